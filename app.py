@@ -4,13 +4,74 @@
 ##
 
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
 from flask_bcrypt import Bcrypt
 
-app = Flask(__name__)
-app.config.from_pyfile('config.py')
+import os
 
-db = SQLAlchemy(app)
-ma = Marshmallow(app)
-flask_bcrypt = Bcrypt(app)
\ No newline at end of file
+# personal imports
+from utils.database import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy() # reads and writes on their own connection pools
+ma = Marshmallow()
+flask_bcrypt = Bcrypt()
+
+# app factory: profile is 'dev', 'test' or 'prod' (default: API_ENV, or dev)
+def create_app(profile=None):
+    from config import profiles
+
+    app = Flask(__name__)
+    app.config.from_object(profiles[profile or os.environ.get('API_ENV', 'dev')])
+    app.config.from_envvar('API_SETTINGS', silent=True) # local overrides
+
+    db.init_app(app)
+    ma.init_app(app)
+    flask_bcrypt.init_app(app)
+
+    # imported here: models and routes import db / ma from this file
+    from routes.users import users_api
+    from routes.auth import auth_api, init_app as init_auth
+    from routes.videos import videos_api
+    from routes.uploads import uploads_api
+    from routes.metrics import metrics_api
+    from utils import metrics, ratelimit, compression
+
+    app.register_blueprint(users_api)
+    app.register_blueprint(auth_api)
+    app.register_blueprint(videos_api)
+    app.register_blueprint(uploads_api)
+    app.register_blueprint(metrics_api)
+    init_auth(app)
+    metrics.init_app(app) # per request SQL / serialization / bcrypt / upload timings
+    ratelimit.init_app(app) # after the metrics, so that the 429 are timed too
+    compression.init_app(app) # gzip / deflate / br of the json responses, runs before the metrics' after_request
+
+    return app
+
+# background threads of a serving process (dev server, or each gunicorn worker after the fork)
+def start_services(app):
+    from utils.tokens import start_reaper
+    from utils.encoding import jobs
+    from utils.views import views
+    from utils.sweeper import sweeper
+    from utils.feed import hub
+    from utils import metrics
+
+    start_reaper(app) # purge expired tokens, sync revoked ones
+    jobs.start(app) # encoding workers, run the queued jobs
+    views.start(app) # batched flush of the view counts
+    metrics.saver.start(app) # snapshot of the metrics for /metrics in the other workers
+    sweeper.start(app) # files of the deleted videos and formats, in small batches
+    hub.start(app) # comments saved by the other workers, for the live streams
+
+# state a forked process must not share with its parent
+def reset_process_state(app):
+    from utils import hashing, response_cache, metrics, ratelimit
+
+    with app.app_context():
+        db.engine.dispose() # sqlite / pooled connections opened before the fork
+        db.dispose_reader()
+    hashing.pool.reset()
+    response_cache.reset()
+    metrics.registry.reset()
+    ratelimit.reset()
@@ -0,0 +1,65 @@
+##
+## FILE WHERE WE COMPARE TWO BENCHMARK RESULTS
+## python -m bench.compare bench/results/<before>.json bench/results/<after>.json [--threshold 10]
+##
+
+import argparse
+import json
+import sys
+
+METRICS = ['p50_ms', 'p95_ms', 'p99_ms', 'throughput', 'queries_per_request']
+HIGHER_IS_BETTER = ['throughput']
+
+def change(before, after):
+    if not before or after is None:
+        return None
+    return (after - before) * 100.0 / before
+
+# (operation, metric, before, after, change %) worse than threshold percent,
+# plus any operation doing more queries per request than before
+def regressions(before, after, threshold, metric='p95_ms'):
+    found = []
+    for name, row in sorted(after['operations'].items()):
+        if name not in before['operations']:
+            continue
+        old = before['operations'][name]
+        delta = change(old[metric], row[metric])
+        if delta is not None and (-delta if metric in HIGHER_IS_BETTER else delta) > threshold:
+            found.append((name, metric, old[metric], row[metric], delta))
+        if row['queries_per_request'] > old['queries_per_request']:
+            found.append((name, 'queries_per_request', old['queries_per_request'], row['queries_per_request'],
+                change(old['queries_per_request'], row['queries_per_request'])))
+    return found
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compares two bench/run.py results, exits 1 on a regression')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=10.0, help='percent of p95 allowed to be lost')
+    args = parser.parse_args()
+
+    with open(args.before) as file:
+        before = json.load(file)
+    with open(args.after) as file:
+        after = json.load(file)
+
+    if before['meta']['dataset'] != after['meta']['dataset'] or before['meta']['mix'] != after['meta']['mix']:
+        print('warning: different dataset or mix, the numbers are not comparable')
+
+    print('%s -> %s' % (before['meta']['commit'], after['meta']['commit']))
+    print('%-20s %-20s %10s %10s %8s' % ('operation', 'metric', 'before', 'after', 'change'))
+    for name in sorted(set(before['operations']) | set(after['operations'])) + ['TOTAL']:
+        old = before['total'] if name == 'TOTAL' else before['operations'].get(name)
+        new = after['total'] if name == 'TOTAL' else after['operations'].get(name)
+        if old is None or new is None:
+            print('%-20s %s' % (name, 'only before' if new is None else 'only after'))
+            continue
+        for metric in METRICS:
+            delta = change(old[metric], new[metric])
+            print('%-20s %-20s %10s %10s %8s' % (name, metric, old[metric], new[metric], '' if delta is None else '%+.1f%%' % delta))
+
+    found = regressions(before, after, args.threshold)
+    for name, metric, old, new, delta in found:
+        print('REGRESSION %s %s: %s -> %s' % (name, metric, old, new))
+    if found:
+        sys.exit(1)
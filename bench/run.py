@@ -0,0 +1,360 @@
+##
+## FILE WHERE WE DEFINE THE ENDPOINT BENCHMARK
+## python -m bench.run [--dataset small] [--mix browse] [--requests 5000] [--threads 4]
+##
+
+from sqlalchemy import event
+from threading import Thread, local
+from datetime import datetime
+
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import time
+
+# personal imports
+from app import create_app, db
+from bench.seed import DATASETS, PASSWORD, WORDS, seed
+
+MP4 = bytes.fromhex('000000206674797069736f6d0000020069736f6d69736f32617663316d703431') + b'\0' * 4096
+
+###################
+#### SCENARIOS ####
+###################
+
+names = itertools.count() # suffix of the users created, unique in the process
+
+# an operation is one request, f(client, context) -> response; context has the rng, the
+# dataset sizes, the token of the thread's user, its id and the videos it created
+def list_users(client, context):
+    return client.get('/users?page=%d&perPage=20' % context.rng.randint(1, 50))
+
+def list_users_cursor(client, context):
+    first = client.get('/users?limit=20')
+    after = (first.get_json() or {}).get('pager', {}).get('next')
+    return client.get('/users?limit=20&after=%s' % after) if after else first
+
+def search_users(client, context):
+    return client.get('/users?pseudo=%s' % context.rng.choice(WORDS))
+
+def get_user(client, context):
+    return client.get('/user/%d' % context.rng.randint(1, context.users))
+
+def get_own_user(client, context):
+    return client.get('/user/%d' % context.userId, headers=context.headers)
+
+def create_user(client, context):
+    name = 'new%d_%d_%d' % (os.getpid(), context.userId, next(names))
+    return client.post('/user', json={'username': name, 'email': name + '@bench', 'password': PASSWORD})
+
+def modify_user(client, context):
+    return client.put('/user/%d' % context.userId, json={'username': context.username, 'email': context.username + '@bench',
+        'password': PASSWORD, 'pseudo': '%s_%d' % (context.rng.choice(WORDS), context.userId)}, headers=context.headers)
+
+def delete_user(client, context):
+    name = 'gone%d_%d_%d' % (os.getpid(), context.userId, next(names))
+    created = client.post('/user', json={'username': name, 'email': name + '@bench', 'password': PASSWORD}).get_json()['data']
+    token = client.post('/auth', json={'login': name, 'password': PASSWORD}).get_json()['data']
+    return client.delete('/user/%d' % created['id'], headers={'x-token': token})
+
+def login(client, context):
+    return client.post('/auth', json={'login': 'user%d' % context.rng.randint(1, context.users), 'password': PASSWORD})
+
+# a random user: the tokens of a user are the same within a second, this one must not be the thread's
+def logout(client, context):
+    token = client.post('/auth', json={'login': 'user%d' % context.rng.randint(1, context.users), 'password': PASSWORD}).get_json()['data']
+    return client.delete('/auth', headers={'x-token': token})
+
+def list_videos(client, context):
+    return client.get('/videos?page=%d&perPage=20' % context.rng.randint(1, 50))
+
+def list_videos_cursor(client, context):
+    first = client.get('/videos?limit=20')
+    after = (first.get_json() or {}).get('pager', {}).get('next')
+    return client.get('/videos?limit=20&after=%s' % after) if after else first
+
+def search_videos(client, context):
+    return client.get('/videos?name=%s' % context.rng.choice(WORDS))
+
+def list_user_videos(client, context):
+    return client.get('/user/%d/videos' % context.rng.randint(1, context.users))
+
+def create_video(client, context):
+    response = client.post('/user/%d/video' % context.userId, data={'name': 'bench %s' % context.rng.choice(WORDS),
+        'source': (io.BytesIO(MP4), 'bench.mp4')}, headers=context.headers, content_type='multipart/form-data')
+    if response.status_code == 201:
+        context.videos.append(response.get_json()['data']['id'])
+    return response
+
+def own_video(client, context):
+    if not context.videos:
+        create_video(client, context)
+    return context.rng.choice(context.videos)
+
+def upload_format(client, context):
+    return client.patch('/video/%d' % own_video(client, context), data={'format': context.rng.choice(['480', '720']),
+        'file': (io.BytesIO(MP4), 'bench.mp4')}, headers=context.headers, content_type='multipart/form-data')
+
+def encode_video(client, context):
+    return client.patch('/video/%d' % own_video(client, context), json={'formats': ['1080']}, headers=context.headers)
+
+def list_jobs(client, context):
+    return client.get('/video/%d/jobs' % own_video(client, context), headers=context.headers)
+
+def get_job(client, context):
+    jobs = client.get('/video/%d/jobs' % own_video(client, context), headers=context.headers).get_json()['data']
+    return client.get('/job/%d' % jobs[0]['id'], headers=context.headers) if jobs else encode_video(client, context)
+
+def rename_video(client, context):
+    return client.put('/video/%d' % own_video(client, context), json={'name': 'bench %s' % context.rng.choice(WORDS)}, headers=context.headers)
+
+def delete_video(client, context):
+    videoId = own_video(client, context)
+    context.videos.remove(videoId)
+    return client.delete('/video/%d' % videoId, headers=context.headers)
+
+def comment_video(client, context):
+    return client.post('/video/%d/comment' % context.hot_video(), json={'body': ' '.join(context.rng.choice(WORDS) for index in range(8))}, headers=context.headers)
+
+def view_video(client, context):
+    return client.post('/video/%d/view' % context.hot_video())
+
+def list_comments(client, context):
+    return client.get('/video/%d/comments' % context.hot_video())
+
+# a feed page: 20 items fetched in one request instead of one request each
+def batch_users(client, context):
+    return client.get('/users/batch?ids=%s' % ','.join(str(context.rng.randint(1, context.users)) for index in range(20)))
+
+def batch_videos(client, context):
+    return client.get('/videos/batch?ids=%s' % ','.join(str(context.hot_video()) for index in range(20)))
+
+def batch_comments(client, context):
+    return client.get('/videos/comments?limit=5&ids=%s' % ','.join(str(context.hot_video()) for index in range(20)))
+
+def comment_videos(client, context):
+    return client.post('/comments', json={'comments': [{'video': context.hot_video(), 'body': ' '.join(context.rng.choice(WORDS) for index in range(8))}
+        for index in range(5)]}, headers=context.headers)
+
+def get_media(client, context):
+    return client.get('/uploads/bench.mp4', headers={'Range': 'bytes=0-1023'} if context.rng.random() < 0.5 else {})
+
+OPERATIONS = dict((f.__name__, f) for f in [
+    list_users, list_users_cursor, search_users, get_user, get_own_user, create_user, modify_user, delete_user,
+    login, logout,
+    list_videos, list_videos_cursor, search_videos, list_user_videos, create_video, upload_format, encode_video,
+    list_jobs, get_job, rename_video, delete_video, comment_video, view_video, list_comments, get_media,
+    batch_users, batch_videos, batch_comments, comment_videos,
+])
+
+# operation -> weight; 'all' drives every route of users_api, auth_api and videos_api the same
+MIXES = {
+    'browse': {
+        'list_videos': 25, 'list_videos_cursor': 10, 'search_videos': 15, 'list_user_videos': 10, 'list_comments': 15,
+        'view_video': 10, 'get_user': 5, 'list_users': 3, 'search_users': 3, 'get_media': 4,
+    },
+    'default': {
+        'list_videos': 20, 'list_videos_cursor': 8, 'search_videos': 12, 'list_user_videos': 8, 'list_comments': 12,
+        'view_video': 10, 'get_user': 4, 'list_users': 2, 'search_users': 2, 'get_media': 4, 'get_own_user': 2,
+        'comment_video': 6, 'login': 2, 'create_video': 2, 'rename_video': 2, 'upload_format': 1, 'encode_video': 1,
+        'list_jobs': 1, 'create_user': 1,
+    },
+    'write': {
+        'comment_video': 25, 'view_video': 20, 'create_video': 10, 'rename_video': 10, 'upload_format': 5,
+        'encode_video': 5, 'create_user': 5, 'modify_user': 5, 'login': 5, 'list_videos': 10,
+    },
+    'all': dict((name, 1) for name in OPERATIONS),
+}
+
+class Context(object):
+    def __init__(self, rng, counts, userId, token):
+        self.rng = rng
+        self.users = counts['users']
+        self.hot = max(1, counts['videos'] // 10)
+        self.userId = userId
+        self.username = 'user%d' % userId
+        self.headers = {'x-token': token}
+        self.videos = []
+
+    # same skew as the seeded comments: most of the traffic on the first 10% of the videos
+    def hot_video(self):
+        return self.rng.randint(1, self.hot)
+
+#################
+#### RUNNING ####
+#################
+
+# statements per request, counted on both engines for the thread running the request
+queries = local()
+
+def count_query(*args):
+    queries.count = getattr(queries, 'count', 0) + 1
+
+def percentile(values, rank):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(rank / 100.0 * (len(values) - 1))))]
+
+def summary(samples, elapsed):
+    latencies = [sample[0] for sample in samples]
+    statuses = {}
+    for sample in samples:
+        statuses[str(sample[2])] = statuses.get(str(sample[2]), 0) + 1
+    return {
+        'requests': len(samples),
+        'throughput': round(len(samples) / elapsed, 2) if elapsed else None, # requests per second
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3) if samples else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3) if samples else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3) if samples else None,
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3) if samples else None,
+        'queries_per_request': round(sum(sample[1] for sample in samples) / float(len(samples)), 2) if samples else None,
+        'statuses': statuses,
+    }
+
+def worker(app, mix, count, seed, counts, userId, token, samples):
+    rng = random.Random(seed)
+    client = app.test_client()
+    context = Context(rng, counts, userId, token)
+    names = sorted(mix)
+    weights = [mix[name] for name in names]
+    for index in range(count):
+        name = rng.choices(names, weights)[0]
+        queries.count = 0
+        began = time.perf_counter()
+        try:
+            response = OPERATIONS[name](client, context)
+            status = response.status_code
+        except Exception as err:
+            status = type(err).__name__
+        samples.append((name, time.perf_counter() - began, queries.count, status))
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    counts = dict(DATASETS[args.dataset])
+    for name in ('users', 'videos', 'comments'):
+        if getattr(args, name) is not None:
+            counts[name] = getattr(args, name)
+
+    # scratch database kept between runs of the same dataset (--reseed to rebuild it)
+    folder = os.path.abspath(args.data)
+    path = os.path.join(folder, 'bench_%(users)d_%(videos)d_%(comments)d.db' % counts)
+    os.makedirs(os.path.join(folder, 'uploads'), exist_ok=True)
+    if args.reseed:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    app = create_app('test')
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI='sqlite:///' + path,
+        UPLOAD_FOLDER=os.path.join(folder, 'uploads') + '/',
+        VIEWS_JOURNAL=os.path.join(folder, 'views.journal'),
+        RESPONSE_CACHE=args.cache,
+        ENCODE_WORKERS=0, # jobs are queued, not encoded
+        ENCODE_QUEUE_SIZE=10 ** 6,
+        SQLALCHEMY_ECHO=False,
+    )
+    with open(os.path.join(folder, 'uploads', 'bench.mp4'), 'wb') as file:
+        file.write(MP4 * 16)
+
+    if not os.path.exists(path):
+        print('seeding %s' % path)
+        began = time.perf_counter()
+        seed(app, counts['users'], counts['videos'], counts['comments'], seed=args.seed)
+        print('seeded in %.1fs' % (time.perf_counter() - began))
+
+    with app.app_context():
+        engines = set([db.engine, db.get_reader_engine()])
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', count_query)
+
+    # one logged in user per thread
+    client = app.test_client()
+    sessions = []
+    for index in range(args.threads):
+        userId = 1 + index * max(1, counts['users'] // args.threads)
+        token = client.post('/auth', json={'login': 'user%d' % userId, 'password': PASSWORD}).get_json()['data']
+        sessions.append((userId, token))
+
+    mix = MIXES[args.mix]
+    if args.warmup:
+        worker(app, mix, args.warmup, args.seed - 1, counts, sessions[0][0], sessions[0][1], [])
+
+    samples = []
+    per_thread = args.requests // args.threads
+    threads = [Thread(target=worker, args=(app, mix, per_thread, args.seed + index, counts, sessions[index][0], sessions[index][1], samples))
+        for index in range(args.threads)]
+    began = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+
+    operations = {}
+    for sample in samples:
+        operations.setdefault(sample[0], []).append(sample[1:])
+
+    return {
+        'meta': {
+            'commit': commit(),
+            'date': datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'dataset': counts,
+            'mix': args.mix,
+            'threads': args.threads,
+            'seed': args.seed,
+            'response_cache': args.cache,
+            'elapsed_s': round(elapsed, 3),
+        },
+        'total': summary([sample[1:] for sample in samples], elapsed),
+        'operations': dict((name, summary(rows, elapsed)) for name, rows in sorted(operations.items())),
+    }
+
+def report(result):
+    print('\n%-20s %8s %10s %9s %9s %9s %8s' % ('operation', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+    for name, row in sorted(result['operations'].items()) + [('TOTAL', result['total'])]:
+        print('%-20s %8d %10.1f %9.2f %9.2f %9.2f %8.1f' % (name, row['requests'], row['throughput'], row['p50_ms'], row['p95_ms'], row['p99_ms'], row['queries_per_request']))
+        errors = dict((status, count) for status, count in row['statuses'].items() if not status.startswith(('2', '3')))
+        if errors:
+            print('%-20s errors: %s' % ('', errors))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='in-process benchmark of the api routes on a synthetic dataset')
+    parser.add_argument('--dataset', default='small', choices=sorted(DATASETS))
+    parser.add_argument('--users', type=int, default=None, help='overrides the dataset size')
+    parser.add_argument('--videos', type=int, default=None)
+    parser.add_argument('--comments', type=int, default=None)
+    parser.add_argument('--mix', default='default', choices=sorted(MIXES))
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--warmup', type=int, default=200, help='requests run before measuring')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=1407)
+    parser.add_argument('--cache', action='store_true', help='keep the response cache on')
+    parser.add_argument('--data', default='bench/data', help='folder of the scratch databases')
+    parser.add_argument('--reseed', action='store_true')
+    parser.add_argument('--out', default=None, help='results file, default: bench/results/<commit>_<mix>_<dataset>.json')
+    args = parser.parse_args()
+
+    result = run(args)
+    report(result)
+
+    out = args.out or os.path.join('bench', 'results', '%s_%s_%s.json' % (result['meta']['commit'] or 'nocommit', args.mix, args.dataset))
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as file:
+        json.dump(result, file, indent=2, sort_keys=True)
+    print('\nresults written to %s' % out)
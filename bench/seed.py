@@ -0,0 +1,92 @@
+##
+## FILE WHERE WE DEFINE THE BENCHMARK DATASETS
+## (synthetic users, videos, formats and comments bulk inserted in a scratch database)
+##
+
+from datetime import datetime, timedelta
+
+import random
+import time
+
+# personal imports
+from app import db, flask_bcrypt
+from utils.migrations import upgrade
+from utils.counters import COUNTERS, fix
+
+# sizes of the datasets, --dataset in bench/run.py (or --users / --videos / --comments)
+DATASETS = {
+    'tiny': {'users': 100, 'videos': 1000, 'comments': 5000},
+    'small': {'users': 1000, 'videos': 10000, 'comments': 100000},
+    'medium': {'users': 10000, 'videos': 100000, 'comments': 1000000},
+    'large': {'users': 100000, 'videos': 1000000, 'comments': 10000000},
+}
+
+PASSWORD = 'bench' # of every seeded user, usernames are user<id>
+FORMATS = ['480', '720', '1080']
+WORDS = ['cat', 'dog', 'music', 'live', 'tutorial', 'game', 'travel', 'cooking', 'news', 'funny',
+    'review', 'football', 'guitar', 'python', 'flask', 'vlog', 'paris', 'trailer', 'remix', 'train']
+
+BATCH_SIZE = 10000
+
+def words(rng, count):
+    return ' '.join(rng.choice(WORDS) for index in range(count))
+
+def batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# ids are 1..count, so that the benchmark can pick rows without asking the database
+# each video gets 0 to 2 formats, the comments go to random videos (most of them to the first 10%)
+def seed(app, users, videos, comments, seed=1407, log=print):
+    rng = random.Random(seed)
+    start = datetime(2019, 1, 1)
+    password = flask_bcrypt.generate_password_hash(PASSWORD, app.config.get('BCRYPT_LOG_ROUNDS', 10)).decode('utf-8')
+
+    with app.app_context():
+        upgrade(db.engine, log=log)
+        connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA synchronous = OFF') # scratch database, rebuilt if anything goes wrong
+
+        def insert(table, statement, rows):
+            began = time.perf_counter()
+            count = 0
+            for batch in batches(rows):
+                cursor.executemany(statement, batch)
+                connection.commit()
+                count += len(batch)
+            log('%s: %d rows in %.1fs' % (table, count, time.perf_counter() - began))
+
+        insert('user', 'INSERT INTO "user" (id, username, email, pseudo, password, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+            ((index, 'user%d' % index, 'user%d@bench' % index, '%s_%d' % (rng.choice(WORDS), index), password,
+                str(start + timedelta(seconds=index))) for index in range(1, users + 1)))
+
+        insert('video', 'INSERT INTO video (id, source, name, view, enabled, user_id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ((index, 'uploads/bench.mp4', words(rng, 3), rng.randint(0, 100000), 1, rng.randint(1, users),
+                str(start + timedelta(seconds=index * 10))) for index in range(1, videos + 1)))
+
+        insert('video__format', 'INSERT INTO video__format (video_id, code, uri) VALUES (?, ?, ?)',
+            ((videoId, code, 'uploads/bench_%s.mp4' % code) for videoId in range(1, videos + 1)
+                for code in FORMATS[:rng.randint(0, 2)]))
+
+        hot = max(1, videos // 10)
+        insert('comment', 'INSERT INTO comment (id, body, user_id, video_id) VALUES (?, ?, ?, ?)',
+            ((index, words(rng, 8), rng.randint(1, users), rng.randint(1, hot) if rng.random() < 0.8 else rng.randint(1, videos))
+                for index in range(1, comments + 1)))
+    finally:
+        connection.close()
+
+    # the rows were inserted without the write paths that keep the counters
+    began = time.perf_counter()
+    with app.app_context():
+        with db.engine.begin() as connection:
+            for counter in COUNTERS:
+                connection.execute(fix(*counter))
+    log('counters in %.1fs' % (time.perf_counter() - began))
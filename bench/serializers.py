@@ -0,0 +1,145 @@
+##
+## FILE WHERE WE COMPARE THE FAST SERIALIZERS WITH MARSHMALLOW
+## python -m bench.serializers [--dataset tiny] [--items 200] [--repeat 20]
+## (fails if any compiled serializer gives another output than schema.dump(...).data)
+##
+
+from datetime import datetime
+from sqlalchemy import event
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+# personal imports
+from app import create_app, db
+from bench.run import commit
+from bench.seed import DATASETS, seed
+from models import User, Video, Video_Format, Comment, Encode_Job, Upload
+from models import UserSchema, VideoSchema, VideoFormatSchema, CommentSchema, EncodeJobSchema, UploadSchema
+from utils.serializers import serializer
+
+# (name, model, schema class, only, exclude), as dumped by the routes and utils/loaders.py
+CASES = [
+    ('users', User, UserSchema, ('id', 'username', 'pseudo', 'created_at', 'video_count'), ()),
+    ('user_private', User, UserSchema, ('id', 'username', 'pseudo', 'email', 'created_at', 'video_count'), ()),
+    ('videos', Video, VideoSchema, None, ('user', 'formats', 'comments')),
+    ('video_full', Video, VideoSchema, None, ()),
+    ('formats', Video_Format, VideoFormatSchema, None, ('video',)),
+    ('format_full', Video_Format, VideoFormatSchema, None, ()),
+    ('comments', Comment, CommentSchema, None, ('user', 'video')),
+    ('comment_full', Comment, CommentSchema, None, ()),
+    ('jobs', Encode_Job, EncodeJobSchema, None, ()),
+    ('uploads', Upload, UploadSchema, ('id', 'filename', 'name', 'code', 'size', 'offset', 'video_id', 'created_at'), ()),
+]
+
+def best(function, repeat):
+    times = []
+    for index in range(repeat):
+        began = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - began)
+    return min(times)
+
+def count_queries(function, engine):
+    queries = [0]
+    def count(*args):
+        queries[0] += 1
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        function()
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    return queries[0]
+
+def run(args):
+    counts = DATASETS[args.dataset]
+    folder = os.path.abspath(args.data)
+    path = os.path.join(folder, 'bench_%(users)d_%(videos)d_%(comments)d.db' % counts)
+    os.makedirs(folder, exist_ok=True)
+
+    app = create_app('test')
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + path, ENCODE_WORKERS=0, SQLALCHEMY_ECHO=False)
+    if not os.path.exists(path):
+        print('seeding %s' % path)
+        seed(app, counts['users'], counts['videos'], counts['comments'])
+
+    cases = {}
+    mismatches = []
+    with app.app_context():
+        for name, model, schema_class, only, exclude in CASES:
+            # a fresh session per case, so that both paths start without loaded relationships
+            db.session.remove()
+            objects = model.query.order_by(model.id).limit(args.items).all()
+            if not objects:
+                print('%-14s no rows, skipped' % name)
+                continue
+            schema = schema_class(only=only, exclude=exclude, many=True)
+            fast = serializer(schema_class, only=only, exclude=exclude, many=True)
+
+            if schema.dump(objects).data != fast(objects):
+                mismatches.append(name)
+                continue
+
+            db.session.remove()
+            objects = model.query.order_by(model.id).limit(args.items).all()
+            fast_queries = count_queries(lambda: fast(objects), db.get_reader_engine())
+            db.session.remove()
+            objects = model.query.order_by(model.id).limit(args.items).all()
+            queries = count_queries(lambda: schema.dump(objects), db.get_reader_engine())
+
+            # relationships are loaded by now, the timings are the serialization alone
+            marshmallow = best(lambda: schema.dump(objects), args.repeat)
+            compiled = best(lambda: fast(objects), args.repeat)
+            cases[name] = {
+                'items': len(objects),
+                'marshmallow_us_per_item': round(marshmallow * 1e6 / len(objects), 2),
+                'compiled_us_per_item': round(compiled * 1e6 / len(objects), 2),
+                'speedup': round(marshmallow / compiled, 2),
+                'marshmallow_queries': queries,
+                'compiled_queries': fast_queries,
+            }
+
+    return {
+        'meta': {
+            'commit': commit(),
+            'date': datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'dataset': counts,
+            'items': args.items,
+            'repeat': args.repeat,
+        },
+        'cases': cases,
+        'mismatches': mismatches,
+    }
+
+def report(result):
+    print('\n%-14s %6s %14s %14s %8s %10s' % ('case', 'items', 'marshmallow us', 'compiled us', 'speedup', 'queries'))
+    for name, row in sorted(result['cases'].items()):
+        print('%-14s %6d %14.2f %14.2f %7.2fx %4d -> %-4d' % (name, row['items'], row['marshmallow_us_per_item'],
+            row['compiled_us_per_item'], row['speedup'], row['marshmallow_queries'], row['compiled_queries']))
+    for name in result['mismatches']:
+        print('MISMATCH %s: the compiled output differs from schema.dump(...).data' % name)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='checks and times the compiled serializers against marshmallow')
+    parser.add_argument('--dataset', default='tiny', choices=sorted(DATASETS))
+    parser.add_argument('--items', type=int, default=200, help='objects dumped per case')
+    parser.add_argument('--repeat', type=int, default=20, help='best of')
+    parser.add_argument('--data', default='bench/data', help='folder of the scratch databases')
+    parser.add_argument('--out', default=None, help='results file, default: bench/results/<commit>_serializers_<dataset>.json')
+    args = parser.parse_args()
+
+    result = run(args)
+    report(result)
+
+    out = args.out or os.path.join('bench', 'results', '%s_serializers_%s.json' % (result['meta']['commit'] or 'nocommit', args.dataset))
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as file:
+        json.dump(result, file, indent=2, sort_keys=True)
+    print('\nresults written to %s' % out)
+    if result['mismatches']:
+        sys.exit(1)
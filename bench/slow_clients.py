@@ -0,0 +1,282 @@
+##
+## FILE WHERE WE MEASURE THE SLOW CLIENTS THE SERVERS CAN HOLD
+## python -m bench.slow_clients [--clients 16] [--size 256] [--rate 64] [--servers gthread,asyncio]
+## (N clients upload / download at --rate KB/s while a prober times GET /videos, on gunicorn gthread and on media_server.py)
+##
+
+from datetime import datetime
+from threading import Thread
+
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+# personal imports
+from app import create_app
+from bench.run import MP4, commit, percentile
+from bench.seed import DATASETS, PASSWORD, seed
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOUNDARY = 'benchslowclients'
+
+# command of each server, listening on port with `threads` request threads
+def server_command(name, port, threads):
+    if name == 'gthread':
+        return [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'], \
+            {'API_BIND': '127.0.0.1:%d' % port, 'API_WORKERS': '1', 'API_THREADS': str(threads)}
+    return [sys.executable, 'media_server.py'], {'API_AIO_BIND': '127.0.0.1:%d' % port, 'API_AIO_THREADS': str(threads)}
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+# one request on a new connection: (status, body), raises socket.timeout
+def request(port, method, path, body=b'', headers=None, timeout=10):
+    lines = ['%s %s HTTP/1.1' % (method, path), 'Host: 127.0.0.1', 'Connection: close', 'Content-Length: %d' % len(body)]
+    lines += ['%s: %s' % item for item in (headers or {}).items()]
+    sock = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+    try:
+        sock.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        response = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            response += chunk
+    finally:
+        sock.close()
+    head, _, content = response.partition(b'\r\n\r\n')
+    return int(head.split(b' ')[1]) if head else 0, content
+
+def wait_ready(port, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('server exited with %d' % process.returncode)
+        try:
+            if request(port, 'GET', '/videos?limit=1', timeout=1)[0] == 200:
+                return
+        except (OSError, IndexError, ValueError):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('server not ready after %ds' % timeout)
+
+def upload_body(size):
+    content = (MP4 + b'\0' * size)[:size]
+    return ('--%s\r\nContent-Disposition: form-data; name="name"\r\n\r\nslow client\r\n' % BOUNDARY).encode('latin-1') \
+        + ('--%s\r\nContent-Disposition: form-data; name="source"; filename="slow.mp4"\r\nContent-Type: video/mp4\r\n\r\n' % BOUNDARY).encode('latin-1') \
+        + content + ('\r\n--%s--\r\n' % BOUNDARY).encode('latin-1')
+
+###################
+#### CLIENTS ######
+###################
+
+# sends the body of POST /user/<id>/video at rate bytes/s, (status, seconds) into results
+def slow_upload(port, userId, token, body, rate, timeout, results):
+    began = time.perf_counter()
+    status = 'error'
+    try:
+        sock = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+        try:
+            sock.sendall(('POST /user/%d/video HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\nx-token: %s\r\n'
+                'Content-Type: multipart/form-data; boundary=%s\r\nContent-Length: %d\r\n\r\n' % (userId, token, BOUNDARY, len(body))).encode('latin-1'))
+            step = 8192
+            for offset in range(0, len(body), step):
+                sock.sendall(body[offset:offset + step])
+                time.sleep(step / float(rate))
+            response = sock.recv(65536)
+            status = int(response.split(b' ')[1]) if response else 'closed'
+        finally:
+            sock.close()
+    except socket.timeout:
+        status = 'timeout'
+    except (OSError, IndexError, ValueError):
+        pass
+    results.append((status, time.perf_counter() - began))
+
+# reads GET /uploads/<filename> at rate bytes/s through a small receive buffer
+def slow_download(port, filename, size, rate, timeout, results):
+    began = time.perf_counter()
+    status = 'error'
+    try:
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16 * 1024)
+        sock.settimeout(timeout)
+        sock.connect(('127.0.0.1', port))
+        try:
+            sock.sendall(('GET /uploads/%s HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n' % filename).encode('latin-1'))
+            response = b''
+            step = 8192
+            while True:
+                chunk = sock.recv(step)
+                if not chunk:
+                    break
+                response += chunk
+                time.sleep(len(chunk) / float(rate))
+            head, _, content = response.partition(b'\r\n\r\n')
+            status = int(head.split(b' ')[1]) if len(content) == size else 'truncated'
+        finally:
+            sock.close()
+    except socket.timeout:
+        status = 'timeout'
+    except (OSError, IndexError, ValueError):
+        pass
+    results.append((status, time.perf_counter() - began))
+
+# GET /videos every interval until done is set: (seconds or None on a timeout / error, status)
+def probe(port, interval, timeout, done, samples):
+    while not done:
+        began = time.perf_counter()
+        try:
+            status = request(port, 'GET', '/videos?limit=10', timeout=timeout)[0]
+            samples.append((time.perf_counter() - began, status))
+        except socket.timeout:
+            samples.append((None, 'timeout'))
+        except (OSError, IndexError, ValueError):
+            samples.append((None, 'error'))
+        time.sleep(max(0, interval - (time.perf_counter() - began)))
+
+def summary(transfers, probes, elapsed):
+    completed = [seconds for status, seconds in transfers if status in (200, 201)]
+    latencies = [seconds for seconds, status in probes if seconds is not None]
+    statuses = {}
+    for status, seconds in transfers:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'elapsed_s': round(elapsed, 3),
+        'transfers': len(transfers),
+        'completed': len(completed),
+        'transfer_statuses': statuses,
+        'transfer_p50_s': round(percentile(completed, 50), 3) if completed else None,
+        'transfer_max_s': round(max(completed), 3) if completed else None,
+        'probes': len(probes),
+        'probe_failures': len(probes) - len(latencies),
+        'probe_p50_ms': round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        'probe_p99_ms': round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+        'probe_max_ms': round(max(latencies) * 1000, 3) if latencies else None,
+    }
+
+def scenario(kind, port, args, userId, token):
+    rate = args.rate * 1024
+    size = args.size * 1024
+    timeout = size / float(rate) * 4 + 30
+    body = upload_body(size)
+    transfers = []
+    probes = []
+    done = []
+    if kind == 'upload':
+        clients = [Thread(target=slow_upload, args=(port, userId, token, body, rate, timeout, transfers)) for index in range(args.clients)]
+    else:
+        clients = [Thread(target=slow_download, args=(port, 'slow_clients.bin', size, rate, timeout, transfers)) for index in range(args.clients)]
+    prober = Thread(target=probe, args=(port, args.interval, args.probe_timeout, done, probes))
+
+    began = time.perf_counter()
+    for thread in clients:
+        thread.start()
+    time.sleep(0.2) # the slow clients got their connection first
+    prober.start()
+    for thread in clients:
+        thread.join()
+    done.append(True)
+    prober.join()
+    return summary(transfers, probes, time.perf_counter() - began)
+
+def run(args):
+    counts = DATASETS[args.dataset]
+    folder = os.path.abspath(args.data)
+    path = os.path.join(folder, 'bench_%(users)d_%(videos)d_%(comments)d.db' % counts)
+    os.makedirs(os.path.join(folder, 'uploads'), exist_ok=True)
+
+    # the servers run in their own processes, with these overrides (API_SETTINGS)
+    settings = os.path.join(folder, 'slow_clients_settings.py')
+    overrides = {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+        'UPLOAD_FOLDER': os.path.join(folder, 'uploads') + '/',
+        'VIEWS_JOURNAL': os.path.join(folder, 'views.journal'),
+        'ENCODE_WORKERS': 0,
+        'SQLALCHEMY_ECHO': False,
+    }
+    with open(settings, 'w') as file:
+        for name, value in sorted(overrides.items()):
+            file.write('%s = %r\n' % (name, value))
+    with open(os.path.join(folder, 'uploads', 'slow_clients.bin'), 'wb') as file:
+        file.write((MP4 + b'\0' * args.size * 1024)[:args.size * 1024])
+
+    if not os.path.exists(path):
+        print('seeding %s' % path)
+        app = create_app('test')
+        app.config.update(overrides)
+        seed(app, counts['users'], counts['videos'], counts['comments'])
+
+    results = {}
+    for name in args.servers.split(','):
+        port = free_port()
+        command, variables = server_command(name, port, args.threads)
+        env = dict(os.environ, API_ENV='test', API_SETTINGS=settings, **variables)
+        with open(os.path.join(folder, 'slow_clients_%s.log' % name), 'w') as log:
+            process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+            try:
+                wait_ready(port, process)
+                status, content = request(port, 'POST', '/auth', json.dumps({'login': 'user1', 'password': PASSWORD}).encode('utf-8'),
+                    {'Content-Type': 'application/json'})
+                token = json.loads(content.decode('utf-8'))['data']
+                results[name] = {}
+                for kind in args.scenarios.split(','):
+                    print('%s: %d slow %s(s) at %dKB/s...' % (name, args.clients, kind, args.rate))
+                    results[name][kind] = scenario(kind, port, args, 1, token)
+            finally:
+                process.terminate()
+                process.wait()
+
+    return {
+        'meta': {
+            'commit': commit(),
+            'date': datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'dataset': counts,
+            'clients': args.clients,
+            'size_kb': args.size,
+            'rate_kbps': args.rate,
+            'threads': args.threads,
+        },
+        'servers': results,
+    }
+
+def report(result):
+    print('\n%-8s %-9s %9s %10s %10s %8s %10s %10s %10s' % ('server', 'scenario', 'completed', 'p50 s', 'max s', 'probes', 'failed', 'p50 ms', 'p99 ms'))
+    for name, scenarios in sorted(result['servers'].items()):
+        for kind, row in sorted(scenarios.items()):
+            print('%-8s %-9s %4d/%-4d %10s %10s %8d %10d %10s %10s' % (name, kind, row['completed'], row['transfers'], row['transfer_p50_s'],
+                row['transfer_max_s'], row['probes'], row['probe_failures'], row['probe_p50_ms'], row['probe_p99_ms']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='slow uploads / downloads on gunicorn gthread and on the async media server')
+    parser.add_argument('--dataset', default='tiny', choices=sorted(DATASETS))
+    parser.add_argument('--servers', default='gthread,asyncio')
+    parser.add_argument('--scenarios', default='upload,download')
+    parser.add_argument('--clients', type=int, default=16, help='slow clients at once')
+    parser.add_argument('--size', type=int, default=256, help='KB per upload / download')
+    parser.add_argument('--rate', type=int, default=64, help='KB/s of each slow client')
+    parser.add_argument('--threads', type=int, default=4, help='request threads of gunicorn (one worker) and of the media server pool')
+    parser.add_argument('--interval', type=float, default=0.1, help='seconds between two probes')
+    parser.add_argument('--probe-timeout', type=float, default=2.0)
+    parser.add_argument('--data', default='bench/data', help='folder of the scratch databases')
+    parser.add_argument('--out', default=None, help='results file, default: bench/results/<commit>_slow_clients.json')
+    args = parser.parse_args()
+
+    result = run(args)
+    report(result)
+
+    out = args.out or os.path.join('bench', 'results', '%s_slow_clients.json' % (result['meta']['commit'] or 'nocommit'))
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as file:
+        json.dump(result, file, indent=2, sort_keys=True)
+    print('\nresults written to %s' % out)
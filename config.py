@@ -1,10 +1,184 @@
-# config
-SECRET_KEY = 'whatiswallou'
-SQLALCHEMY_DATABASE_URI = 'sqlite:///api.db'
-UPLOAD_FOLDER = 'uploads/'
-MAX_CONTENT_LENGTH = 100 * 1024 * 1024
-SQLALCHEMY_TRACK_MODIFICATIONS = False
-
-# dev
-DEBUG = True
-SQLALCHEMY_ECHO = True
\ No newline at end of file
+import os
+
+# config profiles, selected by the API_ENV environment variable (dev, test, prod)
+# see create_app in app.py; API_SETTINGS can point to a python file overriding any of them
+
+class Config(object):
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'whatiswallou')
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///api.db')
+    UPLOAD_FOLDER = 'uploads/'
+    MAX_CONTENT_LENGTH = 100 * 1024 * 1024
+    UPLOAD_MAX_SIZE = 2 * 1024 * 1024 * 1024 # total size of a resumable upload
+    UPLOAD_CHUNK_MAX_SIZE = 16 * 1024 * 1024 # size of one PUT /upload/<id>
+    UPLOAD_BUFFER_SIZE = 64 * 1024 # bytes read from the request stream at once
+    BLOB_FOLDER = 'blobs' # in UPLOAD_FOLDER, files stored once per content (see utils/storage.py)
+    BLOB_SHARD_DEPTH = 2 # blobs/ab/cd/<sha256><ext>, 65536 folders
+
+    # media sweeper: files of deleted videos and formats are removed in the background (see utils/sweeper.py)
+    GC = True
+    GC_INTERVAL = 60 # seconds between two sweeps of the unreferenced blobs
+    GC_SCAN_INTERVAL = 24 * 3600 # seconds between two walks of UPLOAD_FOLDER for files without a row
+    GC_GRACE = 3600 # seconds a file must be left untouched before it is removed
+    GC_BATCH_SIZE = 100 # files removed per batch
+    GC_BATCH_PAUSE = 1.0 # seconds between two batches, so that the disk keeps serving media
+    GC_DRY_RUN = False # only log what would be removed
+    GC_LOCK = 'gc.lock' # one sweeping process at a time
+    BLOB_LOCK = 'blobs.lock' # taken by the uploads touching a blob and by the sweeper removing one (None = this process only)
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # database connections (see utils/database.py)
+    # writes go through a single connection per worker, sqlite allows one writer at a time anyway
+    SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': 1, 'max_overflow': 0, 'pool_timeout': 30}
+    # reads of the handlers go to a pool of their own, on a replica if SQLALCHEMY_READ_URI is set
+    SQLALCHEMY_READ_ROUTING = True
+    SQLALCHEMY_READ_URI = os.environ.get('DATABASE_READ_URL') # None = same database as the writes
+    SQLALCHEMY_READ_ENGINE_OPTIONS = {'pool_size': 8, 'max_overflow': 16, 'pool_timeout': 30}
+    SQLITE_PRAGMAS = [
+        ('journal_mode', 'WAL'), # readers don't block the writer and the other way around
+        ('busy_timeout', 5000), # ms waiting for the lock of another process instead of 'database is locked'
+        ('synchronous', 'NORMAL'), # safe with WAL, no fsync on each commit
+        ('mmap_size', 256 * 1024 * 1024),
+        ('cache_size', -16000), # KiB
+        ('temp_store', 'MEMORY'),
+    ]
+
+    # media (/uploads/<filename>)
+    MEDIA_MAX_AGE = 3600 # Cache-Control max-age, ETag / Last-Modified for revalidation
+    MEDIA_MAX_RANGES = 16 # more ranges than that in one request gets the whole file
+    MEDIA_BUFFER_SIZE = 64 * 1024
+    MEDIA_ACCEL = None # 'x-accel' (nginx) or 'x-sendfile' (apache, lighttpd) to let the proxy send the file
+    MEDIA_ACCEL_PREFIX = '/protected/' # internal nginx location aliased to UPLOAD_FOLDER
+
+    # encoding jobs (PATCH /video/<id> with {"formats": [...]})
+    ENCODER = 'utils.encoding.FFmpegEncoder' # or 'utils.encoding.CopyEncoder' without ffmpeg
+    FFMPEG_BIN = 'ffmpeg'
+    ENCODE_WORKERS = 2 # encoding threads per worker
+    ENCODE_QUEUE_SIZE = 100 # jobs waiting before answering 503
+    ENCODE_MAX_ATTEMPTS = 3
+    ENCODE_RETRY_DELAY = 10 # seconds, doubled at each attempt
+    ENCODE_TIMEOUT = 3600 # seconds
+    ENCODE_RETRY_AFTER = 30 # Retry-After of the 503
+    ENCODE_HEARTBEAT = 30 # seconds between two updates of updated_at of the running jobs
+    ENCODE_STALE_AFTER = 300 # seconds without a heartbeat before a running job is queued again (its worker died)
+
+    # views (POST /video/<id>/view)
+    VIEWS_FLUSH_INTERVAL = 5 # seconds between two batched UPDATE of video.view
+    VIEWS_JOURNAL = 'views.journal' # views left at exit if the database was not reachable
+
+    # search (?name= on /videos, ?pseudo= on /users)
+    SEARCH_FTS = True # SQLite FTS5 ranked prefix search, LIKE / exact match without it
+    SEARCH_MAX_TERMS = 8
+
+    # response cache (GET /videos, /users, /user/<id>/videos, /video/<id>/comments)
+    RESPONSE_CACHE = True
+    RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024 # per worker, LRU
+    RESPONSE_CACHE_TTL = 30 # seconds, also bounds how stale the view counts are
+    RESPONSE_CACHE_VERSIONS = 'cache.versions' # file shared by the workers for invalidations (None = this process only)
+    RESPONSE_CACHE_SLOTS = 65536
+
+    # live comments (GET /video/<id>/comments/stream, see utils/feed.py)
+    STREAM_MAX_CLIENTS = int(os.environ.get('API_STREAM_CLIENTS', 2)) # open streams per gunicorn worker, each holds a request thread (the media server has AIO_STREAM_MAX_CLIENTS)
+    STREAM_HEARTBEAT = 15 # seconds between two ': ping' of an idle stream
+    STREAM_MAX_DURATION = 300 # seconds before a stream is closed, the EventSource reconnects with Last-Event-ID
+    STREAM_RETRY = 3000 # ms, reconnection delay sent to the EventSource
+    STREAM_RESUME_MAX = 100 # comments sent from the database on a resume, the rest on the next one
+    STREAM_CHANNEL_BACKLOG = 100 # events kept per watched video for the slow streams
+    STREAM_POLL_INTERVAL = 1.0 # seconds between two reads of the comments saved by the other workers
+    STREAM_POLL_BATCH = 500
+
+    # async media server (python media_server.py, see utils/aio.py)
+    AIO_BIND = os.environ.get('API_AIO_BIND', '0.0.0.0:1408')
+    AIO_THREADS = int(os.environ.get('API_AIO_THREADS', 8)) # pool for the checks, the database writes and the other routes
+    AIO_HEADER_TIMEOUT = 10 # seconds to send the request line and headers
+    AIO_READ_TIMEOUT = 60 # seconds without a byte of the body read or of the response taken before the connection is closed
+    AIO_KEEPALIVE = 5 # seconds an idle connection is kept between two requests
+    AIO_MAX_HEADER_SIZE = 64 * 1024
+    AIO_STREAM_MAX_CLIENTS = int(os.environ.get('API_AIO_STREAM_CLIENTS', 10000)) # comment streams of the media server, a position on its loop each
+
+    # response compression (see utils/compression.py)
+    COMPRESSION = True
+    COMPRESSION_MIN_SIZE = 1024 # bytes, smaller bodies are sent as they are
+    COMPRESSION_STREAM_SIZE = 1024 * 1024 # bytes, larger bodies are compressed chunk by chunk as they are sent (streamed ones always)
+    COMPRESSION_CHUNK_SIZE = 64 * 1024
+    COMPRESSION_LEVEL = 6 # gzip and deflate, 1 (fast) to 9 (small)
+    COMPRESSION_BROTLI_QUALITY = 4 # br, offered when the brotli package is installed
+    COMPRESSION_MIMETYPES = ('application/json', 'text/plain', 'text/html', 'text/csv')
+    COMPRESSION_SKIP = ('videos_api.uploaded_file',) # media files: already compressed, and Range is on the file bytes
+
+    # pagination
+    PAGER_MAX_LIMIT = 100 # max perPage / limit
+    PAGER_COUNT_TTL = 30 # seconds a cached COUNT(*) is reused for pager.total
+    PAGER_COUNT_CACHE_SIZE = 1024
+    COMMENT_PREVIEW_SIZE = 5 # comments embedded per video in lists (?expand=comments)
+    BATCH_MAX_ITEMS = 100 # ids / comments per batch request (/videos/batch, /users/batch, /videos/comments, POST /comments)
+
+    # auth
+    AUTH_CACHE_SIZE = 10000 # verified tokens / users kept per process
+    AUTH_CACHE_TTL = 60 # seconds
+    TOKEN_REVOCATION_SYNC = 5 # seconds before a logout is seen by the other workers
+    TOKEN_REAPER_INTERVAL = 600 # seconds between two purges of expired tokens
+    TOKEN_REAPER_BATCH = 1000 # rows deleted per transaction
+
+    # metrics (GET /metrics, prometheus format)
+    METRICS = True
+    METRICS_DIR = 'metrics' # one snapshot per worker, summed by the one answering the scrape (None = this process only)
+    METRICS_SYNC_INTERVAL = 5 # seconds between two snapshots of a worker
+    METRICS_FOLD_INTERVAL = 60 # seconds between two folds of the snapshots of the dead workers into metrics.dead.json
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN') # Authorization: Bearer <token> required on /metrics if set
+    SLOW_REQUEST_THRESHOLD = 0.5 # seconds, logged with their slowest statements (None = off)
+    SLOW_REQUEST_LOG_STATEMENTS = 10
+    SLOW_REQUEST_LOG_PARAMETERS = False # the values hold tokens and password hashes
+    SLOW_REQUEST_MAX_STATEMENTS = 50 # statements kept per request for the log
+
+    # rate limits (see utils/ratelimit.py): token buckets, 429 with Retry-After once empty
+    RATE_LIMIT = True
+    RATE_LIMIT_FILE = 'ratelimit.buckets' # buckets shared by the workers (None = this process only)
+    RATE_LIMIT_SLOTS = 65536 # keys hashed on that many buckets (16 bytes each)
+    RATE_LIMIT_PROXIES = 0 # X-Forwarded-For entries added by our own proxies (1 behind one nginx)
+    # endpoint or blueprint -> [(scope, requests, seconds)], scope 'ip' per client address or 'user'
+    # per authenticated user (per address without a token); a bucket holds `requests` tokens refilled over `seconds`
+    RATE_LIMITS = {
+        'auth_api.auth': [('ip', 10, 60)], # a bcrypt check per attempt
+        'users_api.createUser': [('ip', 5, 600)], # a bcrypt hash per user
+        'users_api.modifyUser': [('user', 10, 60)],
+        'videos_api.createVideo': [('user', 20, 60), ('ip', 40, 60)], # disk writes
+        'videos_api.encodeVideo': [('user', 20, 60)],
+        'videos_api.commentVideos': [('user', 30, 60)],
+        'uploads_api': [('user', 300, 60), ('ip', 600, 60)], # chunks of UPLOAD_CHUNK_MAX_SIZE
+    }
+
+    # password hashing
+    BCRYPT_LOG_ROUNDS = 10 # cost of new hashes, older ones are rehashed on login
+    HASH_POOL_WORKERS = 2 # bcrypt processes per worker (0 = hash in the request thread)
+    HASH_POOL_QUEUE = 8 # hashes waiting for a process before answering 503
+    HASH_TIMEOUT = 5 # seconds
+    HASH_RETRY_AFTER = 1 # Retry-After of the 503
+
+    DEBUG = False
+    SQLALCHEMY_ECHO = False
+
+# dev: debugger, reloader and every SQL statement in the logs
+class DevConfig(Config):
+    DEBUG = True
+    SQLALCHEMY_ECHO = True
+
+class TestConfig(Config):
+    TESTING = True
+    HASH_POOL_WORKERS = 0 # hash in the request thread
+    BCRYPT_LOG_ROUNDS = 4
+    RESPONSE_CACHE_VERSIONS = None
+    METRICS_DIR = None
+    ENCODER = 'utils.encoding.CopyEncoder'
+    GC_LOCK = None
+    BLOB_LOCK = None
+    RATE_LIMIT = False # tests and benchmarks send everything from one address
+
+# prod: served by gunicorn (see gunicorn.conf.py), SECRET_KEY and DATABASE_URL come from the environment
+class ProdConfig(Config):
+    PREFERRED_URL_SCHEME = 'https'
+
+profiles = {
+    'dev': DevConfig,
+    'test': TestConfig,
+    'prod': ProdConfig,
+}
@@ -0,0 +1,48 @@
+##
+## FILE WHERE WE CONFIGURE GUNICORN (prefork serving)
+## gunicorn -c gunicorn.conf.py wsgi:app
+##
+## the app is loaded once in the master and the workers are forked from it,
+## kill -HUP <master> restarts the workers gracefully, kill -TERM stops after the running requests,
+## to deploy new code: kill -USR2 <master> (new master) then kill -QUIT <old master>
+##
+
+import multiprocessing
+import os
+
+bind = os.environ.get('API_BIND', '0.0.0.0:1407')
+workers = int(os.environ.get('API_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('API_THREADS', 4)) # a live comment stream holds one of them, API_STREAM_CLIENTS caps those per worker
+preload_app = True
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+max_requests = 10000 # recycle workers, with jitter so they don't all restart together
+max_requests_jitter = 1000
+accesslog = '-'
+
+# master, once the app is loaded: jobs left running by the last run go back to the queue
+def when_ready(server):
+    from utils.encoding import recover_jobs
+    recover_jobs(server.app.wsgi())
+
+# each worker: drop what was inherited from the master, then start the background threads
+def post_fork(server, worker):
+    from app import reset_process_state, start_services
+    app = server.app.wsgi()
+    reset_process_state(app)
+    start_services(app)
+
+# graceful stop of a worker: flush what is still in memory
+def worker_exit(server, worker):
+    from utils.views import views
+    from utils.encoding import jobs
+    from utils import metrics
+    if views.app is not None:
+        views.stop()
+    if jobs.app is not None:
+        jobs.stop() # its running jobs go back to the queue
+    if metrics.saver.app is not None:
+        with metrics.saver.app.app_context():
+            metrics.save() # last numbers of the worker, still summed by /metrics
@@ -0,0 +1,116 @@
+##
+## FILE WHERE WE MANAGE THE DATABASE, OUTSIDE OF THE SERVING PATH
+## python manage.py init-db | migrate [--to N] | db-status | check-plans | import-uploads | gc [--dry-run] [--orphans] [--grace S]
+##        | repair-counters [--dry-run] [--batch N]
+##
+
+import argparse
+import shutil
+import sys
+import tempfile
+
+from app import create_app, db
+from models import *
+
+# creates the tables (and the search indexes) of an empty database, or migrates an existing one
+def init_db(app, args):
+    from utils.migrations import upgrade
+
+    with app.app_context():
+        upgrade(db.engine)
+    print('database ready')
+
+# applies the pending migrations (up to --to)
+def migrate(app, args):
+    from utils.migrations import upgrade
+
+    with app.app_context():
+        applied = upgrade(db.engine, args.to)
+    print('%d migration(s) applied' % len(applied))
+
+def db_status(app, args):
+    from utils.migrations import status
+
+    with app.app_context():
+        for version, name, applied in status(db.engine):
+            print('%04d_%s %s' % (version, name, 'applied' if applied else 'pending'))
+
+# EXPLAIN QUERY PLAN of the statements of the routes on a new database, exits 1 on a full table scan
+def check_plans(app, args):
+    from utils.migrations import upgrade
+    from utils.plans import check
+
+    folder = tempfile.mkdtemp()
+    try:
+        app = create_app('test')
+        app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + folder + '/plans.db', UPLOAD_FOLDER=folder + '/')
+        with app.app_context():
+            upgrade(db.engine)
+
+        failures = check(app)
+    finally:
+        shutil.rmtree(folder)
+
+    for request, statement, scans in failures:
+        print('\nFULL SCAN in %s: %s\n%s' % (request, ', '.join(scans), statement))
+    print('\n%d statement(s) with a full table scan' % len(failures))
+    if failures:
+        sys.exit(1)
+
+# moves the files of the videos and formats created before the blobs (migration 0003) into the blob storage
+def import_uploads(app, args):
+    from utils.storage import import_legacy
+
+    with app.app_context():
+        imported, missing = import_legacy()
+    print('%d file(s) imported, %d missing' % (imported, missing))
+
+# one sweep of the media files now (every file of UPLOAD_FOLDER), --dry-run reports without removing anything
+# --orphans first deletes the rows left without their video or user by the deletes of before the cascades
+def gc(app, args):
+    from utils.sweeper import sweep, delete_orphans
+
+    if args.grace is not None:
+        app.config['GC_GRACE'] = args.grace
+    with app.app_context():
+        if args.orphans:
+            counts = delete_orphans(db.session, args.dry_run)
+            for name, count in sorted(counts.items()):
+                print('%s: %d orphan row(s)%s' % (name, count, ' (dry run)' if args.dry_run else ' deleted'))
+        report = sweep(dry_run=args.dry_run, scan=True)
+    print('\n'.join(report.lines()))
+    for path in report.paths:
+        print('  ' + path)
+
+# recomputes video.comment_count, video.format_count and user.video_count, --batch ids per transaction
+def repair_counters(app, args):
+    from utils.counters import repair
+
+    with app.app_context():
+        found = repair(db.session, args.batch, args.dry_run, log=print)
+        db.session.remove()
+    print('%d wrong counter(s)%s' % (sum(found.values()), ' (dry run)' if args.dry_run else ' fixed'))
+
+commands = {
+    'init-db': init_db,
+    'migrate': migrate,
+    'db-status': db_status,
+    'check-plans': check_plans,
+    'import-uploads': import_uploads,
+    'gc': gc,
+    'repair-counters': repair_counters,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='api management commands')
+    parser.add_argument('command', choices=sorted(commands))
+    parser.add_argument('--env', default=None, help='config profile (dev, test, prod), default: API_ENV or dev')
+    parser.add_argument('--to', default=None, type=int, help='migrate: last version to apply, default: all')
+    parser.add_argument('--dry-run', action='store_true', help='gc, repair-counters: report only')
+    parser.add_argument('--orphans', action='store_true', help='gc: also delete the orphan rows')
+    parser.add_argument('--grace', default=None, type=int, help='gc: seconds a file must be untouched, default: GC_GRACE')
+    parser.add_argument('--batch', default=10000, type=int, help='repair-counters: ids per transaction')
+    args = parser.parse_args()
+
+    app = create_app(args.env)
+    commands[args.command](app, args)
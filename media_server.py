@@ -0,0 +1,18 @@
+##
+## FILE WHERE WE RUN THE ASYNC MEDIA SERVER,
+## (asyncio on AIO_BIND, port 1408 by default: the proxy sends it POST /user/<id>/video, PATCH /video/<id>, /uploads/
+##  and /video/<id>/comments/stream,
+##  the rest to gunicorn; any other route also works here, in the AIO_THREADS pool, see utils/aio.py)
+##
+
+import os
+
+from app import create_app, start_services
+from utils.aio import serve
+
+app = create_app(os.environ.get('API_ENV', 'prod'))
+
+if __name__ == '__main__':
+    start_services(app)
+    host, _, port = app.config['AIO_BIND'].rpartition(':')
+    serve(app, host, int(port))
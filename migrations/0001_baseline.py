@@ -0,0 +1,11 @@
+##
+## MIGRATION 0001: DATABASES CREATED BY db.create_all BEFORE THE MIGRATIONS
+## (gets them the tables added since, the existing tables are left as they are)
+##
+
+# personal imports
+from app import db
+import models
+
+def upgrade(connection):
+    db.Model.metadata.create_all(connection) # skips the existing tables
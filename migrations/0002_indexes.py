@@ -0,0 +1,42 @@
+##
+## MIGRATION 0002: INDEXES OF THE FOREIGN KEYS AND OF THE QUERIES OF routes/
+## (and one Video_Format per (video_id, code), for the upserts)
+##
+
+from sqlalchemy import text
+
+# personal imports
+from utils.migrations import create_index
+
+INDEXES = [
+    ('ix_user_pseudo', 'user', ['pseudo'], False),
+    ('ix_user_created_at_id', 'user', ['created_at', 'id'], False),
+    ('ix_video_created_at_id', 'video', ['created_at', 'id'], False),
+    ('ix_video_user_id_created_at_id', 'video', ['user_id', 'created_at', 'id'], False),
+    ('ix_video_name_nocase', 'video', ['name COLLATE NOCASE'], False),
+    ('ix_comment_video_id_id', 'comment', ['video_id', 'id'], False),
+    ('ix_comment_user_id', 'comment', ['user_id'], False),
+    ('ix_token_code', 'token', ['code'], False),
+    ('ix_token_expired_at', 'token', ['expired_at'], False),
+    ('ix_token_user_id', 'token', ['user_id'], False),
+    ('ix_encode__job_video_id', 'encode__job', ['video_id'], False),
+    ('ix_encode__job_status', 'encode__job', ['status'], False),
+    ('ix_upload_user_id', 'upload', ['user_id'], False),
+    ('ix_upload_video_id', 'upload', ['video_id'], False),
+    ('ix_revoked__token_expired_at', 'revoked__token', ['expired_at'], False),
+    ('uq_video__format_video_id_code', 'video__format', ['video_id', 'code'], True),
+]
+
+def upgrade(connection):
+    # duplicated formats left by the old SELECT then INSERT: the last one wins, like its uri did
+    connection.execute(text(
+        'UPDATE encode__job SET format_id = ('
+            'SELECT MAX(last.id) FROM video__format AS duplicate '
+            'JOIN video__format AS last ON last.video_id = duplicate.video_id AND last.code = duplicate.code '
+            'WHERE duplicate.id = encode__job.format_id'
+        ') WHERE format_id IS NOT NULL'))
+    connection.execute(text(
+        'DELETE FROM video__format WHERE id NOT IN (SELECT MAX(id) FROM video__format GROUP BY video_id, code)'))
+
+    for name, table, columns, unique in INDEXES:
+        create_index(connection, name, table, columns, unique)
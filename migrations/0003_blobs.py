@@ -0,0 +1,18 @@
+##
+## MIGRATION 0003: CONTENT ADDRESSED STORAGE OF THE UPLOADS
+## (blob table, video.blob_id and video__format.blob_id; the existing files are moved by python manage.py import-uploads)
+##
+
+from sqlalchemy import text
+
+# personal imports
+from utils.migrations import has_column, create_index
+import models
+
+def upgrade(connection):
+    models.Blob.__table__.create(connection, checkfirst=True) # with its indexes, unless 0001 just created it
+
+    for table in ('video', 'video__format'):
+        if not has_column(connection, table, 'blob_id'):
+            connection.execute(text('ALTER TABLE "%s" ADD COLUMN blob_id VARCHAR(64) REFERENCES blob (hash)' % table))
+        create_index(connection, 'ix_%s_blob_id' % table, table, ['blob_id'])
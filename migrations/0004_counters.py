@@ -0,0 +1,16 @@
+##
+## MIGRATION 0004: DENORMALIZED COUNTERS
+## (video.comment_count, video.format_count and user.video_count, computed once here then kept by the write paths)
+##
+
+from sqlalchemy import text
+
+# personal imports
+from utils.migrations import has_column
+from utils.counters import COUNTERS, fix
+
+def upgrade(connection):
+    for model, column, counted_model, key in COUNTERS:
+        if not has_column(connection, model.__tablename__, column):
+            connection.execute(text('ALTER TABLE "%s" ADD COLUMN %s INTEGER NOT NULL DEFAULT 0' % (model.__tablename__, column)))
+        connection.execute(fix(model, column, counted_model, key))
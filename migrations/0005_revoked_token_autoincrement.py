@@ -0,0 +1,23 @@
+##
+## MIGRATION 0005: REVOKED TOKEN IDS NEVER REUSED
+## (sqlite reuses the rowids of deleted rows without AUTOINCREMENT: a revocation made after a purge
+##  could get an id at or below the last one a worker synced, and never reach it. The table is rebuilt)
+##
+
+from sqlalchemy import text
+
+# personal imports
+import models
+
+def upgrade(connection):
+    if connection.dialect.name != 'sqlite':
+        return # sequences of the other databases don't go back
+    sql = connection.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'revoked__token'")).scalar()
+    if sql is None or 'AUTOINCREMENT' in sql.upper():
+        return
+
+    connection.execute(text('ALTER TABLE revoked__token RENAME TO revoked__token_old'))
+    connection.execute(text('DROP INDEX IF EXISTS ix_revoked__token_expired_at'))
+    models.Revoked_Token.__table__.create(connection) # with its indexes
+    connection.execute(text('INSERT INTO revoked__token (id, code, expired_at) SELECT id, code, expired_at FROM revoked__token_old'))
+    connection.execute(text('DROP TABLE revoked__token_old'))
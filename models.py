@@ -4,6 +4,7 @@
 ##
 
 from app import db, ma
+from utils.metrics import timed
 from datetime import datetime
 
 ################
@@ -14,12 +15,20 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(100), unique=True, nullable=False)
     email = db.Column(db.String(100), unique=True, nullable=False)
-    pseudo = db.Column(db.String(100), nullable=True)
+    pseudo = db.Column(db.String(100), nullable=True, index=True)
     password = db.Column(db.String(255), nullable=False)
-    videos = db.relationship('Video', backref='user', lazy='dynamic')
-    comments = db.relationship('Comment', backref='user', lazy='dynamic')
+    video_count = db.Column(db.Integer, nullable=False, default=0, server_default='0') # see utils/counters.py
+    # a deleted user takes its rows along (the routes delete them set based, see utils/sweeper.py)
+    videos = db.relationship('Video', backref='user', lazy='dynamic', cascade='all, delete-orphan')
+    comments = db.relationship('Comment', backref='user', lazy='dynamic', cascade='all, delete-orphan')
+    tokens = db.relationship('Token', lazy='dynamic', cascade='all, delete-orphan')
+    uploads = db.relationship('Upload', lazy='dynamic', cascade='all, delete-orphan')
     created_at = db.Column(db.DateTime, default=datetime.utcnow())
 
+    __table_args__ = (
+        db.Index('ix_user_created_at_id', 'created_at', 'id'), # /users order
+    )
+
 class Video(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     source = db.Column(db.String(100), nullable=False)
@@ -27,51 +36,128 @@ class Video(db.Model):
     view = db.Column(db.Integer, default=0)
     enabled = db.Column(db.Boolean, default=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    formats = db.relationship('Video_Format', backref='video', lazy='dynamic')
-    comments = db.relationship('Comment', backref='video', lazy='dynamic')
+    blob_id = db.Column(db.String(64), db.ForeignKey('blob.hash'), nullable=True, index=True) # file of source, None for the files stored before the blobs
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0') # see utils/counters.py
+    format_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    formats = db.relationship('Video_Format', backref='video', lazy='dynamic', cascade='all, delete-orphan')
+    comments = db.relationship('Comment', backref='video', lazy='dynamic', cascade='all, delete-orphan')
+    jobs = db.relationship('Encode_Job', lazy='dynamic', cascade='all, delete-orphan')
+    uploads = db.relationship('Upload', lazy='dynamic', cascade='all, delete-orphan')
     created_at = db.Column(db.DateTime, default=datetime.utcnow())
 
+    __table_args__ = (
+        db.Index('ix_video_created_at_id', 'created_at', 'id'), # /videos order
+        db.Index('ix_video_user_id_created_at_id', 'user_id', 'created_at', 'id'), # /user/<id>/videos
+        db.Index('ix_video_name_nocase', db.text('name COLLATE NOCASE')), # LIKE 'name%' without the search index
+    )
+
 class Video_Format(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     code = db.Column(db.String(100), nullable=False)
     uri = db.Column(db.String(100), nullable=False)
     video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False)
+    blob_id = db.Column(db.String(64), db.ForeignKey('blob.hash'), nullable=True, index=True) # file of uri
+
+    __table_args__ = (
+        db.Index('uq_video__format_video_id_code', 'video_id', 'code', unique=True), # one format per code, for the upserts
+    )
+
+# one stored file per content (see utils/storage.py), shared by the videos and formats with the same bytes
+class Blob(db.Model):
+    hash = db.Column(db.String(64), primary_key=True) # sha256 of the content
+    path = db.Column(db.String(255), nullable=False) # in UPLOAD_FOLDER
+    size = db.Column(db.Integer, nullable=False)
+    refs = db.Column(db.Integer, nullable=False, default=0, index=True) # videos + formats pointing to it
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_comment_video_id_id', 'video_id', 'id'), # comments of a video, newest first
+    )
+
 class Token(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    code = db.Column(db.String(255), nullable=False)
-    expired_at = db.Column(db.DateTime, default=datetime.utcnow())
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    code = db.Column(db.String(255), nullable=False, index=True)
+    expired_at = db.Column(db.DateTime, default=datetime.utcnow(), index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+
+class Encode_Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    code = db.Column(db.String(100), nullable=False) # format to encode
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True) # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False, index=True)
+    format_id = db.Column(db.Integer, db.ForeignKey('video__format.id'), nullable=True) # result
+    created_at = db.Column(db.DateTime, default=datetime.utcnow())
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow())
+
+class Upload(db.Model):
+    id = db.Column(db.String(32), primary_key=True) # uuid4 hex
+    filename = db.Column(db.String(100), nullable=False)
+    name = db.Column(db.String(100), nullable=True)
+    code = db.Column(db.String(100), nullable=True) # format, for an upload of a Video_Format
+    size = db.Column(db.Integer, nullable=True) # total size announced by the client
+    offset = db.Column(db.Integer, nullable=False, default=0) # bytes received
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=True, index=True) # for an upload of a Video_Format
+    created_at = db.Column(db.DateTime, default=datetime.utcnow())
+
+class Revoked_Token(db.Model):
+    # ids are never reused after the purge of the expired rows: the workers sync on id > the last one they saw
+    __table_args__ = {'sqlite_autoincrement': True}
+    id = db.Column(db.Integer, primary_key=True)
+    code = db.Column(db.String(255), unique=True, nullable=False)
+    expired_at = db.Column(db.DateTime, nullable=False, index=True)
+
+# the indexes above are also created by the migrations (see migrations/), keep both in sync
 
 #################
 #### SCHEMAS ####
 #################
 
-class TokenSchema(ma.ModelSchema):
+# every dump is timed for the request metrics (nested schemas count once)
+class ModelSchema(ma.ModelSchema):
+    def dump(self, *args, **kwargs):
+        with timed('serialize'):
+            return ma.ModelSchema.dump(self, *args, **kwargs)
+
+class TokenSchema(ModelSchema):
     class Meta:
         model = Token
 
-class CommentSchema(ma.ModelSchema):
+class EncodeJobSchema(ModelSchema):
+    class Meta:
+        model = Encode_Job
+        include_fk = True
+
+class UploadSchema(ModelSchema):
+    class Meta:
+        model = Upload
+        include_fk = True
+
+class CommentSchema(ModelSchema):
     class Meta:
         model = Comment
 
-class VideoFormatSchema(ma.ModelSchema):
+class VideoFormatSchema(ModelSchema):
     class Meta:
         model = Video_Format
 
-class VideoSchema(ma.ModelSchema):
+class VideoSchema(ModelSchema):
     formats = ma.Nested(VideoFormatSchema, many=True)
     comments = ma.Nested(CommentSchema, many=True)
     class Meta:
         model = Video
+        exclude = ('jobs', 'uploads')
 
-class UserSchema(ma.ModelSchema):
+class UserSchema(ModelSchema):
     videos = ma.Nested(VideoSchema, many=True)
     class Meta:
-        model = User
\ No newline at end of file
+        model = User
+        exclude = ('tokens', 'uploads')
\ No newline at end of file
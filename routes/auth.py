@@ -1,4 +1,4 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, current_app
 from sqlalchemy import exc
 from functools import wraps
 from datetime import datetime, timedelta
@@ -6,9 +6,66 @@ from datetime import datetime, timedelta
 import jwt
 import re
 
+from sqlalchemy.orm import make_transient_to_detached
+
 # personal imports
 from models import User, UserSchema, Token
-from app import app, db, flask_bcrypt
+from app import db
+from utils.cache import TTLCache
+from utils.tokens import revoked, revoke
+from utils.hashing import check_password, hash_password, needs_rehash, overloaded, Overloaded
+from utils.ratelimit import limit_user
+from utils.response_cache import get_cache
+
+# verified tokens (token -> user id) and their users (user id -> (columns, version))
+# per process, entries live at most AUTH_CACHE_TTL seconds (and never past the token exp).
+# A user entry is only used while the version of its user:<id> tag in the file shared by the workers
+# (the one of the response cache) is the one it was loaded with: forget_user() bumps it for every worker
+tokens_cache = TTLCache(10000, 60)
+users_cache = TTLCache(10000, 60)
+
+# sizes the caches from the config, called by create_app
+def init_app(app):
+    for cache in (tokens_cache, users_cache):
+        cache.maxsize = app.config.get('AUTH_CACHE_SIZE', 10000)
+        cache.ttl = app.config.get('AUTH_CACHE_TTL', 60)
+        cache.clear()
+
+# returns the user of a token, None if the user doesn't exist anymore
+# raises if the token is invalid or expired
+def load_user(token):
+    if token in revoked:
+        raise jwt.InvalidTokenError('revoked token')
+
+    userId = tokens_cache.get(token)
+    if userId is None:
+        decoded = jwt.decode(token, current_app.config['SECRET_KEY'])
+        userId = decoded['id']
+        ttl = None
+        if 'exp' in decoded:
+            ttl = decoded['exp'] - (datetime.utcnow() - datetime(1970, 1, 1)).total_seconds()
+        tokens_cache.set(token, userId, ttl)
+
+    version = user_version(userId) # read before the row: a write committed in between bumps it again
+    cached = users_cache.get(userId)
+    if cached is None or cached[1] != version:
+        user = User.query.filter_by(id = userId).first()
+        if user is not None:
+            users_cache.set(userId, (dict((column.key, getattr(user, column.key)) for column in User.__table__.columns), version))
+        return user
+
+    # rebuild the row from the cache and attach it to the session without a query
+    user = User(**cached[0])
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+def user_version(userId):
+    return get_cache().versions.get('user:%d' % userId)
+
+# to call when a user is modified or deleted, in every worker
+def forget_user(userId):
+    users_cache.delete(userId)
+    get_cache().versions.bump('user:%d' % userId)
 
 # token decorators
 # 1st blocks workflow and return error if no token of wrong token
@@ -23,15 +80,24 @@ def token_required(f):
             }), 401
 
         try: 
-            decoded = jwt.decode(token, app.config['SECRET_KEY'])
-            current_user = User.query.filter_by(id = decoded['id']).first()
+            current_user = load_user(token)
         except:
             return jsonify({
                 'message': 'Unauthorized',
             }), 401
 
+        if current_user is None: # token of a deleted user
+            return jsonify({
+                'message': 'Unauthorized',
+            }), 401
+
+        limited = limit_user(current_user) # 'user' rate limits, see utils/ratelimit.py
+        if limited is not None:
+            return limited
+
         return f(current_user, *args, **kwargs)
 
+    decorated.checks_token = True
     return decorated
 
 # 2nd return no error on missing token 
@@ -45,15 +111,24 @@ def token_optional(f):
             return f(current_user, *args, **kwargs)
 
         try: 
-            data = jwt.decode(token, app.config['SECRET_KEY'])
-            current_user = User.query.filter_by(id = data['id']).first()
+            current_user = load_user(token)
         except:
             return jsonify({
                 'message': 'Unauthorized',
             }), 401
 
+        if current_user is None: # token of a deleted user
+            return jsonify({
+                'message': 'Unauthorized',
+            }), 401
+
+        limited = limit_user(current_user) # 'user' rate limits, see utils/ratelimit.py
+        if limited is not None:
+            return limited
+
         return f(current_user, *args, **kwargs)
 
+    decorated.checks_token = True
     return decorated
 
 #######################################
@@ -90,9 +165,22 @@ def auth():
             'message': 'Not found',
         }), 404
 
-    if flask_bcrypt.check_password_hash(user.password, password):
+    try:
+        valid = check_password(user.password, password)
+    except Overloaded:
+        return overloaded()
+
+    rehashed = False
+    if valid and needs_rehash(user.password):
+        try:
+            user.password = hash_password(password) # BCRYPT_LOG_ROUNDS changed, saved with the token
+            rehashed = True
+        except Overloaded:
+            pass # the password is right, rehashed on a later login
+
+    if valid:
         expired_date = datetime.utcnow() + timedelta(minutes=60)
-        token = jwt.encode({'id': user.id, 'exp': expired_date}, app.config['SECRET_KEY']).decode('utf-8')
+        token = jwt.encode({'id': user.id, 'exp': expired_date}, current_app.config['SECRET_KEY']).decode('utf-8')
 
         try:
             newToken = Token(
@@ -102,6 +190,8 @@ def auth():
             )
             db.session.add(newToken)
             db.session.commit()
+            if rehashed:
+                forget_user(user.id) # after the write, see load_user
         except exc.IntegrityError as err:
             db.session.rollback()
             return jsonify({
@@ -124,4 +214,25 @@ def auth():
             'message': 'Bad request',
             'code': 10010, # password doesn't match
             'data': ''
-        }), 400
\ No newline at end of file
+        }), 400
+
+# logout: revokes the token of the request
+@auth_api.route('/auth', methods=['DELETE'])
+@token_required
+def logout(current_user):
+    token = request.headers.get('x-token')
+
+    try:
+        decoded = jwt.decode(token, current_app.config['SECRET_KEY'])
+        revoke(token, datetime.utcfromtimestamp(decoded['exp']))
+        tokens_cache.delete(token)
+    except exc.IntegrityError as err:
+        db.session.rollback() # already revoked
+    except Exception as err:
+        db.session.rollback()
+        return jsonify({
+            'message': 'Internal server error',
+            'data': err.args
+        }), 500
+
+    return jsonify({}), 204
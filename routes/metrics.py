@@ -0,0 +1,20 @@
+from flask import Blueprint, Response, jsonify, request, current_app
+
+# personal imports
+from utils.metrics import collect, merge, render
+
+#######################################
+### STARTING TO DEFINE ROUTES HERE ####
+#######################################
+metrics_api = Blueprint('metrics_api', __name__)
+
+# prometheus scrape, summed over the workers
+@metrics_api.route('/metrics', methods=['GET'])
+def getMetrics():
+    token = current_app.config.get('METRICS_TOKEN')
+    if token is not None and request.headers.get('Authorization') != 'Bearer ' + token:
+        return jsonify({
+            'message': 'Unauthorized',
+        }), 401
+
+    return Response(render(merge(collect())), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,322 @@
+from flask import Blueprint, jsonify, request, current_app
+from werkzeug import secure_filename
+from sqlalchemy import exc
+from datetime import datetime
+import magic
+import uuid
+import os
+import re
+
+# personal imports
+from models import User, Video, VideoSchema, VideoFormatSchema, Upload, UploadSchema
+from app import db
+from routes.auth import token_required, forget_user
+from utils.response_cache import invalidate
+from utils.serializers import serializer
+from utils.storage import hash_file, place, extension, add_blob, recount, save_format
+from utils.metrics import timed, add_upload_bytes
+from utils.counters import add as add_count
+
+# resumable uploads:
+# 1. POST /upload                      -> {id, offset: 0}  (filename, [size], [name] or [video_id, format])
+# 2. PUT /upload/<id> + Upload-Offset  -> raw bytes of the chunk, written at that offset
+# 3. HEAD or GET /upload/<id>          -> current offset, to resume after a dropped connection
+# 4. POST /upload/<id>/finalize        -> creates the Video (or the Video_Format)
+
+def partial_path(upload):
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'partial', upload.id)
+
+def find_upload(current_user, uploadId):
+    upload = Upload.query.filter_by(id=uploadId).first()
+    if not upload:
+        return None, (jsonify({
+            'message': 'Upload not found',
+        }), 404)
+
+    if current_user is None or current_user.id != upload.user_id:
+        return None, (jsonify({
+            'message': 'Forbidden',
+        }), 403)
+
+    return upload, None
+
+def offset_headers(upload):
+    headers = {'Upload-Offset': str(upload.offset)}
+    if upload.size is not None:
+        headers['Upload-Length'] = str(upload.size)
+    return headers
+
+def finalize_conflict(upload):
+    return jsonify({
+        'message': 'Conflict',
+        'code': 10024, # upload already finalized
+        'data': ''
+    }), 409, offset_headers(upload)
+
+#######################################
+### STARTING TO DEFINE ROUTES HERE ####
+#######################################
+uploads_api = Blueprint('uploads_api', __name__)
+
+# initiate an upload
+@uploads_api.route('/upload', methods=['POST'])
+@token_required
+def createUpload(current_user):
+    if not current_user:
+        return jsonify({
+            'message': 'Forbidden',
+        }), 403
+
+    data = request.get_json() or request.form
+    filename = data.get('filename')
+    name = data.get('name')
+    size = data.get('size')
+    videoId = data.get('video_id')
+    format = data.get('format')
+
+    format_pattern = re.compile(r'[0-9]+')
+    if (
+        filename is None or type(filename) is not str or secure_filename(filename) == '' or
+        name is not None and type(name) is not str or
+        size is not None and (str(size).isdigit() is False or int(size) > current_app.config['UPLOAD_MAX_SIZE']) or
+        (videoId is None) != (format is None) or
+        format is not None and (type(format) is not str or format_pattern.fullmatch(format) is None) or
+        videoId is not None and str(videoId).isdigit() is False
+        ):
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10001, # invalid form
+            'data': ''
+        }), 400
+
+    if videoId is not None and Video.query.filter_by(id=int(videoId)).first() is None:
+        return jsonify({
+            'message': 'Video not found',
+        }), 404
+
+    try:
+        newUpload = Upload(
+            id = uuid.uuid4().hex,
+            filename = secure_filename(filename),
+            name = name,
+            code = format,
+            size = int(size) if size is not None else None,
+            offset = 0,
+            user_id = current_user.id,
+            video_id = int(videoId) if videoId is not None else None,
+            created_at = datetime.utcnow()
+        )
+        db.session.add(newUpload)
+        db.session.commit()
+
+        os.makedirs(os.path.dirname(partial_path(newUpload)), exist_ok=True)
+        open(partial_path(newUpload), 'wb').close()
+    except exc.IntegrityError as err:
+        db.session.rollback()
+        return jsonify({
+            'message': 'Bad request',
+            'data': err.args
+        }), 400
+    except Exception as err:
+        db.session.rollback()
+        return jsonify({
+            'message': 'Internal server error',
+            'data': err.args
+        }), 500
+
+    schema = serializer(UploadSchema, only=('id', 'filename', 'name', 'code', 'size', 'offset', 'video_id', 'created_at'))
+    output = schema(newUpload)
+
+    return jsonify({
+        'message': 'OK',
+        'data': output
+    }), 201, offset_headers(newUpload)
+
+# current offset of an upload
+@uploads_api.route('/upload/<uploadId>', methods=['GET', 'HEAD'])
+@token_required
+def getUpload(current_user, uploadId):
+    upload, error = find_upload(current_user, uploadId)
+    if error:
+        return error
+
+    schema = serializer(UploadSchema, only=('id', 'filename', 'name', 'code', 'size', 'offset', 'video_id', 'created_at'))
+    output = schema(upload)
+
+    return jsonify({
+        'message': 'OK',
+        'data': output
+    }), 200, offset_headers(upload)
+
+# append a chunk
+@uploads_api.route('/upload/<uploadId>', methods=['PUT', 'PATCH'])
+@token_required
+def putUploadChunk(current_user, uploadId):
+    upload, error = find_upload(current_user, uploadId)
+    if error:
+        return error
+
+    offset = request.headers.get('Upload-Offset', None, type=int)
+    length = request.content_length
+
+    if offset is None or length is None:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10001, # missing Upload-Offset / Content-Length
+            'data': ''
+        }), 400
+
+    if offset != upload.offset:
+        return jsonify({
+            'message': 'Conflict',
+            'code': 10022, # not the current offset, see Upload-Offset
+            'data': ''
+        }), 409, offset_headers(upload)
+
+    if (length > current_app.config['UPLOAD_CHUNK_MAX_SIZE'] or
+        offset + length > (upload.size if upload.size is not None else current_app.config['UPLOAD_MAX_SIZE'])):
+        return jsonify({
+            'message': 'Request entity too large',
+        }), 413, offset_headers(upload)
+
+    buffer_size = current_app.config['UPLOAD_BUFFER_SIZE']
+    stream = request.stream
+    written = 0
+
+    with open(partial_path(upload), 'r+b') as file:
+        file.seek(offset)
+
+        ### file mimetype check on the first bytes of the file
+        if offset == 0:
+            head = stream.read(min(1024, length))
+            if not re.match(r'^video\/', magic.from_buffer(head, mime=True)):
+                return jsonify({
+                    'message': 'Bad request',
+                    'code': 10021, # wrong file type
+                    'data': ''
+                }), 400
+            with timed('disk_write'):
+                file.write(head)
+            written += len(head)
+
+        # stream to disk, never more than buffer_size bytes in memory
+        while written < length:
+            chunk = stream.read(min(buffer_size, length - written))
+            if not chunk:
+                break # client went away, the offset tells where to resume
+            with timed('disk_write'):
+                file.write(chunk)
+            written += len(chunk)
+
+        file.truncate(offset + written)
+    add_upload_bytes(written)
+
+    # only one of two concurrent PUT at the same offset can move it
+    moved = Upload.query.filter_by(id=upload.id, offset=offset).update({'offset': offset + written}, synchronize_session=False)
+    db.session.commit()
+    db.session.refresh(upload)
+
+    if not moved:
+        return jsonify({
+            'message': 'Conflict',
+            'code': 10022,
+            'data': ''
+        }), 409, offset_headers(upload)
+
+    return jsonify({}), 204, offset_headers(upload)
+
+# finalize an upload: creates the Video or the Video_Format
+@uploads_api.route('/upload/<uploadId>/finalize', methods=['POST'])
+@token_required
+def finalizeUpload(current_user, uploadId):
+    upload, error = find_upload(current_user, uploadId)
+    if error:
+        return error
+
+    if upload.offset == 0 or upload.size is not None and upload.offset != upload.size:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10023, # upload not complete
+            'data': ''
+        }), 400, offset_headers(upload)
+
+    # linked to its blob before the rows, the partial file removed only once they are committed:
+    # a failure before (disk, commit) leaves the upload as it was for a retry
+    path, suffix, code, videoId = partial_path(upload), extension(upload.filename), upload.code, upload.video_id
+    try:
+        hash, size = hash_file(path)
+        stored = place(path, hash, size, suffix, keep=True)
+    except FileNotFoundError:
+        return finalize_conflict(upload) # finalized by a concurrent request
+    except OSError as err:
+        current_app.logger.error('finalize upload %s: %s', upload.id, err)
+        return jsonify({
+            'message': 'Internal server error',
+            'data': err.args
+        }), 500
+
+    ## save to db
+    try:
+        if code is None:
+            add_blob(db.session, stored)
+            output = Video(
+                name = upload.name or upload.filename,
+                source = stored.uri,
+                blob_id = stored.hash,
+                user_id = current_user.id,
+                created_at = datetime.utcnow()
+            )
+            db.session.add(output)
+            recount(db.session, [stored.hash])
+            add_count(db.session, User, 'video_count', {current_user.id: 1})
+            schema = serializer(VideoSchema)
+        else:
+            output = save_format(db.session, videoId, code, stored)
+            schema = serializer(VideoFormatSchema)
+        # only one of two concurrent finalize can delete it
+        if not Upload.query.filter_by(id=upload.id).delete(synchronize_session=False):
+            db.session.rollback()
+            return finalize_conflict(upload)
+        db.session.commit()
+        if code is None:
+            forget_user(current_user.id)
+            invalidate('videos', 'user:%d:videos' % current_user.id, 'user:%d' % current_user.id)
+        else:
+            invalidate('video:%d' % videoId)
+    except exc.IntegrityError as err:
+        db.session.rollback()
+        return jsonify({
+            'message': 'Bad request',
+            'data': err.args
+        }), 400
+    except Exception as err:
+        db.session.rollback()
+        return jsonify({
+            'message': 'Internal server error',
+            'data': err.args
+        }), 500
+
+    try:
+        os.remove(path)
+    except OSError as err:
+        current_app.logger.warning('finalize upload %s: %s', uploadId, err) # no row anymore, the sweeper removes it
+
+    return jsonify({
+        'message': 'OK',
+        'data': schema(output)
+    }), 201
+
+# abort an upload
+@uploads_api.route('/upload/<uploadId>', methods=['DELETE'])
+@token_required
+def deleteUpload(current_user, uploadId):
+    upload, error = find_upload(current_user, uploadId)
+    if error:
+        return error
+
+    if os.path.exists(partial_path(upload)):
+        os.remove(partial_path(upload))
+    db.session.delete(upload)
+    db.session.commit()
+
+    return jsonify({}), 204
@@ -5,8 +5,15 @@ import re
 
 # personal imports
 from models import User, UserSchema, Video, VideoSchema
-from app import db, flask_bcrypt
-from routes.auth import token_optional, token_required
+from app import db
+from routes.auth import token_optional, token_required, forget_user
+from utils.pager import pager_args, paginate
+from utils.loaders import expand_args, dump_videos, batch_ids
+from utils.hashing import hash_password, overloaded, Overloaded
+from utils.search import search, enabled as search_enabled
+from utils.response_cache import cached, invalidate, add_tags
+from utils.serializers import serializer
+from utils.sweeper import delete_user
 
 #######################################
 ### STARTING TO DEFINE ROUTES HERE ####
@@ -15,40 +22,88 @@ users_api = Blueprint('users_api', __name__)
 
 # get all users
 @users_api.route('/users', methods=['GET'])
+@cached(lambda: ['users'])
 def getUsers():
     query_params = request.args
     pseudo = query_params.get('pseudo', None, type=str)
-    page = query_params.get('page', 1, type=int)
-    perPage = query_params.get('perPage', 20, type=int)
+    pager_params = pager_args(query_params) # page & perPage, or after & limit for cursor mode
 
-    if pseudo:
-        paginate = User.query.filter_by(pseudo = pseudo).paginate(page = page, per_page = perPage, error_out = False) # if error_out = False, page and perPage defauls to 1 & 20 respectivly
+    found = search(User, 'user_fts', pseudo) if pseudo and search_enabled('user_fts') else None
+
+    if found:
+        query, order_by = found # ranked full-text search, rows are (user, score, id)
+    elif pseudo:
+        query, order_by = User.query.filter_by(pseudo = pseudo), (User.created_at, User.id)
     else:
-        paginate = User.query.paginate(page = page, per_page = perPage, error_out = False) # if error_out = False, page and perPage defauls to 1 & 20 respectivly
-    
-    users = paginate.items
-    total = paginate.pages # total of pages for parameter perPage
+        query, order_by = User.query, (User.created_at, User.id)
+
+    try:
+        users, pager = paginate(query, pager_params, order_by, ('users', pseudo))
+    except ValueError:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10002, # invalid cursor
+            'data': ''
+        }), 400
+
+    if found:
+        users = [row[0] for row in users]
+    if pseudo:
+        add_tags('users:search')
+    add_tags(*['user:%d' % user.id for user in users])
 
     if not users:
         users = [] # possible options here: return empty array, or return 404 not found ? not sure
 
-    schema = UserSchema(only=('id', 'username', 'pseudo', 'created_at'), many=True)
-    output = schema.dump(users).data
+    schema = serializer(UserSchema, only=('id', 'username', 'pseudo', 'created_at', 'video_count'), many=True)
+    output = schema(users)
 
     return jsonify({
         'message': 'OK',
         'data': output,
-        'pager': {
-            'current': page,
-            'total': total
-        }
+        'pager': pager
+    })
+
+# get many users by id: /users/batch?ids=1,2,3 (at most BATCH_MAX_ITEMS), 1 query
+# one result per id, in request order, with its own status (public fields, as /user/<id> for other users)
+@users_api.route('/users/batch', methods=['GET'])
+@cached(lambda: ['users'])
+def getUsersBatch():
+    try:
+        userIds = batch_ids(request.args)
+    except ValueError:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10003, # invalid ids or too many of them
+            'data': ''
+        }), 400
+
+    users = User.query.filter(User.id.in_(userIds)).all() if userIds else []
+    add_tags(*['user:%d' % user.id for user in users])
+
+    schema = serializer(UserSchema, only=('id', 'username', 'pseudo', 'created_at', 'video_count'), many=True)
+    found = dict(zip([user.id for user in users], schema(users)))
+
+    output = []
+    for userId in userIds:
+        if userId in found:
+            output.append({'id': userId, 'status': 200, 'data': found[userId]})
+        else:
+            output.append({'id': userId, 'status': 404, 'message': 'Not found'})
+
+    return jsonify({
+        'message': 'OK',
+        'data': output
     })
 
 # get one user
 @users_api.route('/user/<int:userId>', methods=['GET'])
 @token_optional
 def getUser(current_user, userId):
-    user = User.query.filter_by(id=userId).first()
+    if current_user is not None and current_user.id == userId:
+        user = current_user # already loaded by token_optional / token_required
+    else:
+        user = User.query.filter_by(id=userId).first()
 
     if not user:
         return jsonify({
@@ -56,11 +111,13 @@ def getUser(current_user, userId):
         }), 404
 
     if current_user is not None and current_user.id == user.id:
-        schema = UserSchema(only=('id', 'username', 'pseudo', 'email', 'created_at', 'password', 'videos'))
+        schema = serializer(UserSchema, only=('id', 'username', 'pseudo', 'email', 'created_at', 'video_count', 'password'))
+        output = schema(user)
+        output['videos'] = dump_videos(user.videos.all(), expand_args(request.args)) # same as nested 'videos', without a query per video
     else :
-        schema = UserSchema(only=('id', 'username', 'pseudo', 'created_at'))
+        schema = serializer(UserSchema, only=('id', 'username', 'pseudo', 'created_at', 'video_count'))
+        output = schema(user)
 
-    output = schema.dump(user).data
     # video_schema = VideoSchema(many=True)
     # videos = Video.query.filter_by(user_id=userId).all()
     # output['videos'] = video_schema.dump(videos).data
@@ -94,16 +151,22 @@ def createUser():
             'data': ''
         }), 400
 
+    try:
+        password_hash = hash_password(password)
+    except Overloaded:
+        return overloaded()
+
     try:
         newUser = User(
             username = username,
             pseudo = pseudo or username,
             email = email,
-            password = flask_bcrypt.generate_password_hash(password, rounds=10).decode('utf-8'),
+            password = password_hash,
             created_at = datetime.utcnow()
         )
         db.session.add(newUser)
         db.session.commit()
+        invalidate('users')
     except exc.IntegrityError as err:
         db.session.rollback()
         return jsonify({
@@ -117,8 +180,8 @@ def createUser():
             'data': err.args
         }), 500
 
-    schema = UserSchema(only=('id', 'username', 'pseudo', 'email', 'created_at'))
-    output = schema.dump(newUser).data
+    schema = serializer(UserSchema, only=('id', 'username', 'pseudo', 'email', 'created_at', 'video_count'))
+    output = schema(newUser)
 
     return jsonify({
         'message': 'OK',
@@ -129,7 +192,10 @@ def createUser():
 @users_api.route('/user/<int:userId>', methods=['DELETE'])
 @token_required
 def deleteUser(current_user, userId):
-    user = User.query.filter_by(id=userId).first()
+    if current_user is not None and current_user.id == userId:
+        user = current_user # already loaded by token_optional / token_required
+    else:
+        user = User.query.filter_by(id=userId).first()
 
     if not user:
         return jsonify({
@@ -141,8 +207,11 @@ def deleteUser(current_user, userId):
             'message': 'Forbidden',
         }), 403
 
-    db.session.delete(user)
+    commented = delete_user(db.session, user.id) # and its videos, comments, tokens and uploads; files are left to the sweeper
     db.session.commit()
+    forget_user(userId)
+    invalidate('users', 'user:%d' % userId, 'user:%d:videos' % userId, 'videos',
+        *[tag for videoId in commented for tag in ('video:%d' % videoId, 'video:%d:comments' % videoId)])
 
     return jsonify({}), 204
 
@@ -150,7 +219,10 @@ def deleteUser(current_user, userId):
 @users_api.route('/user/<int:userId>', methods=['PUT'])
 @token_required
 def modifyUser(current_user, userId):
-    user = User.query.filter_by(id=userId).first()
+    if current_user is not None and current_user.id == userId:
+        user = current_user # already loaded by token_optional / token_required
+    else:
+        user = User.query.filter_by(id=userId).first()
 
     if not user:
         return jsonify({
@@ -183,12 +255,19 @@ def modifyUser(current_user, userId):
             'data': ''
         }), 400
 
+    try:
+        password_hash = hash_password(password)
+    except Overloaded:
+        return overloaded()
+
     try:
         user.username = username #unique
         user.pseudo = pseudo or None
         user.email = email #unique
-        user.password = flask_bcrypt.generate_password_hash(password, rounds=10).decode('utf-8')
+        user.password = password_hash
         db.session.commit()
+        forget_user(userId)
+        invalidate('user:%d' % userId, 'users:search')
     except exc.IntegrityError as err:
         db.session.rollback()
         return jsonify({
@@ -202,8 +281,8 @@ def modifyUser(current_user, userId):
             'data': err.args
         }), 500
 
-    schema = UserSchema(only=('id', 'username', 'pseudo', 'email', 'created_at'))
-    output = schema.dump(user).data
+    schema = serializer(UserSchema, only=('id', 'username', 'pseudo', 'email', 'created_at', 'video_count'))
+    output = schema(user)
 
     return jsonify({
         'message': 'OK',
@@ -1,14 +1,28 @@
-from flask import Blueprint, jsonify, request, send_from_directory
+from flask import Blueprint, jsonify, request, current_app, abort, Response
 from werkzeug import secure_filename
 from sqlalchemy import exc
 from datetime import datetime, timedelta
+from collections import Counter
 import magic
 import re
 
 # personal imports
-from models import User, UserSchema, Video, Video_Format, VideoSchema, VideoFormatSchema, Comment, CommentSchema
-from app import app, db
-from routes.auth import token_optional, token_required
+from models import User, UserSchema, Video, Video_Format, VideoSchema, VideoFormatSchema, Comment, CommentSchema, Encode_Job, EncodeJobSchema
+from app import db
+from routes.auth import token_optional, token_required, forget_user
+from utils.pager import pager_args, paginate, encode_cursor
+from utils.loaders import expand_args, dump_videos, dump_comments, load_comments, batch_ids, check_batch_size
+from utils.media import send_media
+from utils.encoding import jobs, QueueFull
+from utils.views import views
+from utils.search import search, enabled as search_enabled
+from utils.response_cache import cached, invalidate, add_tags
+from utils.serializers import serializer
+from utils.metrics import add_upload_bytes
+from utils.storage import store_stream, extension, add_blob, recount, save_format, is_public
+from utils.sweeper import delete_videos
+from utils.feed import hub, stream, event_text, Full
+from utils.counters import add as add_count
 
 #######################################
 ### STARTING TO DEFINE ROUTES HERE ####
@@ -17,60 +31,106 @@ videos_api = Blueprint('videos_api', __name__)
 
 # get all videos
 @videos_api.route('/videos', methods=['GET'])
+@cached(lambda: ['videos'])
 def getVideos():
     query_params = request.args
     name = query_params.get('name', None, type=str)
-    page = query_params.get('page', 1, type=int)
-    perPage = query_params.get('perPage', 20, type=int)
+    pager_params = pager_args(query_params) # page & perPage, or after & limit for cursor mode
 
-    if name:
-        paginate = Video.query.filter(Video.name.like(name + '%')).paginate(page = page, per_page = perPage, error_out = False) # if error_out = False, page and perPage defauls to 1 & 20 respectivly
+    found = search(Video, 'video_fts', name) if name and search_enabled('video_fts') else None
+
+    if found:
+        query, order_by = found # ranked full-text search, rows are (video, score, id)
+    elif name:
+        query, order_by = Video.query.filter(Video.name.like(name + '%')), (Video.created_at, Video.id)
     else:
-        paginate = Video.query.paginate(page = page, per_page = perPage, error_out = False) # if error_out = False, page and perPage defauls to 1 & 20 respectivly
-    
-    videos = paginate.items
-    total = paginate.pages # total of pages for parameter perPage
+        query, order_by = Video.query, (Video.created_at, Video.id)
+
+    try:
+        videos, pager = paginate(query, pager_params, order_by, ('videos', name))
+    except ValueError:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10002, # invalid cursor
+            'data': ''
+        }), 400
+
+    if found:
+        videos = [row[0] for row in videos]
+    if name:
+        add_tags('videos:search')
 
     if not videos:
         videos = [] # possible options here: return empty array, or return 404 not found ? not sure
 
-    schema = VideoSchema(many=True)
-    output = schema.dump(videos).data
+    output = dump_videos(videos, expand_args(query_params)) # formats & comments previews batch loaded, see ?expand=
+    add_tags(*['video:%d' % video.id for video in videos])
 
     return jsonify({
         'message': 'OK',
         'data': output,
-        'pager': {
-            'current': page,
-            'total': total
-        }
+        'pager': pager
+    })
+
+# get many videos by id: /videos/batch?ids=1,2,3 (at most BATCH_MAX_ITEMS), same ?expand= as the lists
+# one result per id, in request order, with its own status
+@videos_api.route('/videos/batch', methods=['GET'])
+@cached(lambda: ['videos'])
+def getVideosBatch():
+    try:
+        videoIds = batch_ids(request.args)
+    except ValueError:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10003, # invalid ids or too many of them
+            'data': ''
+        }), 400
+
+    videos = Video.query.filter(Video.id.in_(videoIds)).all() if videoIds else []
+    add_tags(*['video:%d' % video.id for video in videos])
+
+    found = dict(zip([video.id for video in videos], dump_videos(videos, expand_args(request.args))))
+
+    output = []
+    for videoId in videoIds:
+        if videoId in found:
+            output.append({'id': videoId, 'status': 200, 'data': found[videoId]})
+        else:
+            output.append({'id': videoId, 'status': 404, 'message': 'Video not found'})
+
+    return jsonify({
+        'message': 'OK',
+        'data': output
     })
 
 # get user's videos
 @videos_api.route('/user/<int:userId>/videos', methods=['GET'])
+@cached(lambda userId: ['user:%d:videos' % userId])
 def getUserVideos(userId):
     query_params = request.args
-    page = query_params.get('page', 1, type=int)
-    perPage = query_params.get('perPage', 20, type=int)
+    pager_params = pager_args(query_params) # page & perPage, or after & limit for cursor mode
 
-    paginate = Video.query.filter_by(user_id=userId).paginate(page = page, per_page = perPage, error_out = False) # if error_out = False, page and perPage defauls to 1 & 20 respectivly
-    
-    videos = paginate.items
-    total = paginate.pages # total of pages for parameter perPage
+    query = Video.query.filter_by(user_id=userId)
+
+    try:
+        videos, pager = paginate(query, pager_params, (Video.created_at, Video.id), ('user_videos', userId))
+    except ValueError:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10002, # invalid cursor
+            'data': ''
+        }), 400
 
     if not videos:
         videos = [] # possible options here: return empty array, or return 404 not found ? not sure
 
-    schema = VideoSchema(many=True)
-    output = schema.dump(videos).data
+    output = dump_videos(videos, expand_args(query_params)) # formats & comments previews batch loaded, see ?expand=
+    add_tags(*['video:%d' % video.id for video in videos])
 
     return jsonify({
         'message': 'OK',
         'data': output,
-        'pager': {
-            'current': page,
-            'total': total
-        }
+        'pager': pager
     })
 
 # create new video
@@ -81,17 +141,9 @@ def createVideo(current_user, userId):
     # and: https://werkzeug.palletsprojects.com/en/0.14.x/datastructures/#werkzeug.datastructures.FileStorage
     # and: https://developer.mozilla.org/en-US/docs/Web/HTTP/Basics_of_HTTP/MIME_types/Complete_list_of_MIME_types
     ### user verif
-    user = User.query.filter_by(id=userId).first()
-
-    if not user:
-        return jsonify({
-            'message': 'User not found',
-        }), 404
-    
-    if (current_user is None or current_user.id != user.id):
-        return jsonify({
-            'message': 'Forbidden',
-        }), 403
+    user, error = videoUploader(current_user, userId)
+    if error:
+        return error
 
     ### file form verif
     if ('source' not in request.files or
@@ -111,8 +163,8 @@ def createVideo(current_user, userId):
     file.stream.seek(0)
 
     if pattern.match(file_mimetype):
-        file_path = secure_filename(user.username + '_' + str(datetime.utcnow()) + '_' + file.filename)
-        file.save(app.config['UPLOAD_FOLDER'] + file_path)
+        stored = store_stream(file.stream, extension(file.filename)) # same content, same blob
+        add_upload_bytes(stored.size)
     else:
         return jsonify({
             'message': 'Bad request',
@@ -120,16 +172,45 @@ def createVideo(current_user, userId):
             'data': ''
         }), 400
 
-    ## save to db
+    return saveVideo(user, name or secure_filename(file.filename), stored)
+
+# who may add a video to /user/<userId>: (user, None) or (None, the error response)
+# (also checked by the async media server before it reads the body, see utils/aio.py)
+def videoUploader(current_user, userId):
+    if current_user is not None and current_user.id == userId:
+        user = current_user # already loaded by token_required
+    else:
+        user = User.query.filter_by(id=userId).first()
+
+    if not user:
+        return None, (jsonify({
+            'message': 'User not found',
+        }), 404)
+    
+    if (current_user is None or current_user.id != user.id):
+        return None, (jsonify({
+            'message': 'Forbidden',
+        }), 403)
+
+    return user, None
+
+# the video of a stored upload (store_stream / store_file): 201 and the video
+def saveVideo(user, name, stored):
     try:
+        add_blob(db.session, stored)
         newVideo = Video(
-            name = name or secure_filename(file.filename),
-            source = (app.config['UPLOAD_FOLDER'] + file_path),
+            name = name,
+            source = stored.uri,
+            blob_id = stored.hash,
             user_id = user.id,
             created_at = datetime.utcnow()
         )
         db.session.add(newVideo)
+        recount(db.session, [stored.hash])
+        add_count(db.session, User, 'video_count', {user.id: 1})
         db.session.commit()
+        forget_user(user.id)
+        invalidate('videos', 'user:%d:videos' % user.id, 'user:%d' % user.id)
     except exc.IntegrityError as err:
         db.session.rollback()
         return jsonify({
@@ -143,8 +224,8 @@ def createVideo(current_user, userId):
             'data': err.args
         }), 500
 
-    schema = VideoSchema()
-    output = schema.dump(newVideo).data
+    schema = serializer(VideoSchema)
+    output = schema(newVideo)
 
     return jsonify({
         'message': 'OK',
@@ -159,12 +240,13 @@ def encodeVideo(current_user, videoId):
         return jsonify({
             'message': 'Forbidden',
         }), 403
-    
-    user = User.query.filter_by(id=current_user.id).first()
-    if not user:
-        return jsonify({
-            'message': 'Forbidden',
-        }), 403
+
+    user = current_user # already loaded by token_required
+
+    ### server side encoding: {"formats": ["480", "720"]} and no file
+    json = request.get_json(silent=True)
+    if 'file' not in request.files and json is not None and 'formats' in json:
+        return enqueueEncoding(user, videoId, json.get('formats'))
 
     ### file form verif
     if ('file' not in request.files or
@@ -179,13 +261,9 @@ def encodeVideo(current_user, videoId):
     data = request.get_json() or request.form
     format = data.get('format')
 
-    format_pattern = re.compile(r'[0-9]*')
-    if (format is None or type(format) is not (str or number) or format_pattern.fullmatch(format) is None):
-        return jsonify({
-            'message': 'Bad request',
-            'code': 10021, # no or wrong format specified
-            'data': ''
-        }), 400
+    error = formatError(format)
+    if error:
+        return error
 
     ### file mimetype check and save to storage
     pattern = re.compile(r'^video\/')
@@ -193,8 +271,8 @@ def encodeVideo(current_user, videoId):
     file.stream.seek(0)
 
     if pattern.match(file_mimetype):
-        file_path = secure_filename(user.username + '_' + str(datetime.utcnow()) + '_' + format + '_' + file.filename)
-        file.save(app.config['UPLOAD_FOLDER'] + file_path)
+        stored = store_stream(file.stream, extension(file.filename))
+        add_upload_bytes(stored.size)
     else:
         return jsonify({
             'message': 'Bad request',
@@ -202,39 +280,138 @@ def encodeVideo(current_user, videoId):
             'data': ''
         }), 400
 
-    ## save to db
-    exists_format = Video_Format.query.filter_by(video_id=videoId, code=format).first()
-    if exists_format is not None:
-        exists_format.uri = app.config['UPLOAD_FOLDER'] + file_path
+    return saveFormat(videoId, format, stored)
+
+# 400 if the format code of PATCH /video/<id> is missing or not a number
+def formatError(format):
+    format_pattern = re.compile(r'[0-9]*')
+    if (format is None or type(format) is not (str or number) or format_pattern.fullmatch(format) is None):
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10021, # no or wrong format specified
+            'data': ''
+        }), 400
+    return None
+
+# the format of a stored upload, one row per (video, code): a new upload of the format replaces its uri (and its blob)
+def saveFormat(videoId, format, stored):
+    try:
+        videoFormat = save_format(db.session, videoId, format, stored)
         db.session.commit()
-    else:
+        invalidate('video:%d' % videoId)
+    except exc.IntegrityError as err:
+        db.session.rollback()
+        return jsonify({
+            'message': 'Bad request',
+            'data': err.args
+        }), 400
+    except Exception as err:
+        db.session.rollback()
+        return jsonify({
+            'message': 'Internal server error',
+            'data': err.args
+        }), 500
+
+    schema = serializer(VideoFormatSchema)
+    output = schema(videoFormat)
+
+    return jsonify({
+        'message': 'OK',
+        'data': output
+    }), 200
+
+# creates one Encode_Job per format, the Video_Format rows are created by the workers
+def enqueueEncoding(user, videoId, formats):
+    format_pattern = re.compile(r'[0-9]+')
+    if (type(formats) is not list or len(formats) == 0 or
+        any(type(format) is not str or format_pattern.fullmatch(format) is None for format in formats)):
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10021, # no or wrong format specified
+            'data': ''
+        }), 400
+
+    video = Video.query.filter_by(id=videoId).first()
+    if not video:
+        return jsonify({
+            'message': 'Video not found',
+        }), 404
+
+    formats = sorted(set(formats))
+    if jobs.free() < len(formats):
+        return jsonify({
+            'message': 'Service unavailable',
+        }), 503, {'Retry-After': str(current_app.config.get('ENCODE_RETRY_AFTER', 30))}
+
+    try:
+        newJobs = [Encode_Job(code = format, status = 'queued', video_id = video.id, created_at = datetime.utcnow(), updated_at = datetime.utcnow()) for format in formats]
+        db.session.add_all(newJobs)
+        db.session.commit()
+    except Exception as err:
+        db.session.rollback()
+        return jsonify({
+            'message': 'Internal server error',
+            'data': err.args
+        }), 500
+
+    for job in newJobs:
         try:
-            newFormat = Video_Format(
-                code = format,
-                uri = (app.config['UPLOAD_FOLDER'] + file_path),
-                video_id = videoId,
-            )
-            db.session.add(newFormat)
-            db.session.commit()
-        except exc.IntegrityError as err:
-            db.session.rollback()
-            return jsonify({
-                'message': 'Bad request',
-                'data': err.args
-            }), 400
-        except Exception as err:
-            db.session.rollback()
-            return jsonify({
-                'message': 'Internal server error',
-                'data': err.args
-            }), 500
-
-    schema = VideoFormatSchema()
-    if exists_format:
-        output = schema.dump(exists_format).data
-    else:
-        output = schema.dump(newFormat).data
+            jobs.submit(job.id)
+        except QueueFull:
+            job.status = 'failed'
+            job.error = 'queue full'
+    db.session.commit()
+
+    schema = serializer(EncodeJobSchema, many=True)
+    output = schema(newJobs)
 
+    return jsonify({
+        'message': 'OK',
+        'data': output
+    }), 202
+
+# get video's encoding jobs
+@videos_api.route('/video/<int:videoId>/jobs', methods=['GET'])
+@token_required
+def getVideoJobs(current_user, videoId):
+    query_params = request.args
+    pager_params = pager_args(query_params) # page & perPage, or after & limit for cursor mode
+    status = query_params.get('status', None, type=str)
+
+    query = Encode_Job.query.filter_by(video_id=videoId)
+    if status:
+        query = query.filter_by(status=status)
+
+    try:
+        encodeJobs, pager = paginate(query, pager_params, (Encode_Job.id,), ('video_jobs', videoId, status))
+    except ValueError:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10002, # invalid cursor
+            'data': ''
+        }), 400
+
+    schema = serializer(EncodeJobSchema, many=True)
+    output = schema(encodeJobs)
+
+    return jsonify({
+        'message': 'OK',
+        'data': output,
+        'pager': pager
+    })
+
+# get one encoding job
+@videos_api.route('/job/<int:jobId>', methods=['GET'])
+@token_required
+def getJob(current_user, jobId):
+    job = Encode_Job.query.filter_by(id=jobId).first()
+    if not job:
+        return jsonify({
+            'message': 'Job not found',
+        }), 404
+
+    schema = serializer(EncodeJobSchema)
+    output = schema(job)
 
     return jsonify({
         'message': 'OK',
@@ -249,12 +426,8 @@ def updateVideo(current_user, videoId):
         return jsonify({
             'message': 'Forbidden',
         }), 403
-    
-    user = User.query.filter_by(id=current_user.id).first()
-    if not user:
-        return jsonify({
-            'message': 'Forbidden',
-        }), 403
+
+    user = current_user # already loaded by token_required
 
     data = request.get_json() or request.form
     name = data.get('name')
@@ -274,9 +447,11 @@ def updateVideo(current_user, videoId):
 
     video.name = name
     db.session.commit()
+    invalidate('video:%d' % video.id, 'videos:search')
 
-    schema = VideoSchema()
-    output = schema.dump(video).data
+    schema = serializer(VideoSchema)
+    output = schema(video)
+    output['view'] = (output['view'] or 0) + views.pending(video.id) # not flushed yet
 
     return jsonify({
         'message': 'OK',
@@ -291,12 +466,8 @@ def deleteVideo(current_user, videoId):
         return jsonify({
             'message': 'Forbidden',
         }), 403
-    
-    user = User.query.filter_by(id=current_user.id).first()
-    if not user:
-        return jsonify({
-            'message': 'Forbidden',
-        }), 403
+
+    user = current_user # already loaded by token_required
 
     video = Video.query.filter_by(id=videoId).first()
     if not video:
@@ -304,8 +475,11 @@ def deleteVideo(current_user, videoId):
             'message': 'Video not found',
         }), 404
 
-    db.session.delete(video)
+    ownerId = video.user_id
+    delete_videos(db.session, [video.id]) # and its formats, comments, jobs and uploads; files are left to the sweeper
     db.session.commit()
+    forget_user(ownerId)
+    invalidate('videos', 'user:%d:videos' % ownerId, 'user:%d' % ownerId, 'video:%d' % videoId, 'video:%d:comments' % videoId)
 
     return jsonify({}), 204
     
@@ -317,12 +491,8 @@ def commentVideo(current_user, videoId):
         return jsonify({
             'message': 'Forbidden',
         }), 403
-    
-    user = User.query.filter_by(id=current_user.id).first()
-    if not user:
-        return jsonify({
-            'message': 'Forbidden',
-        }), 403
+
+    user = current_user # already loaded by token_required
 
     data = request.get_json() or request.form
     body = data.get('body')
@@ -347,7 +517,77 @@ def commentVideo(current_user, videoId):
             video_id = video.id
         )
         db.session.add(newComment)
+        add_count(db.session, Video, 'comment_count', {video.id: 1})
+        db.session.commit()
+        invalidate('video:%d' % video.id, 'video:%d:comments' % video.id)
+        hub.notify() # live streams of this worker, the other ones get it at their next poll
+    except exc.IntegrityError as err:
+        db.session.rollback()
+        return jsonify({
+            'message': 'Bad request',
+            'data': err.args
+        }), 400
+    except Exception as err:
+        db.session.rollback()
+        return jsonify({
+            'message': 'Internal server error',
+            'data': err.args
+        }), 500
+
+    schema = serializer(CommentSchema)
+    output = schema(newComment)
+
+    return jsonify({
+        'message': 'OK',
+        'data': output
+    }), 200
+
+# comment many videos in one transaction: json {"comments": [{"video": 1, "body": "..."}, ...]} (at most BATCH_MAX_ITEMS)
+# one result per comment, in request order; invalid ones (400) and unknown videos (404) are skipped, the others are all saved or none
+@videos_api.route('/comments', methods=['POST'])
+@token_required
+def commentVideos(current_user):
+    if not current_user:
+        return jsonify({
+            'message': 'Forbidden',
+        }), 403
+
+    data = request.get_json() or {}
+    items = data.get('comments')
+
+    if type(items) is not list or not items:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10001, # invalid form
+            'data': ''
+        }), 400
+    try:
+        check_batch_size(items)
+    except ValueError:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10003, # too many items
+            'data': ''
+        }), 400
+
+    valid = [type(item) is dict and type(item.get('video')) is int and type(item.get('body')) is str for item in items]
+    videoIds = set(item['video'] for item, ok in zip(items, valid) if ok)
+    known = set(row.id for row in db.session.query(Video.id).filter(Video.id.in_(videoIds))) if videoIds else set()
+
+    newComments = []
+    try:
+        for item, ok in zip(items, valid):
+            if ok and item['video'] in known:
+                newComment = Comment(
+                    body = item['body'],
+                    user_id = current_user.id,
+                    video_id = item['video']
+                )
+                db.session.add(newComment)
+                newComments.append(newComment)
+        add_count(db.session, Video, 'comment_count', Counter(comment.video_id for comment in newComments))
         db.session.commit()
+        invalidate(*[tag for videoId in known for tag in ('video:%d' % videoId, 'video:%d:comments' % videoId)])
     except exc.IntegrityError as err:
         db.session.rollback()
         return jsonify({
@@ -361,41 +601,175 @@ def commentVideo(current_user, videoId):
             'data': err.args
         }), 500
 
-    schema = CommentSchema()
-    output = schema.dump(newComment).data
+    hub.notify()
+
+    created = iter(dump_comments(newComments))
+    output = []
+    for item, ok in zip(items, valid):
+        if not ok:
+            output.append({'status': 400, 'code': 10001, 'message': 'Bad request'}) # invalid form
+        elif item['video'] not in known:
+            output.append({'status': 404, 'message': 'Video not found'})
+        else:
+            output.append({'status': 200, 'data': next(created)})
 
     return jsonify({
         'message': 'OK',
         'data': output
     }), 200
 
+# count a view, added to video.view by the next flush (see utils/views.py)
+@videos_api.route('/video/<int:videoId>/view', methods=['POST'])
+def viewVideo(videoId):
+    video = db.session.query(Video.id, Video.view).filter_by(id=videoId).first()
+    if not video:
+        return jsonify({
+            'message': 'Video not found',
+        }), 404
+
+    views.add(video.id)
+
+    return jsonify({
+        'message': 'OK',
+        'data': {
+            'id': video.id,
+            'view': (video.view or 0) + views.pending(video.id)
+        }
+    }), 202
+
 # get video's comments
 @videos_api.route('/video/<int:videoId>/comments', methods=['GET'])
+@cached(lambda videoId: ['video:%d:comments' % videoId])
 def getVideoComments(videoId):
     query_params = request.args
-    page = query_params.get('page', 1, type=int)
-    perPage = query_params.get('perPage', 20, type=int)
+    pager_params = pager_args(query_params) # page & perPage, or after & limit for cursor mode
 
-    paginate = Comment.query.filter_by(video_id=videoId).paginate(page = page, per_page = perPage, error_out = False) # if error_out = False, page and perPage defauls to 1 & 20 respectivly
-    
-    comments = paginate.items
-    total = paginate.pages # total of pages for parameter perPage
+    query = Comment.query.filter_by(video_id=videoId)
+
+    try:
+        comments, pager = paginate(query, pager_params, (Comment.id,), ('video_comments', videoId)) # comments have no created_at, ids are increasing
+    except ValueError:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10002, # invalid cursor
+            'data': ''
+        }), 400
 
     if not comments:
         comments = [] # possible options here: return empty array, or return 404 not found ? not sure
 
-    schema = CommentSchema(many=True)
-    output = schema.dump(comments).data
+    schema = serializer(CommentSchema, many=True)
+    output = schema(comments)
 
     return jsonify({
         'message': 'OK',
         'data': output,
-        'pager': {
-            'current': page,
-            'total': total
-        }
+        'pager': pager
+    })
+
+# new comments of a video as server-sent events (id: the comment id, data: same as the items of /video/<id>/comments)
+# resumes after the Last-Event-ID header of a reconnecting EventSource (or ?after=<comment id>), ': ping' every STREAM_HEARTBEAT seconds
+@videos_api.route('/video/<int:videoId>/comments/stream', methods=['GET'])
+def streamVideoComments(videoId):
+    error, start = streamStart(videoId)
+    if error:
+        return error
+
+    # the session is released with the request context, the stream itself runs without database
+    channel, seq, backlog, lastId = start
+    response = Response(stream(channel, seq, backlog, lastId, current_app.config), mimetype='text/event-stream')
+    response.call_on_close(lambda: hub.unsubscribe(channel))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # nginx sends the events as they come
+    return response
+
+# checks of a stream, then its subscription and the comments to resume with: (None, (channel, seq, backlog, lastId)) or (error, None).
+# loop: the event loop of the media server the stream will run on (see utils/aio.py), None for a request thread
+def streamStart(videoId, loop=None):
+    lastId = request.headers.get('Last-Event-ID') or request.args.get('after')
+    try:
+        lastId = int(lastId) if lastId is not None else None
+    except ValueError:
+        return (jsonify({
+            'message': 'Bad request',
+            'code': 10002, # invalid cursor
+            'data': ''
+        }), 400), None
+
+    video = db.session.query(Video.id).filter_by(id=videoId).first()
+    if not video:
+        return (jsonify({
+            'message': 'Video not found',
+        }), 404), None
+
+    try:
+        channel, seq = hub.subscribe(videoId, loop) # before reading the backlog, so that nothing falls in between
+    except Full:
+        return (jsonify({
+            'message': 'Service unavailable',
+        }), 503, {'Retry-After': str(current_app.config.get('STREAM_RETRY', 3000) // 1000)}), None
+
+    try:
+        backlog = []
+        if lastId is not None:
+            comments = Comment.query.filter(Comment.video_id == videoId, Comment.id > lastId).order_by(Comment.id) \
+                .limit(current_app.config.get('STREAM_RESUME_MAX', 100)).all()
+            backlog = [event_text(item) for item in dump_comments(comments)]
+            if comments:
+                lastId = comments[-1].id
+    except Exception:
+        hub.unsubscribe(channel, loop)
+        raise
+    return None, (channel, seq, backlog, lastId)
+
+# first comments of many videos: /videos/comments?ids=1,2,3&limit=20 (at most BATCH_MAX_ITEMS videos), 2 queries
+# one result per video, its pager.next goes on with /video/<id>/comments?after=...&limit=...
+@videos_api.route('/videos/comments', methods=['GET'])
+@cached(lambda: ['videos'])
+def getVideosComments():
+    query_params = request.args
+    limit = query_params.get('limit', 20, type=int)
+    if limit < 1:
+        limit = 20 # same as pager_args
+    limit = min(limit, current_app.config.get('PAGER_MAX_LIMIT', 100))
+    try:
+        videoIds = batch_ids(query_params)
+    except ValueError:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10003, # invalid ids or too many of them
+            'data': ''
+        }), 400
+
+    known = set(row.id for row in db.session.query(Video.id).filter(Video.id.in_(videoIds))) if videoIds else set()
+    add_tags(*['video:%d:comments' % videoId for videoId in known])
+    comments = load_comments(list(known), limit + 1, newest=False) # one more to know if there is a next page
+
+    output = []
+    for videoId in videoIds:
+        if videoId not in known:
+            output.append({'id': videoId, 'status': 404, 'message': 'Video not found'})
+            continue
+        page = comments.get(videoId, [])
+        next_cursor = encode_cursor([page[limit - 1].id]) if len(page) > limit else None
+        output.append({
+            'id': videoId,
+            'status': 200,
+            'data': dump_comments(page[:limit]),
+            'pager': {
+                'next': next_cursor,
+                'limit': limit
+            }
+        })
+
+    return jsonify({
+        'message': 'OK',
+        'data': output
     })
 
-@videos_api.route('/uploads/<filename>')
+# media files: Range / 206, ETag & Last-Modified / 304, see utils/media.py
+@videos_api.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
\ No newline at end of file
+    if not is_public(filename):
+        abort(404) # partial uploads, files being hashed
+    return send_media(current_app.config['UPLOAD_FOLDER'], filename)
\ No newline at end of file
@@ -1,19 +1,19 @@
 ##
-## FILE WHERE WE RUN THE APP,
-## IMPORTING OTHER STUFFS IN HERE (app, blueprints, models to create db..)
+## FILE WHERE WE RUN THE APP IN DEV,
+## (flask dev server on port 1407, see gunicorn.conf.py and wsgi.py to serve it for real)
 ##
 
-from app import app
-from models import *
+import os
 
-from routes.users import users_api
-from routes.auth import auth_api
-from routes.videos import videos_api
+from app import create_app, start_services, db
+from models import *
+from utils.encoding import recover_jobs
 
-app.register_blueprint(users_api)
-app.register_blueprint(auth_api)
-app.register_blueprint(videos_api)
+app = create_app()
 
 if __name__ == '__main__': # only run if called from this file (name = main in this case only)
-    db.create_all(app=app) # create tables if not exists
-    app.run(port=int(1407)) # listen on port 1407
\ No newline at end of file
+    # the tables are created by: python manage.py init-db
+    if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true': # not in the reloader's watcher process
+        recover_jobs(app)
+        start_services(app)
+    app.run(port=int(1407)) # listen on port 1407
@@ -0,0 +1,564 @@
+##
+## FILE WHERE WE DEFINE THE ASYNC MEDIA SERVER
+## (asyncio HTTP/1.1: upload bodies, media files and the live comment streams run on the event loop, a slow or idle client
+##  holds a socket and not a thread; token, rate limit and owner checks and the database work are the ones of routes/,
+##  run in a small thread pool)
+##
+
+from flask import request, jsonify
+from werkzeug import secure_filename
+from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.http import parse_options_header
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from urllib.parse import unquote_to_bytes
+
+import asyncio
+import hashlib
+import json
+import magic
+import os
+import re
+import sys
+import time
+
+# personal imports
+from routes.auth import token_required, load_user
+from routes.videos import videoUploader, saveVideo, formatError, saveFormat, streamStart
+from utils.feed import hub, stream_async
+from utils.media import send_media
+from utils.storage import temp_path, place, extension, is_public
+from utils.metrics import registry
+from utils import ratelimit
+
+class HttpError(Exception):
+    def __init__(self, status, data):
+        Exception.__init__(self, status)
+        self.status = status
+        self.data = data
+
+def error_body(message, code=None):
+    data = {'message': message}
+    if code is not None:
+        data.update(code=code, data='')
+    return data
+
+#################
+#### HTTP #######
+#################
+
+# request line and headers
+class Head(object):
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.path, _, self.query = target.partition('?')
+        self.version = version
+        self.headers = headers
+        self._index = dict((name.lower(), value) for name, value in headers)
+
+    def get(self, name, default=None):
+        return self._index.get(name, default)
+
+    def keep_alive(self):
+        connection = self.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+# the request body: at most `length` bytes, AIO_READ_TIMEOUT seconds at most between two reads
+class Body(object):
+    def __init__(self, reader, length, timeout):
+        self.reader = reader
+        self.remaining = length
+        self.timeout = timeout
+
+    async def read(self, size):
+        if self.remaining <= 0:
+            return b''
+        chunk = await asyncio.wait_for(self.reader.read(min(size, self.remaining)), self.timeout)
+        if not chunk:
+            raise ConnectionError('client went away')
+        self.remaining -= len(chunk)
+        return chunk
+
+    async def drain(self, size=64 * 1024):
+        while self.remaining > 0:
+            await self.read(size)
+
+# multipart/form-data read part by part, the content of a part handed to sink(chunk) as it comes
+class Multipart(object):
+    def __init__(self, body, boundary, buffer_size, max_header_size):
+        self.body = body
+        self.delimiter = b'\r\n--' + boundary
+        self.buffer = b'\r\n' # the first delimiter has no CRLF before it
+        self.buffer_size = buffer_size
+        self.max_header_size = max_header_size
+
+    async def fill(self):
+        chunk = await self.body.read(self.buffer_size)
+        if not chunk:
+            raise HttpError(400, error_body('Bad request', 10001)) # truncated body
+        self.buffer += chunk
+
+    # the headers of the next part (lower case names), None after the last one
+    async def next_part(self):
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                break
+            self.buffer = self.buffer[-len(self.delimiter):] # preamble, or what is left of the part
+            await self.fill()
+        self.buffer = self.buffer[index + len(self.delimiter):]
+
+        while True:
+            if self.buffer.startswith(b'--'):
+                return None
+            end = self.buffer.find(b'\r\n\r\n')
+            if end >= 0:
+                break
+            if len(self.buffer) > self.max_header_size:
+                raise HttpError(400, error_body('Bad request', 10001))
+            await self.fill()
+
+        lines, self.buffer = self.buffer[:end].split(b'\r\n')[1:], self.buffer[end + 4:]
+        headers = {}
+        for line in lines:
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return headers
+
+    async def read_part(self, sink):
+        keep = len(self.delimiter) - 1 # the start of a delimiter cut between two reads
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                if index:
+                    sink(self.buffer[:index])
+                self.buffer = self.buffer[index:]
+                return
+            if len(self.buffer) > keep:
+                sink(self.buffer[:-keep])
+                self.buffer = self.buffer[-keep:]
+            await self.fill()
+
+# the file part of an upload, hashed while written to a temporary file (as storage.store_stream does),
+# refused once its first bytes are not a video
+class Upload(object):
+    def __init__(self, filename, path):
+        self.filename = filename
+        self.path = path
+        self.file = open(path, 'wb')
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+        self.checked = False
+
+    def write(self, chunk):
+        if not self.checked:
+            self.head += chunk[:1024 - len(self.head)]
+            if len(self.head) >= 1024:
+                self.check()
+        self.digest.update(chunk)
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def check(self):
+        self.checked = True
+        if not re.match(r'^video\/', magic.from_buffer(self.head, mime=True)):
+            raise HttpError(400, error_body('Bad request', 10021)) # wrong file type
+
+    def close(self):
+        self.file.close()
+        if not self.checked:
+            self.check()
+
+    # moved to its blob (in an app context)
+    def store(self):
+        return place(self.path, self.digest.hexdigest(), self.size, extension(self.filename))
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+# a WSGI environ for the views, without the body (or with the spooled one of the other routes)
+def make_environ(head, peer, server, body=None):
+    environ = {
+        'REQUEST_METHOD': head.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote_to_bytes(head.path).decode('latin-1'),
+        'QUERY_STRING': head.query,
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': head.version,
+        'REMOTE_ADDR': peer[0],
+        'REMOTE_PORT': str(peer[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in head.headers:
+        key = name.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    if body is None:
+        environ['wsgi.input'] = SpooledTemporaryFile(0)
+    return environ
+
+# (status, headers, body iterable) of a WSGI application
+def call_wsgi(application, environ):
+    started = []
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+    body = application(environ, start_response)
+    return started[0], started[1], body
+
+#################
+#### ROUTES #####
+#################
+
+# checks of the view before the body is read: None to go on, or the error response
+def check_video(current_user, userId):
+    return videoUploader(current_user, userId)[1]
+
+def check_format(current_user, videoId):
+    if not current_user:
+        return jsonify({
+            'message': 'Forbidden',
+        }), 403
+    return None
+
+def no_file():
+    return jsonify({
+        'message': 'Bad request',
+        'code': 10020, # no file
+        'data': ''
+    }), 400
+
+# the view once the file is received: fields are the other parts of the form
+def save_video(current_user, args, fields, upload):
+    user, error = videoUploader(current_user, args['userId'])
+    if error:
+        return error
+    if upload is None:
+        return no_file()
+    return saveVideo(user, fields.get('name') or secure_filename(upload.filename), upload.store())
+
+def save_format(current_user, args, fields, upload):
+    if not current_user:
+        return check_format(current_user, args['videoId'])
+    if upload is None:
+        return no_file()
+    error = formatError(fields.get('format'))
+    if error:
+        return error
+    return saveFormat(args['videoId'], fields['format'], upload.store())
+
+# endpoint -> (file field, check, save), for multipart bodies (PATCH /video/<id> with json goes to the view)
+UPLOADS = {
+    'videos_api.createVideo': ('source', check_video, save_video),
+    'videos_api.encodeVideo': ('file', check_format, save_format),
+}
+DOWNLOADS = ('videos_api.uploaded_file',)
+STREAMS = ('videos_api.streamVideoComments',)
+
+#################
+#### SERVER #####
+#################
+
+class MediaServer(object):
+    def __init__(self, app):
+        self.app = app
+        self.config = app.config
+        self.pool = ThreadPoolExecutor(app.config.get('AIO_THREADS', 8))
+        self.adapter = app.url_map.bind('localhost')
+        self.server = ('localhost', 80)
+
+    def run(self, function, *args):
+        return asyncio.get_event_loop().run_in_executor(self.pool, function, *args)
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info('peername') or ('', 0)
+        self.server = writer.get_extra_info('sockname') or self.server
+        timeout = self.config.get('AIO_HEADER_TIMEOUT', 10)
+        try:
+            while True:
+                head = await self.read_head(reader, timeout)
+                if head is None:
+                    break
+                if not await self.dispatch(head, reader, writer, peer):
+                    break
+                timeout = self.config.get('AIO_KEEPALIVE', 5) # idle between two requests
+        except HttpError as err:
+            await self.send_error(writer, err)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass # slow or gone client
+        except Exception as err:
+            self.app.logger.exception('media server: %s', err)
+        finally:
+            writer.close()
+
+    async def read_head(self, reader, timeout):
+        try:
+            data = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+        except asyncio.IncompleteReadError as err:
+            if not err.partial.strip():
+                return None # closed between two requests
+            raise
+        except asyncio.LimitOverrunError:
+            raise HttpError(431, error_body('Request header fields too large'))
+
+        lines = data.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            raise HttpError(400, error_body('Bad request'))
+        headers = []
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(':')
+                headers.append((name.strip(), value.strip()))
+        return Head(method, target, version, headers)
+
+    # returns False when the connection has to be closed
+    async def dispatch(self, head, reader, writer, peer):
+        if 'chunked' in head.get('transfer-encoding', '').lower():
+            raise HttpError(411, error_body('Length required'))
+        try:
+            length = int(head.get('content-length', 0))
+        except ValueError:
+            raise HttpError(400, error_body('Bad request'))
+        if length > self.config.get('MAX_CONTENT_LENGTH') or length < 0:
+            raise HttpError(413, error_body('Request entity too large'))
+        body = Body(reader, length, self.config.get('AIO_READ_TIMEOUT', 60))
+
+        try:
+            endpoint, args = self.adapter.match(unquote_to_bytes(head.path).decode('latin-1'), head.method)
+        except HTTPException:
+            endpoint, args = None, {} # 404, 405, redirects: the app answers
+
+        began = time.perf_counter()
+        if endpoint in DOWNLOADS and not length:
+            status, keep_alive = await self.download(head, writer, peer, args)
+        elif endpoint in UPLOADS and head.get('content-type', '').startswith('multipart/form-data'):
+            status, keep_alive = await self.upload(head, body, writer, peer, endpoint, args)
+        elif endpoint in STREAMS and head.method == 'GET' and not length:
+            status, keep_alive = await self.stream(head, writer, peer, args)
+        else:
+            return await self.forward(head, body, writer, peer)
+        registry.observe('api_request_duration_seconds', (endpoint, head.method, status[:3]), time.perf_counter() - began)
+        return keep_alive
+
+    # files: headers from utils/media.py (Range, 304, multipart), the bytes sent as the client takes them
+    async def download(self, head, writer, peer, args):
+        environ = make_environ(head, peer, self.server)
+        with self.app.request_context(environ): # a stat, no database
+            try:
+                if not is_public(args['filename']):
+                    raise NotFound() # partial uploads, files being hashed
+                response = send_media(self.config['UPLOAD_FOLDER'], args['filename'])
+            except HTTPException as err:
+                response = err.get_response(environ)
+            status, headers, body = call_wsgi(response, environ)
+        keep_alive = await self.send(writer, head, status, headers, body, head.keep_alive(), blocking=False)
+        return status, keep_alive
+
+    # uploads: the view's checks in the pool, the body to a temporary file on the loop, the view's save in the pool
+    async def upload(self, head, body, writer, peer, endpoint, args):
+        field, check, save = UPLOADS[endpoint]
+        environ = make_environ(head, peer, self.server)
+
+        error = await self.run(self.preflight, environ, check, args)
+        if error is not None:
+            status, headers, content = error
+            await self.send(writer, head, status, headers, content, False, blocking=False) # the body is not read
+            return status, False
+        if head.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+        boundary = parse_options_header(head.get('content-type'))[1].get('boundary')
+        if not boundary:
+            raise HttpError(400, error_body('Bad request', 10001))
+        fields, upload = await self.receive(body, boundary.encode('latin-1'), field)
+
+        try:
+            status, headers, content = await self.run(self.save, environ, save, args, fields, upload)
+        finally:
+            if upload is not None:
+                upload.discard() # unless the save moved it to its blob
+        if upload is not None and status.startswith('2'):
+            registry.inc('api_upload_bytes_total', (endpoint,), upload.size)
+        keep_alive = await self.send(writer, head, status, headers, content, head.keep_alive(), blocking=False)
+        return status, keep_alive
+
+    async def receive(self, body, boundary, field):
+        parser = Multipart(body, boundary, self.config.get('UPLOAD_BUFFER_SIZE', 64 * 1024), self.config.get('AIO_MAX_HEADER_SIZE', 64 * 1024))
+        fields = {}
+        upload = None
+        try:
+            while True:
+                headers = await parser.next_part()
+                if headers is None:
+                    break
+                options = parse_options_header(headers.get('content-disposition', ''))[1]
+                name = options.get('name')
+                if 'filename' in options and name == field and upload is None and options['filename']:
+                    with self.app.app_context():
+                        upload = Upload(options['filename'], temp_path())
+                    await parser.read_part(upload.write)
+                    upload.close()
+                elif 'filename' in options:
+                    await parser.read_part(lambda chunk: None) # other files of the form
+                else:
+                    value = bytearray()
+                    def collect(chunk):
+                        if len(value) + len(chunk) > 64 * 1024:
+                            raise HttpError(400, error_body('Bad request', 10001))
+                        value.extend(chunk)
+                    await parser.read_part(collect)
+                    fields[name] = value.decode('utf-8', 'replace')
+            await body.drain() # epilogue
+        except BaseException:
+            if upload is not None:
+                upload.discard()
+            raise
+        return fields, upload
+
+    def preflight(self, environ, check, args):
+        with self.app.request_context(environ):
+            error = ratelimit.before_request() if self.config.get('RATE_LIMIT', True) else None
+            if error is None:
+                error = token_required(check)(**args)
+            if error is None:
+                return None
+            return call_wsgi(self.app.make_response(error), environ)
+
+    def save(self, environ, save, args, fields, upload):
+        with self.app.request_context(environ):
+            try:
+                user = load_user(request.headers.get('x-token'))
+            except Exception:
+                response = jsonify({
+                    'message': 'Unauthorized',
+                }), 401
+            else:
+                response = save(user, args, fields, upload)
+            status, headers, body = call_wsgi(self.app.make_response(response), environ)
+            return status, headers, list(body)
+
+    # comment streams: checks, subscription and resumed comments in the pool, then the live events on the loop
+    async def stream(self, head, writer, peer, args):
+        environ = make_environ(head, peer, self.server)
+        loop = asyncio.get_event_loop()
+        error, start = await self.run(self.subscribe, environ, args, loop)
+        if error is not None:
+            status, headers, content = error
+            return status, await self.send(writer, head, status, headers, content, head.keep_alive(), blocking=False)
+
+        channel, seq, backlog, lastId = start
+        headers = [('Content-Type', 'text/event-stream; charset=utf-8'), ('Cache-Control', 'no-cache'), ('X-Accel-Buffering', 'no')]
+        try:
+            keep_alive = await self.send(writer, head, '200 OK', headers, stream_async(channel, seq, backlog, lastId, self.config),
+                head.keep_alive(), blocking=False)
+        finally:
+            hub.unsubscribe(channel, loop)
+        return '200', keep_alive
+
+    def subscribe(self, environ, args, loop):
+        with self.app.request_context(environ):
+            error, start = streamStart(args['videoId'], loop)
+            if error is not None:
+                status, headers, body = call_wsgi(self.app.make_response(error), environ)
+                return (status, headers, list(body)), None
+            return None, start
+
+    # every other route: the app in the pool, the body spooled to disk past 1MB
+    async def forward(self, head, body, writer, peer):
+        spool = SpooledTemporaryFile(1024 * 1024)
+        while body.remaining:
+            spool.write(await body.read(64 * 1024))
+        spool.seek(0)
+        environ = make_environ(head, peer, self.server, spool)
+        status, headers, content = await self.run(call_wsgi, self.app.wsgi_app, environ)
+        return await self.send(writer, head, status, headers, content, head.keep_alive(), blocking=True)
+
+    # the next chunk of a body, None at its end: async generators on the loop, the others in the pool if blocking
+    async def next_chunk(self, iterator, blocking):
+        if hasattr(iterator, '__anext__'):
+            try:
+                chunk = await iterator.__anext__()
+            except StopAsyncIteration:
+                return None
+        elif blocking:
+            chunk = await self.run(next, iterator, None)
+        else:
+            chunk = next(iterator, None)
+        return chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+
+    # writes the response, body chunks as the client reads them (blocking: iterated in the pool, e.g. streamed views)
+    async def send(self, writer, head, status, headers, body, keep_alive, blocking):
+        names = set(name.lower() for name, value in headers)
+        with_body = head.method != 'HEAD' and status[:3] not in ('204', '304')
+        chunked = with_body and 'content-length' not in names and head.version == 'HTTP/1.1'
+        if with_body and 'content-length' not in names and not chunked:
+            keep_alive = False # HTTP/1.0: the end of the body is the end of the connection
+
+        lines = ['HTTP/1.1 %s' % status] + ['%s: %s' % (name, value) for name, value in headers if name.lower() != 'connection']
+        if chunked:
+            lines.append('Transfer-Encoding: chunked')
+        lines.append('Connection: %s' % ('keep-alive' if keep_alive else 'close'))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+        timeout = self.config.get('AIO_READ_TIMEOUT', 60)
+        iterator = body if hasattr(body, '__anext__') else iter(body)
+        try:
+            while with_body:
+                chunk = await self.next_chunk(iterator, blocking)
+                if chunk is None:
+                    break
+                if not chunk:
+                    continue
+                if writer.transport.is_closing():
+                    raise ConnectionResetError('client went away') # found by the next heartbeat of an idle stream
+                writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk)
+                await asyncio.wait_for(writer.drain(), timeout) # the client's pace, without a thread
+            if chunked:
+                writer.write(b'0\r\n\r\n')
+            await asyncio.wait_for(writer.drain(), timeout)
+        finally:
+            if hasattr(body, 'aclose'):
+                await body.aclose()
+            elif hasattr(body, 'close'):
+                body.close() # files, call_on_close of the view
+        return keep_alive
+
+    async def send_error(self, writer, err):
+        content = (json.dumps(err.data, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8') # as jsonify
+        head = Head('GET', '/', 'HTTP/1.1', [])
+        try:
+            await self.send(writer, head, '%d %s' % (err.status, err.data['message']),
+                [('Content-Type', 'application/json'), ('Content-Length', str(len(content)))], [content], False, blocking=False)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+
+# runs the server until interrupted (python media_server.py)
+def serve(app, host='0.0.0.0', port=1408):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = MediaServer(app)
+    listener = loop.run_until_complete(asyncio.start_server(server.handle, host, port, limit=app.config.get('AIO_MAX_HEADER_SIZE', 64 * 1024)))
+    app.logger.info('media server on %s:%d', host, port)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+        server.pool.shutdown(wait=False)
+        loop.close()
@@ -0,0 +1,165 @@
+##
+## FILE WHERE WE DEFINE THE IN-PROCESS CACHES
+##
+
+from collections import OrderedDict
+from threading import Lock
+
+import fcntl
+import mmap
+import os
+import struct
+import time
+import zlib
+
+# LRU cache with a ttl per entry, safe to share between request threads
+class TTLCache(object):
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is None:
+                return default
+            if hit[1] <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return hit[0]
+
+    # ttl (seconds) can only shorten the default one
+    def set(self, key, value, ttl=None):
+        if ttl is None or ttl > self.ttl:
+            ttl = self.ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+#######################
+### RESPONSE CACHE ####
+#######################
+
+# one version counter per tag, shared by the workers of the host through a mmap'ed file:
+# a write bumps the versions of its tags, a cached response is valid while the versions
+# it was built with didn't change. Tags are hashed on a fixed number of slots, a collision
+# only costs an extra miss
+class SharedVersions(object):
+    def __init__(self, path, slots=65536):
+        self.path = path
+        self.slots = slots
+        self._map = None
+        self._local = {}
+        self._lock = Lock()
+
+    def _open(self):
+        with self._lock:
+            if self._map is not None or self.path is None:
+                return
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if os.fstat(fd).st_size < self.slots * 8:
+                    os.ftruncate(fd, self.slots * 8)
+                self._map = mmap.mmap(fd, self.slots * 8)
+                self._fd = fd
+            except Exception:
+                os.close(fd)
+                raise
+
+    def _slot(self, tag):
+        return (zlib.crc32(tag.encode('utf-8')) % self.slots) * 8
+
+    def get(self, tag):
+        if self.path is None:
+            return self._local.get(tag, 0)
+        if self._map is None:
+            self._open()
+        return struct.unpack_from('Q', self._map, self._slot(tag))[0]
+
+    def bump(self, tag):
+        if self.path is None:
+            with self._lock:
+                self._local[tag] = self._local.get(tag, 0) + 1
+            return
+        if self._map is None:
+            self._open()
+        slot = self._slot(tag)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 8, slot) # the slot only, other tags are not blocked
+        try:
+            struct.pack_into('Q', self._map, slot, struct.unpack_from('Q', self._map, slot)[0] + 1)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 8, slot)
+
+    # after a fork the child has to map the file again
+    def reset(self):
+        with self._lock:
+            self._map = None
+
+# LRU of serialized responses bounded in bytes, key -> (body, etag, versions of the tags, expiration, size)
+class ResponseCache(object):
+    def __init__(self, max_bytes, ttl, versions):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.versions = versions
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def current(self, tags):
+        return tuple((tag, self.versions.get(tag)) for tag in tags)
+
+    def get(self, key):
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is None:
+                return None
+            self._data.move_to_end(key)
+        if hit[3] <= time.monotonic() or any(self.versions.get(tag) != version for tag, version in hit[2]):
+            self.delete(key)
+            return None
+        return hit
+
+    # versions: read before building the response, so that a write during the build invalidates it
+    def set(self, key, body, etag, versions):
+        size = len(body)
+        if size > self.max_bytes // 16:
+            return
+        if any(self.versions.get(tag) != version for tag, version in versions):
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old[4]
+            self._data[key] = (body, etag, versions, time.monotonic() + self.ttl, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.size -= self._data.popitem(last=False)[1][4]
+
+    def delete(self, key):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old[4]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
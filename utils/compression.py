@@ -0,0 +1,156 @@
+##
+## FILE WHERE WE DEFINE THE RESPONSE COMPRESSION
+## (gzip, deflate or br from Accept-Encoding for the json / text responses over COMPRESSION_MIN_SIZE,
+##  the large and the streamed bodies compressed chunk by chunk as they are sent)
+##
+
+from flask import current_app, request
+
+import time
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None # br is only offered with the brotli package
+
+# personal imports
+from utils.metrics import registry, current, timed
+
+# zlib: gzip (wbits 31) or deflate (zlib format, wbits 15)
+class Deflater(object):
+    def __init__(self, wbits, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+class Brotli(object):
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+def compressor(encoding, config):
+    if encoding == 'br':
+        return Brotli(config.get('COMPRESSION_BROTLI_QUALITY', 4))
+    return Deflater(31 if encoding == 'gzip' else 15, config.get('COMPRESSION_LEVEL', 6))
+
+# ours, best first among the same quality
+def encodings():
+    return ('br', 'gzip', 'deflate') if brotli is not None else ('gzip', 'deflate')
+
+# the encoding to use for Accept-Encoding, None for identity
+def negotiate(accept):
+    qualities = dict((value.lower(), quality) for value, quality in accept)
+    best, best_quality = None, 0
+    for encoding in encodings():
+        quality = qualities.get(encoding, qualities.get('*', 0)) # gzip;q=0 wins over *
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def count(endpoint, encoding, size, compressed):
+    registry.inc('api_compress_input_bytes_total', (endpoint, encoding), size)
+    registry.inc('api_compress_output_bytes_total', (endpoint, encoding), compressed)
+
+# Content-Encoding changes the bytes: the ETag of the json (response cache) is only a weak one now
+def encoded(response, encoding):
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+# body compressed as it is sent: no Content-Length, the CPU time observed once the body is done
+# (after the request's teardown). flush: every chunk leaves at once (generators of the views)
+def stream(response, encoding, chunks, flush):
+    endpoint = request.endpoint or 'unknown'
+    metered = current() is not None
+    packer = compressor(encoding, current_app.config)
+
+    def generate():
+        size = compressed = 0
+        elapsed = 0.0
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                began = time.perf_counter()
+                data = packer.compress(chunk)
+                if flush:
+                    data += packer.flush()
+                elapsed += time.perf_counter() - began
+                size += len(chunk)
+                compressed += len(data)
+                if data:
+                    yield data
+            began = time.perf_counter()
+            data = packer.finish()
+            elapsed += time.perf_counter() - began
+            compressed += len(data)
+            yield data
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            if metered:
+                registry.observe('api_compress_duration_seconds', (endpoint,), elapsed)
+                count(endpoint, encoding, size, compressed)
+
+    response.response = generate()
+    response.headers.pop('Content-Length', None)
+    encoded(response, encoding)
+    return response
+
+def slices(body, size):
+    for start in range(0, len(body), size):
+        yield body[start:start + size]
+
+def after_request(response):
+    config = current_app.config
+    if request.endpoint in config.get('COMPRESSION_SKIP', ()) or response.direct_passthrough:
+        return response # media files, already compressed
+    if response.mimetype not in config.get('COMPRESSION_MIMETYPES', ()) and response.status_code != 304:
+        return response # event streams, multipart/byteranges...
+    response.vary.add('Accept-Encoding') # caches keep one copy per encoding
+    if response.status_code < 200 or response.status_code in (204, 206, 304) or 'Content-Encoding' in response.headers \
+            or 'no-transform' in response.headers.get('Cache-Control', ''):
+        return response
+
+    encoding = negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        return stream(response, encoding, response.iter_encoded(), True)
+
+    body = response.get_data()
+    if len(body) < config.get('COMPRESSION_MIN_SIZE', 1024):
+        return response # not worth the headers and the CPU
+    if len(body) >= config.get('COMPRESSION_STREAM_SIZE', 1024 * 1024):
+        return stream(response, encoding, slices(body, config.get('COMPRESSION_CHUNK_SIZE', 64 * 1024)), False)
+
+    with timed('compress'):
+        packer = compressor(encoding, config)
+        data = packer.compress(body) + packer.finish()
+    response.set_data(data)
+    encoded(response, encoding)
+    if current() is not None:
+        count(request.endpoint or 'unknown', encoding, len(body), len(data))
+    return response
+
+def init_app(app):
+    if not app.config.get('COMPRESSION', True):
+        return
+    app.after_request(after_request)
@@ -0,0 +1,85 @@
+##
+## FILE WHERE WE DEFINE THE DENORMALIZED COUNTERS
+## (video.comment_count, video.format_count and user.video_count, kept up to date by the write paths,
+##  recomputed in bulk by python manage.py repair-counters)
+##
+
+from sqlalchemy import bindparam, func, select
+
+# personal imports
+from models import User, Video, Video_Format, Comment
+from routes.auth import forget_user
+from utils.response_cache import invalidate
+
+# (model, counter column, counted model, its foreign key to model)
+COUNTERS = [
+    (Video, 'comment_count', Comment, 'video_id'),
+    (Video, 'format_count', Video_Format, 'video_id'),
+    (User, 'video_count', Video, 'user_id'),
+]
+
+# counts: row id -> delta, in the session's transaction. An UPDATE column = column + delta per row
+# rather than a read then a write, so that two requests counting on the same row don't lose one
+def add(session, model, column, counts):
+    counts = dict((key, delta) for key, delta in counts.items() if delta)
+    if not counts:
+        return
+    table = model.__table__
+    session.execute(table.update().where(table.c.id == bindparam('_id')).values({column: table.c[column] + bindparam('_delta')}),
+        [{'_id': key, '_delta': delta} for key, delta in counts.items()])
+
+# -1 per row about to be deleted: query gives (id of the counting row, number of deleted rows)
+def remove(session, model, column, query):
+    add(session, model, column, dict((key, -count) for key, count in query))
+
+#################
+#### REPAIR #####
+#################
+
+def counted(model, counted_model, key):
+    return select([func.count()]).where(getattr(counted_model, key) == model.id).as_scalar()
+
+# UPDATE of the counters of the rows with an id in (start, end] that are wrong
+def fix(model, column, counted_model, key, start=None, end=None):
+    table = model.__table__
+    count = counted(model, counted_model, key)
+    statement = table.update().values({column: count}).where(table.c[column] != count)
+    if start is not None:
+        statement = statement.where(table.c.id > start).where(table.c.id <= end)
+    return statement
+
+def wrong(session, model, column, counted_model, key, start, end):
+    table = model.__table__
+    count = counted(model, counted_model, key)
+    return [row[0] for row in session.query(table.c.id).filter(table.c.id > start, table.c.id <= end, table.c[column] != count)]
+
+# the cached responses and users showing the counters of these rows
+def forget(model, ids):
+    if model is User:
+        for userId in ids:
+            forget_user(userId)
+        invalidate(*['user:%d' % userId for userId in ids])
+    else:
+        invalidate(*['video:%d' % videoId for videoId in ids])
+
+# recomputes every counter by ranges of `batch` ids, one transaction each so that the writers are not held long;
+# returns 'table.column' -> rows that were wrong (fixed unless dry_run)
+def repair(session, batch=10000, dry_run=False, log=None):
+    found = {}
+    for model, column, counted_model, key in COUNTERS:
+        name = '%s.%s' % (model.__tablename__, column)
+        last = session.query(func.max(model.id)).scalar() or 0
+        session.commit()
+        fixed = 0
+        for start in range(0, last, batch):
+            ids = wrong(session, model, column, counted_model, key, start, start + batch)
+            if ids and not dry_run:
+                session.execute(fix(model, column, counted_model, key, start, start + batch))
+            session.commit()
+            if ids and not dry_run:
+                forget(model, ids)
+            fixed += len(ids)
+        found[name] = fixed
+        if log is not None:
+            log('%s: %d wrong row(s)%s' % (name, fixed, ' (dry run)' if dry_run else ' fixed'))
+    return found
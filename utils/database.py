@@ -0,0 +1,123 @@
+##
+## FILE WHERE WE DEFINE THE DATABASE SETUP
+## (sqlite pragmas, connection pools, and reads / writes routed to two engines)
+##
+
+from flask import current_app
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, QueuePool, StaticPool
+from sqlalchemy.sql.dml import UpdateBase
+from threading import Lock
+
+import copy
+
+# PRAGMA on every new sqlite connection (SQLITE_PRAGMAS), WAL lets readers and the writer work together
+def sqlite_pragmas(pragmas):
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+    return connect
+
+# session routing statements between the writer engine (SQLALCHEMY_DATABASE_URI) and
+# the reader one (SQLALCHEMY_READ_URI, same database by default):
+# flushes and INSERT / UPDATE / DELETE go to the writer, and once a session wrote all its
+# statements do (read your writes, even on a lagging replica), the other reads go to the reader
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        writer = SignallingSession.get_bind(self, mapper, clause)
+        if not self.app.config.get('SQLALCHEMY_READ_ROUTING', True):
+            return writer
+
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+            return writer
+        if self.info.get('wrote') or self.info.get('writer'):
+            return writer
+
+        return self.db.get_reader_engine(self.app)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def __init__(self, *args, **kwargs):
+        SQLAlchemy.__init__(self, *args, **kwargs)
+        self._reader_lock = Lock()
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    # flask-sqlalchemy puts sqlite files on a NullPool (a connection per checkout),
+    # with a pool_size in the engine options they get a real pool shared by the threads
+    def create_engine(self, sa_url, engine_opts):
+        if sa_url.drivername.startswith('sqlite'):
+            if engine_opts.get('pool_size') and engine_opts.get('poolclass') in (None, NullPool):
+                engine_opts['poolclass'] = QueuePool
+                engine_opts['connect_args'] = dict(engine_opts.get('connect_args', {}), check_same_thread=False)
+            elif engine_opts.get('poolclass') is StaticPool: # memory database, a single connection
+                for name in ('pool_size', 'max_overflow', 'pool_timeout'):
+                    engine_opts.pop(name, None)
+        engine = SQLAlchemy.create_engine(self, sa_url, engine_opts)
+        if sa_url.drivername.startswith('sqlite'):
+            event.listen(engine, 'connect', sqlite_pragmas(current_app.config.get('SQLITE_PRAGMAS', [])))
+        return engine
+
+    def get_reader_engine(self, app=None):
+        app = self.get_app(app)
+        state = get_state(app)
+        reader = getattr(state, 'reader_engine', None)
+        if reader is not None:
+            return reader
+
+        with self._reader_lock:
+            if getattr(state, 'reader_engine', None) is None:
+                options = copy.copy(app.config.get('SQLALCHEMY_READ_ENGINE_OPTIONS', {}))
+                options.setdefault('echo', app.config.get('SQLALCHEMY_ECHO', False))
+                if app.config.get('SQLALCHEMY_READ_URI'):
+                    url = make_url(app.config['SQLALCHEMY_READ_URI'])
+                    self.apply_driver_hacks(app, url, options)
+                else:
+                    url = copy.copy(self.get_engine(app).url) # already made absolute for sqlite
+                if url.drivername.startswith('sqlite') and url.database in (None, '', ':memory:'):
+                    state.reader_engine = self.get_engine(app) # a memory database is per connection
+                    return state.reader_engine
+                state.reader_engine = self.create_engine(url, options)
+                if url.drivername.startswith('sqlite'):
+                    event.listen(state.reader_engine, 'connect', sqlite_pragmas([('query_only', 'ON')]))
+        return state.reader_engine
+
+    # to call in a forked child, like engine.dispose()
+    def dispose_reader(self, app=None):
+        state = get_state(self.get_app(app))
+        if getattr(state, 'reader_engine', None) is not None:
+            state.reader_engine.dispose()
+
+# forces the writer for the rest of the session, for reads that must see the last writes
+# of another worker (e.g. check then insert)
+def use_writer(session):
+    session.info['writer'] = True
+
+# INSERT of the row, nothing if a unique index already has it
+def insert_ignore(session, model, row):
+    table = model.__table__
+    dialect = session.get_bind(clause=table.insert()).dialect.name
+    if dialect == 'postgresql':
+        insert = postgresql.insert(table).values(row).on_conflict_do_nothing()
+    elif dialect == 'mysql':
+        insert = table.insert().values(row).prefix_with('IGNORE')
+    else:
+        insert = table.insert().values(row).prefix_with('OR IGNORE')
+    session.execute(insert)
+
+# INSERT of the row keys + values, or UPDATE of its values if a unique index on keys already has it,
+# without the race of a SELECT then INSERT (two requests both inserting): returns the row
+def upsert(session, model, keys, values):
+    insert_ignore(session, model, dict(keys, **values))
+    session.query(model).filter_by(**keys).update(values, synchronize_session=False)
+    return session.query(model).filter_by(**keys).populate_existing().one()
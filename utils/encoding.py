@@ -0,0 +1,295 @@
+##
+## FILE WHERE WE DEFINE THE ENCODING JOBS
+## (pluggable encoders and the local worker pool running Encode_Job rows)
+##
+
+from flask import current_app
+from werkzeug.utils import import_string
+from datetime import datetime, timedelta
+from threading import Thread, Timer, Lock, Event
+
+import subprocess
+import shutil
+import queue
+import os
+
+# personal imports
+from models import Encode_Job, Video
+from app import db
+from utils.response_cache import invalidate
+from utils.storage import temp_path, store_file, save_format
+
+class QueueFull(Exception):
+    pass
+
+#################
+### ENCODERS ####
+#################
+
+# an encoder writes `source` encoded in the format `code` (height in pixels) to `destination`
+# and raises on failure. ENCODER in the config is the import path of the class to use
+class Encoder(object):
+    extension = '.mp4'
+
+    def encode(self, source, code, destination):
+        raise NotImplementedError()
+
+class FFmpegEncoder(Encoder):
+    def encode(self, source, code, destination):
+        command = [
+            current_app.config.get('FFMPEG_BIN', 'ffmpeg'), '-y', '-loglevel', 'error',
+            '-i', source,
+            '-vf', 'scale=-2:%s' % code,
+            '-c:v', 'libx264', '-preset', 'veryfast', '-c:a', 'aac',
+            destination
+        ]
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=current_app.config.get('ENCODE_TIMEOUT', 3600))
+        if process.returncode != 0:
+            raise RuntimeError(process.stderr.decode('utf-8', 'replace')[-1000:])
+
+# no external binary: copies the source (dev / tests)
+class CopyEncoder(Encoder):
+    def encode(self, source, code, destination):
+        shutil.copyfile(source, destination)
+
+def get_encoder():
+    encoder = current_app.config.get('ENCODER', 'utils.encoding.FFmpegEncoder')
+    if isinstance(encoder, str):
+        encoder = import_string(encoder)
+    return encoder()
+
+#################
+### JOB QUEUE ###
+#################
+
+# bounded queue of job ids consumed by ENCODE_WORKERS threads (the encoders run
+# ffmpeg in a subprocess, threads only wait). Jobs live in the encode_job table,
+# queued ones are picked up again when the workers start and a job is claimed
+# with a conditional UPDATE, so that two processes never run the same one.
+# The running jobs get a heartbeat (updated_at) every ENCODE_HEARTBEAT seconds,
+# those without one for ENCODE_STALE_AFTER seconds lost their worker and are queued again.
+# Queued jobs no queue holds (dropped on a full one, here or in a process gone) are taken back as room frees up
+class JobQueue(object):
+    def __init__(self):
+        self.app = None
+        self.queue = None
+        self.threads = []
+        self.running = set() # ids of the jobs of this process
+        self.waiting = set() # ids in the queue of this process
+        self.delayed = set() # ids waiting for their retry
+        self.stopped = Event()
+        self._lock = Lock()
+
+    def start(self, app):
+        with self._lock:
+            if self.app is not None:
+                return
+            self.app = app
+            self.queue = queue.Queue(app.config.get('ENCODE_QUEUE_SIZE', 100))
+            for index in range(app.config.get('ENCODE_WORKERS', 2)):
+                thread = Thread(target=self.work, name='encoder-%d' % index, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            if self.threads:
+                thread = Thread(target=self.monitor, name='encoder-monitor', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+        with app.app_context():
+            pending = db.session.query(Encode_Job.id).filter_by(status='queued').order_by(Encode_Job.id).all()
+            db.session.remove()
+        for row in pending:
+            if not self.put(row.id):
+                break # the next ones stay queued in the table until the monitor takes them
+
+    # room left for new jobs
+    def free(self):
+        if self.queue is None:
+            self.start(current_app._get_current_object())
+        return self.queue.maxsize - self.queue.qsize()
+
+    # false if the queue is full
+    def put(self, jobId):
+        with self._lock:
+            if jobId in self.waiting:
+                return True
+            try:
+                self.queue.put_nowait(jobId)
+            except queue.Full:
+                return False
+            self.waiting.add(jobId)
+            return True
+
+    def submit(self, jobId):
+        if self.queue is None:
+            self.start(current_app._get_current_object())
+        if not self.put(jobId):
+            raise QueueFull()
+
+    def work(self):
+        while True:
+            jobId = self.queue.get()
+            with self._lock:
+                self.waiting.discard(jobId)
+            try:
+                with self.app.app_context():
+                    self.run(jobId)
+            except Exception as err:
+                self.app.logger.error('encode job %s: %s', jobId, err)
+            finally:
+                self.queue.task_done()
+
+    def run(self, jobId):
+        try:
+            claimed = Encode_Job.query.filter_by(id=jobId, status='queued') \
+                .update({'status': 'running', 'attempts': Encode_Job.attempts + 1, 'updated_at': datetime.utcnow()}, synchronize_session=False)
+            db.session.commit()
+            if not claimed:
+                return # done, failed, or taken by another worker
+            with self._lock:
+                self.running.add(jobId)
+
+            job = Encode_Job.query.filter_by(id=jobId).first()
+            if job is None:
+                return # deleted with its video
+            video = Video.query.filter_by(id=job.video_id).first()
+            if video is None:
+                job.status = 'failed'
+                job.error = 'video not found'
+                db.session.commit()
+                return
+
+            encoder = get_encoder()
+            destination = temp_path(encoder.extension) # the encoders pick the container from the extension
+            source, code = video.source, job.code # read before the commit expires them, a refresh would take the writer again
+            db.session.commit() # gives back the writer connection for the time of the encode (the heartbeat needs it)
+            try:
+                encoder.encode(source, code, destination)
+                stored = store_file(destination, encoder.extension)
+            except Exception as err:
+                if os.path.exists(destination):
+                    os.remove(destination)
+                self.failed(job, err)
+                return
+
+            ## save to db, same upsert as encodeVideo (unless the video was deleted during the encode, the sweeper gets the file)
+            if db.session.query(Video.id).filter_by(id=video.id).first() is None:
+                return
+            format = save_format(db.session, video.id, job.code, stored)
+
+            job.format_id = format.id
+            job.status = 'done'
+            job.error = None
+            job.updated_at = datetime.utcnow()
+            db.session.commit()
+            invalidate('video:%d' % video.id)
+        finally:
+            with self._lock:
+                self.running.discard(jobId)
+            db.session.remove()
+
+    # retries with an exponential backoff, up to ENCODE_MAX_ATTEMPTS
+    def failed(self, job, err):
+        job.error = str(err)[-1000:]
+        job.updated_at = datetime.utcnow()
+
+        if job.attempts < current_app.config.get('ENCODE_MAX_ATTEMPTS', 3):
+            job.status = 'queued'
+            db.session.commit()
+            delay = current_app.config.get('ENCODE_RETRY_DELAY', 10) * 2 ** (job.attempts - 1)
+            with self._lock:
+                self.delayed.add(job.id)
+            timer = Timer(delay, self.retry, [job.id])
+            timer.daemon = True
+            timer.start()
+        else:
+            job.status = 'failed'
+            db.session.commit()
+
+    def retry(self, jobId):
+        with self._lock:
+            self.delayed.discard(jobId)
+        self.put(jobId) # if full, stays queued in the table until the monitor takes it
+
+    # queued jobs older than `seconds` no queue of this process holds: dropped on a full queue, here or in
+    # another process (maybe gone). One in the queue of a live process is run once anyway, the claim is conditional
+    def resubmit(self, seconds):
+        free = self.queue.maxsize - self.queue.qsize()
+        if free <= 0:
+            return
+        with self._lock:
+            mine = list(self.waiting | self.running | self.delayed)
+        query = db.session.query(Encode_Job.id) \
+            .filter(Encode_Job.status == 'queued', Encode_Job.updated_at < datetime.utcnow() - timedelta(seconds=seconds))
+        if mine:
+            query = query.filter(~Encode_Job.id.in_(mine))
+        for row in query.order_by(Encode_Job.id).limit(free).all():
+            if not self.put(row.id):
+                break
+
+    def monitor(self):
+        interval = self.app.config.get('ENCODE_HEARTBEAT', 30)
+        while not self.stopped.wait(interval):
+            with self.app.app_context():
+                try:
+                    self.heartbeat()
+                    for jobId in requeue_stale(self.app.config.get('ENCODE_STALE_AFTER', 300)):
+                        self.put(jobId)
+                    self.resubmit(interval)
+                except Exception as err:
+                    db.session.rollback()
+                    self.app.logger.error('encode monitor: %s', err)
+                finally:
+                    db.session.remove()
+
+    def heartbeat(self):
+        with self._lock:
+            running = list(self.running)
+        if running:
+            Encode_Job.query.filter(Encode_Job.id.in_(running), Encode_Job.status == 'running') \
+                .update({'updated_at': datetime.utcnow()}, synchronize_session=False)
+            db.session.commit()
+
+    # graceful stop of the worker: its running jobs go back to the queue at once
+    # (they die with the process) instead of after ENCODE_STALE_AFTER seconds
+    def stop(self):
+        self.stopped.set()
+        with self._lock:
+            running = list(self.running)
+        if running:
+            with self.app.app_context():
+                Encode_Job.query.filter(Encode_Job.id.in_(running), Encode_Job.status == 'running') \
+                    .update({'status': 'queued'}, synchronize_session=False)
+                db.session.commit()
+                db.session.remove()
+
+jobs = JobQueue()
+
+# running jobs without a heartbeat since `seconds`: their worker died (killed, timeout of gunicorn),
+# queued again or failed once ENCODE_MAX_ATTEMPTS is reached. Returns the ids queued again
+def requeue_stale(seconds):
+    cutoff = datetime.utcnow() - timedelta(seconds=seconds)
+    stale = db.session.query(Encode_Job.id, Encode_Job.attempts) \
+        .filter(Encode_Job.status == 'running', Encode_Job.updated_at < cutoff).all()
+    if not stale:
+        return []
+
+    attempts = current_app.config.get('ENCODE_MAX_ATTEMPTS', 3)
+    queued = [jobId for jobId, count in stale if count < attempts]
+    failed = [jobId for jobId, count in stale if count >= attempts]
+    now = datetime.utcnow()
+    # conditional, a heartbeat may have come in the meantime
+    for ids, values in ((queued, {'status': 'queued', 'updated_at': now}), (failed, {'status': 'failed', 'error': 'worker lost', 'updated_at': now})):
+        if ids:
+            Encode_Job.query.filter(Encode_Job.id.in_(ids), Encode_Job.status == 'running', Encode_Job.updated_at < cutoff) \
+                .update(values, synchronize_session=False)
+    db.session.commit()
+    return queued
+
+# jobs left running by a stopped server go back to the queue,
+# to call once at boot before the workers start (not in each worker)
+def recover_jobs(app):
+    with app.app_context():
+        Encode_Job.query.filter_by(status='running').update({'status': 'queued'}, synchronize_session=False)
+        db.session.commit()
+        db.session.remove()
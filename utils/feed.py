@@ -0,0 +1,234 @@
+##
+## FILE WHERE WE DEFINE THE LIVE COMMENT FEED
+## (one hub per worker fans the new comments out to the streams of /video/<id>/comments/stream,
+##  a poller tails the comment table, woken up at once by the comments of its own worker.
+##  Streams of gunicorn hold a request thread, the ones of the media server (utils/aio.py) only a position on its event loop)
+##
+
+from flask import current_app
+from sqlalchemy import func
+from collections import deque
+from threading import Thread, Event, Condition, Lock
+
+import asyncio
+import json
+import time
+
+# personal imports
+from models import Comment
+from app import db
+from utils.loaders import dump_comments
+
+class Full(Exception):
+    pass
+
+# the new comments of one video, serialized once for all its streams: (seq, comment id, event text),
+# the last STREAM_CHANNEL_BACKLOG of them. A stream only keeps the seq it is at, not a queue of its own
+class Channel(object):
+    def __init__(self, videoId, lock, backlog):
+        self.videoId = videoId
+        self.events = deque(maxlen=backlog)
+        self.seq = 0
+        self.subscribers = 0
+        self.changed = Condition(lock) # the hub lock, a publish only wakes up the streams of its video
+        self.loops = {} # event loop -> its streams of the video
+        self.ready = {} # event loop -> asyncio.Event its waiting streams share, set by the next publish
+
+def event_text(comment):
+    return 'id: %d\nevent: comment\ndata: %s\n\n' % (comment['id'], json.dumps(comment, separators=(',', ':')))
+
+class Hub(object):
+    def __init__(self):
+        self.app = None
+        self.stopped = Event()
+        self.wakeup = Event()
+        self.clients = 0
+        self.async_clients = 0
+        self._channels = {}
+        self._lock = Lock()
+
+    def start(self, app):
+        with self._lock:
+            if self.app is not None:
+                return
+            self.app = app
+        thread = Thread(target=self.run, name='comments-feed', daemon=True)
+        thread.start()
+
+    # a stream of the video: Full over STREAM_MAX_CLIENTS, each one holds a request thread,
+    # or with the event loop it runs on, Full over AIO_STREAM_MAX_CLIENTS
+    def subscribe(self, videoId, loop=None):
+        if self.app is None:
+            self.start(current_app._get_current_object())
+        with self._lock:
+            if loop is None and self.clients >= self.app.config.get('STREAM_MAX_CLIENTS', 2):
+                raise Full()
+            if loop is not None and self.async_clients >= self.app.config.get('AIO_STREAM_MAX_CLIENTS', 10000):
+                raise Full()
+            channel = self._channels.get(videoId)
+            if channel is None:
+                channel = self._channels[videoId] = Channel(videoId, self._lock, self.app.config.get('STREAM_CHANNEL_BACKLOG', 100))
+            channel.subscribers += 1
+            if loop is None:
+                self.clients += 1
+            else:
+                channel.loops[loop] = channel.loops.get(loop, 0) + 1
+                self.async_clients += 1
+            return channel, channel.seq
+
+    def unsubscribe(self, channel, loop=None):
+        with self._lock:
+            channel.subscribers -= 1
+            if loop is None:
+                self.clients -= 1
+            else:
+                self.async_clients -= 1
+                channel.loops[loop] -= 1
+                if not channel.loops[loop]:
+                    del channel.loops[loop]
+                    channel.ready.pop(loop, None)
+            if channel.subscribers == 0 and self._channels.get(channel.videoId) is channel:
+                del self._channels[channel.videoId]
+
+    # comments as dumped by dump_comments, in id order, to the streams of their video
+    def publish(self, comments):
+        with self._lock:
+            for comment in comments:
+                channel = self._channels.get(comment['video'])
+                if channel is None:
+                    continue
+                channel.seq += 1
+                channel.events.append((channel.seq, comment['id'], event_text(comment)))
+                channel.changed.notify_all()
+                for loop in channel.loops:
+                    try:
+                        loop.call_soon_threadsafe(self._wake, channel, loop) # once per loop, not per stream
+                    except RuntimeError:
+                        pass # loop closed
+
+    # on the loop: the streams waiting for the channel read the new events
+    def _wake(self, channel, loop):
+        with self._lock:
+            ready = channel.ready.pop(loop, None)
+        if ready is not None:
+            ready.set()
+
+    # called once a comment is committed in this worker: poll now rather than at the next interval.
+    # Everything goes through the poller so that the streams get the comments in id order, as Last-Event-ID expects
+    def notify(self):
+        if self._channels:
+            self.wakeup.set()
+
+    # the events after seq, [] after timeout seconds without any,
+    # None if some of them already left the backlog (the stream is too slow, it has to resume)
+    def wait(self, channel, seq, timeout):
+        with self._lock:
+            if channel.seq == seq:
+                channel.changed.wait(timeout)
+            return self._after(channel, seq)
+
+    # same, for a stream of an event loop
+    async def wait_async(self, channel, seq, timeout):
+        loop = asyncio.get_event_loop()
+        with self._lock:
+            ready = None
+            if channel.seq == seq:
+                ready = channel.ready.get(loop)
+                if ready is None:
+                    ready = channel.ready[loop] = asyncio.Event()
+        if ready is not None:
+            try:
+                await asyncio.wait_for(ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        with self._lock:
+            return self._after(channel, seq)
+
+    def _after(self, channel, seq):
+        if channel.seq == seq:
+            return []
+        if channel.events[0][0] > seq + 1:
+            return None
+        return [event for event in channel.events if event[0] > seq]
+
+    def watched(self):
+        with self._lock:
+            return set(self._channels)
+
+    # comments saved since the last poll, for the videos watched in this worker
+    def poll(self, cursor):
+        watched = self.watched()
+        try:
+            if cursor is None or not watched:
+                # nobody to send them to: a new stream starts from there (comments saved since are in the next poll)
+                return db.session.query(func.max(Comment.id)).scalar() or 0
+            comments = Comment.query.filter(Comment.id > cursor).order_by(Comment.id) \
+                .limit(self.app.config.get('STREAM_POLL_BATCH', 500)).all()
+            if comments:
+                self.publish(dump_comments([comment for comment in comments if comment.video_id in watched]))
+                cursor = comments[-1].id
+        finally:
+            db.session.remove() # a new read transaction for the next poll
+        return cursor
+
+    def run(self):
+        cursor = None
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.app.config.get('STREAM_POLL_INTERVAL', 1.0))
+            self.wakeup.clear()
+            try:
+                with self.app.app_context():
+                    cursor = self.poll(cursor)
+            except Exception as err:
+                self.app.logger.error('comments feed: %s', err)
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+hub = Hub()
+
+# body of the stream: the comments after lastId found in the database, then the live ones and a heartbeat.
+# Ends after STREAM_MAX_DURATION (or when too far behind), the EventSource reconnects with Last-Event-ID
+def stream(channel, seq, backlog, lastId, config):
+    yield 'retry: %d\n\n' % config.get('STREAM_RETRY', 3000)
+    for text in backlog:
+        yield text
+    if len(backlog) >= config.get('STREAM_RESUME_MAX', 100):
+        return # more to resume, from the last one sent
+
+    heartbeat = config.get('STREAM_HEARTBEAT', 15)
+    deadline = time.monotonic() + config.get('STREAM_MAX_DURATION', 300)
+    while time.monotonic() < deadline:
+        events = hub.wait(channel, seq, heartbeat)
+        if events is None:
+            return
+        if not events:
+            yield ': ping\n\n' # keeps the proxies from closing it, and finds the clients gone
+            continue
+        for seq, commentId, text in events:
+            if lastId is None or commentId > lastId: # else already sent from the database
+                lastId = commentId
+                yield text
+
+# same, for the media server: an async generator, waiting on the event loop
+async def stream_async(channel, seq, backlog, lastId, config):
+    yield 'retry: %d\n\n' % config.get('STREAM_RETRY', 3000)
+    for text in backlog:
+        yield text
+    if len(backlog) >= config.get('STREAM_RESUME_MAX', 100):
+        return
+
+    heartbeat = config.get('STREAM_HEARTBEAT', 15)
+    deadline = time.monotonic() + config.get('STREAM_MAX_DURATION', 300)
+    while time.monotonic() < deadline:
+        events = await hub.wait_async(channel, seq, heartbeat)
+        if events is None:
+            return
+        if not events:
+            yield ': ping\n\n'
+            continue
+        for seq, commentId, text in events:
+            if lastId is None or commentId > lastId:
+                lastId = commentId
+                yield text
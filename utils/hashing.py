@@ -0,0 +1,98 @@
+##
+## FILE WHERE WE DEFINE THE PASSWORD HASHING
+## (bcrypt runs in a bounded process pool so that logins don't starve the request workers)
+##
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from flask import current_app, jsonify
+from threading import BoundedSemaphore, Lock
+
+import bcrypt
+
+# personal imports
+from utils.metrics import timed
+
+class Overloaded(Exception):
+    pass
+
+# executed in the pool processes
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+# a malformed hash (edited row, other scheme) is a failed login, not a 500
+def _check(pw_hash, password):
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+    except ValueError:
+        return False
+
+# at most `workers` hashes running and `queue` waiting, Overloaded for the next ones
+# workers = 0 hashes in the request thread (dev / tests)
+class HashPool(object):
+    def __init__(self):
+        self._executor = None
+        self._slots = None
+        self._started = False
+        self._lock = Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._started:
+                return
+            workers = current_app.config.get('HASH_POOL_WORKERS', 2)
+            if workers > 0:
+                self._executor = ProcessPoolExecutor(max_workers=workers)
+                self._slots = BoundedSemaphore(workers + current_app.config.get('HASH_POOL_QUEUE', 8))
+            self._started = True
+
+    def run(self, fn, *args):
+        if not self._started:
+            self._start()
+        if self._executor is None:
+            return fn(*args)
+
+        slots = self._slots
+        if not slots.acquire(False):
+            raise Overloaded()
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            slots.release()
+            raise
+        # the slot is given back when the hash is done (or cancelled), not on a timeout:
+        # its process is still busy with it and the next ones would wait behind
+        future.add_done_callback(lambda future: slots.release())
+        try:
+            return future.result(current_app.config.get('HASH_TIMEOUT', 5))
+        except TimeoutError:
+            future.cancel() # dropped if still waiting for a process
+            raise Overloaded()
+
+    # to call in a forked child, the executor of the parent is not usable there
+    def reset(self):
+        with self._lock:
+            self._executor = None
+            self._slots = None
+            self._started = False
+
+pool = HashPool()
+
+def hash_password(password):
+    with timed('bcrypt'):
+        return pool.run(_hash, password, current_app.config.get('BCRYPT_LOG_ROUNDS', 10))
+
+def check_password(pw_hash, password):
+    with timed('bcrypt'):
+        return pool.run(_check, pw_hash, password)
+
+# true if the hash was made with another cost than BCRYPT_LOG_ROUNDS ($2b$<cost>$...)
+def needs_rehash(pw_hash):
+    try:
+        return int(pw_hash.split('$')[2]) != current_app.config.get('BCRYPT_LOG_ROUNDS', 10)
+    except (IndexError, ValueError):
+        return True
+
+def overloaded():
+    return jsonify({
+        'message': 'Service unavailable',
+    }), 503, {'Retry-After': str(current_app.config.get('HASH_RETRY_AFTER', 1))}
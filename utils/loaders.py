@@ -0,0 +1,98 @@
+##
+## FILE WHERE WE DEFINE THE BATCH LOADERS
+## (nested collections of a page of videos in a constant number of queries)
+##
+
+from flask import current_app
+from sqlalchemy import func
+
+# personal imports
+from models import Video_Format, VideoSchema, VideoFormatSchema, Comment, CommentSchema
+from app import db
+from utils.views import views
+from utils.serializers import serializer
+
+EXPANDABLE = ('formats', 'comments')
+
+# ?expand=formats,comments (default) / ?expand=formats / ?expand= (nothing nested)
+def expand_args(query_params):
+    expand = query_params.get('expand', None, type=str)
+    if expand is None:
+        return set(EXPANDABLE)
+    return set(item.strip() for item in expand.split(',') if item.strip() in EXPANDABLE)
+
+# groups rows by one of their columns, keeping query order
+def group_by(rows, key):
+    groups = {}
+    for row in rows:
+        groups.setdefault(getattr(row, key), []).append(row)
+    return groups
+
+# formats of all videos: 1 query
+def load_formats(videoIds):
+    if not videoIds:
+        return {}
+    formats = Video_Format.query.filter(Video_Format.video_id.in_(videoIds)).order_by(Video_Format.id).all()
+    return group_by(formats, 'video_id')
+
+# ?ids=1,2,3 of the batch routes: distinct ids in request order
+# raises ValueError if one is not an integer, or if there are more than BATCH_MAX_ITEMS
+def batch_ids(query_params):
+    ids = []
+    seen = set()
+    for value in query_params.get('ids', '', type=str).split(','):
+        if not value.strip():
+            continue
+        itemId = int(value) # ValueError
+        if itemId not in seen:
+            seen.add(itemId)
+            ids.append(itemId)
+            check_batch_size(ids)
+    return ids
+
+def check_batch_size(items):
+    if len(items) > current_app.config.get('BATCH_MAX_ITEMS', 100):
+        raise ValueError('too many items')
+
+# last `size` comments of each video (or the first ones): 1 query (ROW_NUMBER() per video)
+def load_comments(videoIds, size, newest=True):
+    if not videoIds or size < 1:
+        return {}
+    row_number = func.row_number().over(partition_by=Comment.video_id, order_by=Comment.id.desc() if newest else Comment.id).label('row_number')
+    ranked = db.session.query(Comment.id.label('id'), row_number).filter(Comment.video_id.in_(videoIds)).subquery()
+    comments = Comment.query.join(ranked, ranked.c.id == Comment.id).filter(ranked.c.row_number <= size).order_by(Comment.id).all()
+    return group_by(comments, 'video_id')
+
+# many-to-one fields ('user', 'video') are dumped from the fk columns,
+# going through the relationship would lazy load one row per item
+def dump_formats(formats):
+    output = serializer(VideoFormatSchema, exclude=('video',), many=True)(formats)
+    for item, format in zip(output, formats):
+        item['video'] = format.video_id
+    return output
+
+def dump_comments(comments):
+    output = serializer(CommentSchema, exclude=('user', 'video'), many=True)(comments)
+    for item, comment in zip(output, comments):
+        item['user'] = comment.user_id
+        item['video'] = comment.video_id
+    return output
+
+# same output as VideoSchema(many=True), except that nested collections are
+# the ones in `expand` and comments are a bounded preview (COMMENT_PREVIEW_SIZE last ones)
+def dump_videos(videos, expand):
+    output = serializer(VideoSchema, exclude=('user', 'formats', 'comments'), many=True)(videos)
+    videoIds = [video.id for video in videos]
+
+    formats = load_formats(videoIds) if 'formats' in expand else None
+    comments = load_comments(videoIds, current_app.config.get('COMMENT_PREVIEW_SIZE', 5)) if 'comments' in expand else None
+
+    for item, video in zip(output, videos):
+        item['user'] = video.user_id
+        item['view'] = (item['view'] or 0) + views.pending(video.id) # not flushed yet
+        if formats is not None:
+            item['formats'] = dump_formats(formats.get(video.id, []))
+        if comments is not None:
+            item['comments'] = dump_comments(comments.get(video.id, []))
+
+    return output
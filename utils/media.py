@@ -0,0 +1,149 @@
+##
+## FILE WHERE WE DEFINE THE MEDIA SERVING
+## (Range / 206 incl. multipart, ETag / Last-Modified / 304, sendfile, X-Accel-Redirect / X-Sendfile)
+##
+
+from flask import current_app, request, safe_join, Response, abort
+from werkzeug.http import http_date
+
+import calendar
+import mimetypes
+import uuid
+import os
+
+# strong validator from what changes when a file is replaced: inode, size and mtime
+def make_etag(stat):
+    return '%x-%x-%x' % (stat.st_ino, stat.st_size, int(stat.st_mtime * 1000000))
+
+# http dates have a 1 second precision
+def timestamp(date):
+    return calendar.timegm(date.utctimetuple())
+
+def not_modified(etag, mtime):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag) or request.if_none_match.star_tag
+    if request.if_modified_since is not None:
+        return int(mtime) <= timestamp(request.if_modified_since)
+    return False
+
+# the Range of the request as a list of (start, end) with end exclusive,
+# None to send the whole file, [] if nothing is satisfiable (416)
+def requested_ranges(size, etag, mtime):
+    if request.range is None or request.range.units != 'bytes':
+        return None
+
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None # file changed since the client got its first part
+    if if_range.date is not None and int(mtime) > timestamp(if_range.date):
+        return None
+
+    if len(request.range.ranges) > current_app.config.get('MEDIA_MAX_RANGES', 16):
+        return None # no point in serving hundreds of tiny parts
+
+    ranges = []
+    for begin, end in request.range.ranges:
+        if begin < 0:
+            start, end = max(size + begin, 0), size # suffix: last -begin bytes
+        else:
+            start, end = begin, min(end if end is not None else size, size)
+        if start < end:
+            ranges.append((start, end))
+    return ranges
+
+# reads [start, end) by blocks, the file is closed when the response is
+def read_range(file, start, end, buffer_size):
+    try:
+        file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = file.read(min(buffer_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+def read_multipart(path, parts, boundary, buffer_size):
+    with open(path, 'rb') as file:
+        for header, start, end in parts:
+            yield header
+            file.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = file.read(min(buffer_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        yield ('\r\n--%s--\r\n' % boundary).encode('ascii')
+
+def send_media(directory, filename):
+    path = safe_join(directory, filename) # 404 on ../
+    try:
+        stat = os.stat(path)
+    except OSError:
+        abort(404)
+    if not os.path.isfile(path):
+        abort(404)
+
+    size = stat.st_size
+    mtime = stat.st_mtime
+    etag = make_etag(stat)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': '"%s"' % etag,
+        'Last-Modified': http_date(mtime),
+        'Cache-Control': 'public, max-age=%d' % current_app.config.get('MEDIA_MAX_AGE', 3600),
+    }
+
+    if not_modified(etag, mtime):
+        return Response(status=304, headers=headers)
+
+    # a fronting proxy sends the bytes (and handles Range itself)
+    accel = current_app.config.get('MEDIA_ACCEL')
+    if accel == 'x-accel':
+        headers['X-Accel-Redirect'] = current_app.config.get('MEDIA_ACCEL_PREFIX', '/protected/') + filename
+        return Response(status=200, headers=headers, mimetype=mimetype)
+    if accel == 'x-sendfile':
+        headers['X-Sendfile'] = os.path.abspath(path)
+        return Response(status=200, headers=headers, mimetype=mimetype)
+
+    buffer_size = current_app.config.get('MEDIA_BUFFER_SIZE', 64 * 1024)
+    ranges = requested_ranges(size, etag, mtime)
+
+    if ranges == []:
+        headers['Content-Range'] = 'bytes */%d' % size
+        return Response(status=416, headers=headers)
+
+    if ranges is None or len(ranges) == 1:
+        start, end = ranges[0] if ranges else (0, size)
+        file = open(path, 'rb')
+        file.seek(start)
+
+        # up to the end of the file: the server's file_wrapper can sendfile() it (zero copy)
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        if end == size and file_wrapper is not None:
+            body = file_wrapper(file, buffer_size)
+        else:
+            body = read_range(file, start, end, buffer_size)
+
+        headers['Content-Length'] = str(end - start)
+        if ranges:
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, size)
+        return Response(body, status=206 if ranges else 200, headers=headers, mimetype=mimetype, direct_passthrough=True)
+
+    # several ranges: multipart/byteranges
+    boundary = uuid.uuid4().hex
+    parts = []
+    length = len('\r\n--%s--\r\n' % boundary)
+    for start, end in ranges:
+        header = ('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (boundary, mimetype, start, end - 1, size)).encode('ascii')
+        parts.append((header, start, end))
+        length += len(header) + end - start
+
+    headers['Content-Length'] = str(length)
+    return Response(read_multipart(path, parts, boundary, buffer_size), status=206, headers=headers,
+        mimetype='multipart/byteranges; boundary=%s' % boundary, direct_passthrough=True)
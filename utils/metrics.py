@@ -0,0 +1,341 @@
+##
+## FILE WHERE WE DEFINE THE REQUEST METRICS
+## (SQL, serialization, bcrypt and upload time per request, exported for prometheus on /metrics)
+##
+
+from flask import current_app, g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from contextlib import contextmanager
+from threading import Thread, Event, Lock
+
+import fcntl
+import json
+import os
+import time
+
+#################
+#### METRICS ####
+#################
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+# name -> (type, help, label names, buckets)
+METRICS = {
+    'api_request_duration_seconds': ('histogram', 'Time spent in the request, by endpoint, method and status', ('endpoint', 'method', 'status'), DURATION_BUCKETS),
+    'api_sql_queries': ('histogram', 'SQL statements run per request', ('endpoint',), COUNT_BUCKETS),
+    'api_sql_duration_seconds': ('histogram', 'Cumulative SQL time per request', ('endpoint',), DURATION_BUCKETS),
+    'api_serialize_duration_seconds': ('histogram', 'Time spent in marshmallow dump per request', ('endpoint',), DURATION_BUCKETS),
+    'api_bcrypt_duration_seconds': ('histogram', 'Time spent hashing or checking passwords per request', ('endpoint',), DURATION_BUCKETS),
+    'api_disk_write_duration_seconds': ('histogram', 'Time spent writing uploads to disk per request', ('endpoint',), DURATION_BUCKETS),
+    'api_upload_bytes_total': ('counter', 'Bytes of uploaded files written to disk', ('endpoint',), None),
+    'api_slow_requests_total': ('counter', 'Requests slower than SLOW_REQUEST_THRESHOLD', ('endpoint',), None),
+    'api_rate_limited_total': ('counter', 'Requests refused by a rate limit (429)', ('endpoint', 'scope'), None),
+    'api_compress_duration_seconds': ('histogram', 'Time spent compressing the response per request', ('endpoint',), DURATION_BUCKETS),
+    'api_compress_input_bytes_total': ('counter', 'Bytes of responses before compression', ('endpoint', 'encoding'), None),
+    'api_compress_output_bytes_total': ('counter', 'Bytes of responses after compression', ('endpoint', 'encoding'), None),
+}
+
+# the values of one process: name -> label values -> counter value, or [bucket counts..., sum, count]
+class Registry(object):
+    def __init__(self):
+        self._values = {}
+        self._lock = Lock()
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][3]
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            if labels not in series:
+                series[labels] = [0] * (len(buckets) + 2)
+            row = series[labels]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    row[index] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def inc(self, name, labels, value=1):
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return dict((name, [[list(labels), row if type(row) is not list else list(row)] for labels, row in series.items()])
+                for name, series in self._values.items())
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+registry = Registry()
+
+# the snapshots of METRICS_DIR: one per process, and metrics.dead.json for the processes gone (see fold)
+def snapshot_files(folder):
+    return [name for name in os.listdir(folder) if name.startswith('metrics.') and name.endswith('.json')]
+
+def read_snapshot(path):
+    with open(path) as file:
+        return json.load(file)
+
+# sums the snapshots of the workers (one file per process in METRICS_DIR), or this process only
+def collect():
+    folder = current_app.config.get('METRICS_DIR')
+    if not folder:
+        return [registry.snapshot()]
+    save()
+    snapshots = []
+    with folder_lock(folder, fcntl.LOCK_SH): # not in the middle of a fold, a dead process would be counted twice or not at all
+        for name in snapshot_files(folder):
+            try:
+                snapshots.append(read_snapshot(os.path.join(folder, name)))
+            except (OSError, ValueError):
+                continue # being written, the next scrape gets it
+    return snapshots
+
+def merge(snapshots):
+    merged = {}
+    for snapshot in snapshots:
+        for name, series in snapshot.items():
+            if name not in METRICS:
+                continue
+            target = merged.setdefault(name, {})
+            for labels, row in series:
+                labels = tuple(labels)
+                if type(row) is list:
+                    total = target.setdefault(labels, [0] * len(row))
+                    target[labels] = [a + b for a, b in zip(total, row)]
+                else:
+                    target[labels] = target.get(labels, 0) + row
+    return merged
+
+def label_text(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs)
+
+# prometheus text format 0.0.4
+def render(merged):
+    lines = []
+    for name in sorted(METRICS):
+        kind, help, names, buckets = METRICS[name]
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, row in sorted(merged.get(name, {}).items()):
+            if kind == 'counter':
+                lines.append('%s%s %s' % (name, label_text(names, labels), row))
+                continue
+            for bound, count in zip(buckets, row):
+                lines.append('%s_bucket%s %d' % (name, label_text(names, labels, 'le="%s"' % bound), count))
+            lines.append('%s_bucket%s %d' % (name, label_text(names, labels, 'le="+Inf"'), row[-1]))
+            lines.append('%s_sum%s %s' % (name, label_text(names, labels), repr(float(row[-2]))))
+            lines.append('%s_count%s %d' % (name, label_text(names, labels), row[-1]))
+    return '\n'.join(lines) + '\n'
+
+######################
+#### PER REQUEST #####
+######################
+
+class RequestMetrics(object):
+    def __init__(self, started):
+        self.started = started
+        self.queries = 0
+        self.sql_time = 0.0
+        self.statements = [] # (duration, statement, parameters), for the slow request log
+        self.timers = {} # serialize, bcrypt, disk_write, compress -> seconds
+        self.depth = {}
+        self.upload_bytes = 0
+
+def current():
+    if has_app_context():
+        return g.get('metrics')
+    return None
+
+# times the block for the current request; nested blocks of the same name (nested schemas) count once
+@contextmanager
+def timed(name):
+    metrics = current()
+    if metrics is None or metrics.depth.get(name):
+        yield
+        return
+    metrics.depth[name] = 1
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.timers[name] = metrics.timers.get(name, 0.0) + time.perf_counter() - began
+        metrics.depth[name] = 0
+
+def add_upload_bytes(count):
+    metrics = current()
+    if metrics is not None:
+        metrics.upload_bytes += count
+
+# every engine (writer and reader): statements of a request are counted, timed and kept for the slow log
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    started = connection.info.get('metrics_started')
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    metrics = current()
+    if metrics is None:
+        return
+    metrics.queries += 1
+    metrics.sql_time += elapsed
+    if len(metrics.statements) < current_app.config.get('SLOW_REQUEST_MAX_STATEMENTS', 50):
+        metrics.statements.append((elapsed, statement, parameters))
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    started = context.connection.info.get('metrics_started') if context.connection is not None else None
+    if started:
+        started.pop()
+
+def before_request():
+    g.metrics = RequestMetrics(time.perf_counter())
+
+def after_request(response):
+    g.metrics_status = response.status_code
+    return response
+
+def teardown_request(error):
+    metrics = g.get('metrics')
+    if metrics is None:
+        return
+    g.metrics = None # statements of the teardown (session removal) are not the request's
+    elapsed = time.perf_counter() - metrics.started
+    endpoint = request.endpoint or 'unknown' # 404
+    status = 500 if error is not None else g.get('metrics_status', 500)
+
+    registry.observe('api_request_duration_seconds', (endpoint, request.method, str(status)), elapsed)
+    registry.observe('api_sql_queries', (endpoint,), metrics.queries)
+    registry.observe('api_sql_duration_seconds', (endpoint,), metrics.sql_time)
+    if 'serialize' in metrics.timers:
+        registry.observe('api_serialize_duration_seconds', (endpoint,), metrics.timers['serialize'])
+    if 'bcrypt' in metrics.timers:
+        registry.observe('api_bcrypt_duration_seconds', (endpoint,), metrics.timers['bcrypt'])
+    if 'disk_write' in metrics.timers:
+        registry.observe('api_disk_write_duration_seconds', (endpoint,), metrics.timers['disk_write'])
+    if 'compress' in metrics.timers:
+        registry.observe('api_compress_duration_seconds', (endpoint,), metrics.timers['compress'])
+    if metrics.upload_bytes:
+        registry.inc('api_upload_bytes_total', (endpoint,), metrics.upload_bytes)
+
+    threshold = current_app.config.get('SLOW_REQUEST_THRESHOLD')
+    if threshold is not None and elapsed >= threshold:
+        registry.inc('api_slow_requests_total', (endpoint,))
+        log_slow(endpoint, status, elapsed, metrics)
+
+def log_slow(endpoint, status, elapsed, metrics):
+    lines = ['slow request: %s %s (%s) %d in %.1fms, %d statements in %.1fms, %s' % (
+        request.method, request.full_path.rstrip('?'), endpoint, int(status), elapsed * 1000, metrics.queries, metrics.sql_time * 1000,
+        ', '.join('%s %.1fms' % (name, seconds * 1000) for name, seconds in sorted(metrics.timers.items())) or 'no other timer')]
+    # slowest first
+    for duration, statement, parameters in sorted(metrics.statements, key=lambda row: -row[0])[:current_app.config.get('SLOW_REQUEST_LOG_STATEMENTS', 10)]:
+        lines.append('  %.1fms %s%s' % (duration * 1000, ' '.join(statement.split()),
+            ' %r' % (parameters,) if current_app.config.get('SLOW_REQUEST_LOG_PARAMETERS', False) else ''))
+    current_app.logger.warning('\n'.join(lines))
+
+###################
+#### WORKERS ######
+###################
+
+# the snapshot of this process, read by the worker answering /metrics
+def save():
+    folder = current_app.config.get('METRICS_DIR')
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, 'metrics.%d.json' % os.getpid())
+    with open(path + '.tmp', 'w') as file:
+        json.dump(registry.snapshot(), file)
+    os.rename(path + '.tmp', path)
+
+@contextmanager
+def folder_lock(folder, operation):
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, 'fold.lock'), 'a') as file:
+        fcntl.flock(file, operation) # released on close
+        yield
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass # another user's
+    return True
+
+# the snapshots of the processes gone (recycled or killed workers) are added to metrics.dead.json and removed,
+# so that the folder doesn't grow with each restart and the counters summed by /metrics never go down.
+# mine: also the file of this pid, at start (left by a dead process with the same pid)
+def fold(mine=False):
+    folder = current_app.config.get('METRICS_DIR')
+    with folder_lock(folder, fcntl.LOCK_EX):
+        dead = []
+        for name in snapshot_files(folder):
+            pid = name.split('.')[1]
+            if pid.isdigit() and (mine if int(pid) == os.getpid() else not alive(int(pid))):
+                dead.append(name)
+        if not dead:
+            return 0
+
+        path = os.path.join(folder, 'metrics.dead.json')
+        snapshots = []
+        for name in ['metrics.dead.json'] + dead:
+            try:
+                snapshots.append(read_snapshot(os.path.join(folder, name)))
+            except FileNotFoundError:
+                continue # no process died before
+        merged = merge(snapshots)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(dict((name, [[list(labels), row] for labels, row in series.items()]) for name, series in merged.items()), file)
+        os.rename(path + '.tmp', path)
+        for name in dead:
+            os.remove(os.path.join(folder, name))
+        return len(dead)
+
+class Saver(object):
+    def __init__(self):
+        self.app = None
+        self.stopped = Event()
+
+    def start(self, app):
+        if self.app is not None or not app.config.get('METRICS_DIR'):
+            return
+        self.app = app
+        try:
+            with app.app_context():
+                fold(mine=True)
+        except (OSError, ValueError) as err:
+            app.logger.error('metrics fold: %s', err)
+        thread = Thread(target=self.run, name='metrics-saver', daemon=True)
+        thread.start()
+
+    def run(self):
+        next_fold = time.monotonic() + self.app.config.get('METRICS_FOLD_INTERVAL', 60)
+        while not self.stopped.wait(self.app.config.get('METRICS_SYNC_INTERVAL', 5)):
+            try:
+                with self.app.app_context():
+                    save()
+                    if time.monotonic() >= next_fold:
+                        fold()
+                        next_fold = time.monotonic() + self.app.config.get('METRICS_FOLD_INTERVAL', 60)
+            except (OSError, ValueError) as err:
+                self.app.logger.error('metrics save: %s', err)
+
+saver = Saver()
+
+def init_app(app):
+    if not app.config.get('METRICS', True):
+        return
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
@@ -0,0 +1,102 @@
+##
+## FILE WHERE WE DEFINE THE MIGRATIONS RUNNER
+## (versioned schema changes of migrations/, applied in order and recorded in schema_version)
+##
+
+from sqlalchemy import text, inspect
+from contextlib import contextmanager
+from datetime import datetime
+
+import importlib
+import os
+import re
+
+# personal imports
+from app import db
+
+# migrations/NNNN_name.py, each with upgrade(connection)
+# a migration must also work on a database that already has its change (IF NOT EXISTS, has_column...):
+# databases created by db.create_all already have the schema of models.py
+FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+FILENAME_PATTERN = re.compile(r'^(\d{4})_(\w+)\.py$')
+
+def migrations():
+    found = []
+    for filename in sorted(os.listdir(FOLDER)):
+        match = FILENAME_PATTERN.match(filename)
+        if match:
+            module = importlib.import_module('migrations.' + filename[:-3])
+            found.append((int(match.group(1)), match.group(2), module))
+    return found
+
+def head():
+    found = migrations()
+    return found[-1][0] if found else 0
+
+# one transaction, DDL included: pysqlite runs DDL outside of its implicit transactions,
+# and IMMEDIATE takes the write lock first, so that two processes don't migrate together
+@contextmanager
+def transaction(engine):
+    with engine.begin() as connection:
+        if connection.dialect.name == 'sqlite':
+            connection.execute(text('BEGIN IMMEDIATE'))
+        yield connection
+
+def ensure_version_table(connection):
+    connection.execute(text('CREATE TABLE IF NOT EXISTS schema_version ('
+        'version INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL, applied_at DATETIME NOT NULL)'))
+
+def current_version(connection):
+    ensure_version_table(connection)
+    return connection.execute(text('SELECT MAX(version) FROM schema_version')).scalar() or 0
+
+def record(connection, version, name):
+    connection.execute(text('INSERT INTO schema_version (version, name, applied_at) VALUES (:version, :name, :applied_at)'),
+        version=version, name=name, applied_at=datetime.utcnow())
+
+# brings the database to target (default: the last migration), returns the versions applied
+# an empty database gets the tables of models.py and every migration marked as applied
+def upgrade(engine, target=None, log=print):
+    found = migrations()
+    if target is None:
+        target = found[-1][0] if found else 0
+
+    with transaction(engine) as connection:
+        if current_version(connection) == 0 and inspect(connection).get_table_names() == ['schema_version']:
+            db.Model.metadata.create_all(connection)
+            for version, name, module in found:
+                record(connection, version, name)
+            log('empty database: tables created at version %d' % (found[-1][0] if found else 0))
+            return [version for version, name, module in found]
+
+    applied = []
+    for version, name, module in found:
+        if version > target:
+            break
+        with transaction(engine) as connection:
+            if version <= current_version(connection):
+                continue # already there, or applied by another process meanwhile
+            log('applying %04d_%s' % (version, name))
+            module.upgrade(connection)
+            record(connection, version, name)
+        applied.append(version)
+    return applied
+
+# (version, name, applied) of every migration
+def status(engine):
+    with engine.connect() as connection:
+        current = current_version(connection)
+    return [(version, name, version <= current) for version, name, module in migrations()]
+
+#################
+#### HELPERS ####
+#################
+
+def has_table(connection, table):
+    return table in inspect(connection).get_table_names()
+
+def has_column(connection, table, column):
+    return column in [info['name'] for info in inspect(connection).get_columns(table)]
+
+def create_index(connection, name, table, columns, unique=False):
+    connection.execute(text('CREATE %sINDEX IF NOT EXISTS %s ON "%s" (%s)' % ('UNIQUE ' if unique else '', name, table, ', '.join(columns))))
@@ -0,0 +1,151 @@
+##
+## FILE WHERE WE DEFINE THE PAGINATION HELPERS
+## (page/perPage with cached counts, and keyset cursors with after/limit)
+##
+
+from flask import current_app
+from sqlalchemy import tuple_, literal, DateTime, Integer, String
+from datetime import datetime
+from threading import Lock
+
+import base64
+import json
+import math
+import time
+
+# cursors are opaque for clients: urlsafe base64 of a json list of the sort keys
+def encode_cursor(values):
+    raw = []
+    for value in values:
+        if isinstance(value, datetime):
+            raw.append({'d': value.isoformat()})
+        else:
+            raw.append(value)
+    return base64.urlsafe_b64encode(json.dumps(raw, separators=(',', ':')).encode('utf-8')).decode('ascii').rstrip('=')
+
+# a value of a decoded cursor for its sort column: ids are integers, dates datetimes,
+# and the FTS score (no type of its own) a number. Anything else comes from a forged cursor
+def check_value(column, value):
+    if isinstance(column.type, DateTime):
+        valid = isinstance(value, datetime)
+    elif isinstance(column.type, Integer):
+        valid = type(value) is int and -2 ** 63 <= value < 2 ** 63 # sqlite integers
+    elif isinstance(column.type, String):
+        valid = type(value) is str
+    else:
+        valid = type(value) in (int, float) and math.isfinite(value) and abs(value) < 2 ** 63
+    if not valid:
+        raise ValueError('invalid cursor')
+    return value
+
+def decode_cursor(cursor, columns):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except Exception:
+        raise ValueError('invalid cursor')
+
+    if type(raw) is not list or len(raw) != len(columns):
+        raise ValueError('invalid cursor')
+
+    values = []
+    for value in raw:
+        if type(value) is dict and 'd' in value:
+            try:
+                values.append(datetime.strptime(value['d'], '%Y-%m-%dT%H:%M:%S.%f' if '.' in value['d'] else '%Y-%m-%dT%H:%M:%S'))
+            except (TypeError, ValueError):
+                raise ValueError('invalid cursor')
+        else:
+            values.append(value)
+    return [check_value(column, value) for column, value in zip(columns, values)]
+
+# count cache: COUNT(*) on big tables is the expensive part of page mode,
+# so the number of pages is approximate (refreshed every PAGER_COUNT_TTL seconds)
+_counts = {}
+_counts_lock = Lock()
+
+def cached_count(query, key):
+    ttl = current_app.config.get('PAGER_COUNT_TTL', 30)
+    now = time.monotonic()
+
+    with _counts_lock:
+        hit = _counts.get(key)
+    if hit is not None and hit[1] > now:
+        return hit[0]
+
+    total = query.order_by(None).count()
+    with _counts_lock:
+        if len(_counts) >= current_app.config.get('PAGER_COUNT_CACHE_SIZE', 1024):
+            _counts.clear()
+        _counts[key] = (total, now + ttl)
+    return total
+
+def clear_counts():
+    with _counts_lock:
+        _counts.clear()
+
+# reads pager params from the query string
+# cursor mode if 'after' or 'limit' is given, page mode otherwise
+def pager_args(query_params):
+    max_limit = current_app.config.get('PAGER_MAX_LIMIT', 100)
+
+    if 'after' in query_params or 'limit' in query_params:
+        limit = query_params.get('limit', 20, type=int)
+        if limit < 1:
+            limit = 20
+        return {
+            'after': query_params.get('after', None, type=str) or None,
+            'limit': min(limit, max_limit)
+        }
+
+    page = query_params.get('page', 1, type=int)
+    perPage = query_params.get('perPage', 20, type=int)
+    if page < 1:
+        page = 1 # same defaults as paginate(error_out = False)
+    if perPage < 0:
+        perPage = 20
+    return {
+        'page': page,
+        'perPage': min(perPage, max_limit)
+    }
+
+# runs the query for the given pager params
+# returns (items, pager) where pager is the json 'pager' of the response
+# raises ValueError on a bad cursor
+def paginate(query, args, order_by, count_key):
+    if 'limit' in args:
+        return keyset(query, order_by, args['after'], args['limit'])
+
+    page = args['page']
+    perPage = args['perPage']
+    items = query.order_by(*order_by).limit(perPage).offset((page - 1) * perPage).all()
+
+    if perPage == 0:
+        total = 0
+    else:
+        total = int(math.ceil(cached_count(query, count_key) / float(perPage)))
+
+    return items, {
+        'current': page,
+        'total': total
+    }
+
+# keyset pagination: WHERE (created_at, id) > (:created_at, :id) ORDER BY created_at, id LIMIT n + 1
+# cost does not depend on how deep the client is in the list
+def keyset(query, columns, after, limit):
+    query = query.order_by(*columns)
+
+    if after:
+        values = decode_cursor(after, columns)
+        query = query.filter(tuple_(*columns) > tuple_(*[literal(value, column.type) for column, value in zip(columns, values)]))
+
+    items = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor([getattr(items[-1], column.key) for column in columns])
+
+    return items, {
+        'next': next_cursor,
+        'limit': limit
+    }
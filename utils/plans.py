@@ -0,0 +1,126 @@
+##
+## FILE WHERE WE DEFINE THE QUERY PLAN CHECK
+## (EXPLAIN QUERY PLAN of every statement the routes run, a full table scan fails the check)
+##
+
+from sqlalchemy import event
+from datetime import datetime, timedelta
+
+import re
+
+# personal imports
+from app import db
+from models import User, Video, Video_Format, Comment, Encode_Job, Upload
+
+# requests run on a small database: (method, path, json), {user} {video} {job} {upload} are the ids of the rows
+# (json can be a function of those ids)
+# seeded, and a response with a pager.next cursor is followed once (keyset pages)
+REQUESTS = [
+    ('POST', '/auth', {'login': 'plan', 'password': 'plan'}),
+    ('GET', '/users', None),
+    ('GET', '/users?perPage=1&page=2', None),
+    ('GET', '/users?limit=1', None),
+    ('GET', '/users?pseudo=plan', None),
+    ('GET', '/user/{user}', None),
+    ('PUT', '/user/{user}', {'username': 'plan', 'email': 'plan@plan', 'password': 'plan', 'pseudo': 'plan2'}),
+    ('GET', '/videos', None),
+    ('GET', '/videos?limit=1', None),
+    ('GET', '/videos?name=plan', None),
+    ('GET', '/videos?expand=formats,comments', None),
+    ('GET', '/user/{user}/videos', None),
+    ('GET', '/user/{user}/videos?limit=1', None),
+    ('GET', '/video/{video}/comments', None),
+    ('GET', '/video/{video}/comments?limit=1', None),
+    ('POST', '/video/{video}/comment', {'body': 'plan'}),
+    ('GET', '/users/batch?ids={user},0', None),
+    ('GET', '/videos/batch?ids={video},0', None),
+    ('GET', '/videos/comments?ids={video},0&limit=1', None),
+    ('POST', '/comments', lambda ids: {'comments': [{'video': ids['video'], 'body': 'plan'}]}),
+    ('PUT', '/video/{video}', {'name': 'plan2'}),
+    ('PATCH', '/video/{video}', {'formats': ['480']}),
+    ('GET', '/video/{video}/jobs', None),
+    ('GET', '/video/{video}/jobs?status=queued', None),
+    ('GET', '/job/{job}', None),
+    ('GET', '/upload/{upload}', None),
+    ('DELETE', '/upload/{upload}', None),
+    ('DELETE', '/video/{video}', None),
+    ('DELETE', '/user/{user}', None), # with its other videos and comments
+    ('DELETE', '/auth', None),
+]
+
+# the tables of models.py; a SCAN without an index on one of them reads every row
+# (SCAN of a subquery, of a virtual FTS table or USING an index are fine)
+FULL_SCAN = re.compile(r'^SCAN (\w+)(?! USING)(?: |$)')
+
+def full_scans(plan):
+    scans = [FULL_SCAN.match(detail) for detail in plan]
+    return [scan.string for scan in scans if scan and scan.group(1) in db.Model.metadata.tables]
+
+def seed(client):
+    client.post('/user', json={'username': 'plan', 'email': 'plan@plan', 'password': 'plan', 'pseudo': 'plan'})
+    user = User.query.filter_by(username='plan').first()
+    token = client.post('/auth', json={'login': 'plan', 'password': 'plan'}).get_json()['data']
+
+    now = datetime.utcnow()
+    videos = [Video(name='plan %d' % index, source='plan.mp4', user_id=user.id, created_at=now - timedelta(minutes=index)) for index in range(3)]
+    db.session.add_all(videos)
+    db.session.flush()
+    db.session.add_all([Video_Format(code='720', uri='plan.mp4', video_id=video.id) for video in videos])
+    db.session.add_all([Comment(body='plan %d' % index, user_id=user.id, video_id=videos[0].id) for index in range(3)])
+    job = Encode_Job(code='1080', status='done', video_id=videos[0].id, created_at=now, updated_at=now)
+    upload = Upload(id='0' * 32, filename='plan.mp4', offset=0, user_id=user.id, created_at=now)
+    db.session.add_all([job, upload])
+    db.session.commit()
+
+    ids = {'user': user.id, 'video': videos[0].id, 'job': job.id, 'upload': upload.id}
+    db.session.remove()
+    return ids, token
+
+# runs REQUESTS on app (an empty database), returns the failures: (request, statement, full scans)
+def check(app, log=print):
+    app.config.update(RESPONSE_CACHE=False, ENCODE_WORKERS=0, HASH_POOL_WORKERS=0)
+    client = app.test_client()
+
+    statements = []
+    def capture(connection, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')):
+            return
+        statements.append((connection.engine, statement, parameters[0] if executemany else parameters))
+
+    with app.app_context():
+        ids, token = seed(client)
+        engines = set([db.engine, db.get_reader_engine()])
+
+    # requests outside of this app context: each one gets its own, and its session is removed after it
+    failures = []
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        for method, path, json in REQUESTS:
+            paths = [path.format(**ids)]
+            if callable(json):
+                json = json(ids)
+            while paths:
+                path = paths.pop()
+                del statements[:]
+                response = client.open(path, method=method, json=json, headers={'x-token': token})
+                log('%s %s -> %d, %d statements' % (method, path, response.status_code, len(statements)))
+
+                for engine, statement, parameters in statements:
+                    connection = engine.raw_connection()
+                    try:
+                        plan = [row[-1] for row in connection.cursor().execute('EXPLAIN QUERY PLAN ' + statement, parameters)]
+                    finally:
+                        connection.close()
+                    scans = full_scans(plan)
+                    if scans:
+                        failures.append(('%s %s' % (method, path), statement, scans))
+
+                pager = (response.get_json(silent=True) or {}).get('pager') or {}
+                if pager.get('next') and 'after=' not in path:
+                    paths.append(path + '&after=' + pager['next'])
+    finally:
+        for engine in engines:
+            event.remove(engine, 'before_cursor_execute', capture)
+
+    return failures
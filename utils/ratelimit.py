@@ -0,0 +1,162 @@
+##
+## FILE WHERE WE DEFINE THE RATE LIMITS
+## (token buckets per client address and per user, shared by the workers of the host through a mmap'ed file)
+##
+
+from flask import current_app, request, jsonify
+from threading import Lock
+
+import fcntl
+import math
+import mmap
+import os
+import struct
+import time
+import zlib
+
+# personal imports
+from utils.metrics import registry
+
+# a slot: tokens left, time of the last request (0 = never used, a full bucket)
+SLOT = struct.Struct('dd')
+
+# a bucket holds `count` tokens, refilled at count / seconds per second, each request takes one.
+# Keys are hashed on a fixed number of slots: two keys on the same slot share their bucket,
+# which can only make the limit stricter for them. Without a path the slots live in this process
+class SharedBuckets(object):
+    def __init__(self, path, slots=65536):
+        self.path = path
+        self.slots = slots
+        self._map = None
+        self._fd = None
+        self._lock = Lock()
+
+    def _open(self):
+        if self.path is None:
+            self._map = bytearray(self.slots * SLOT.size)
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < self.slots * SLOT.size:
+                os.ftruncate(fd, self.slots * SLOT.size)
+            self._map = mmap.mmap(fd, self.slots * SLOT.size)
+            self._fd = fd
+        except Exception:
+            os.close(fd)
+            raise
+
+    def _slot(self, key):
+        return (zlib.crc32(key.encode('utf-8')) % self.slots) * SLOT.size
+
+    # takes a token: 0 if there was one, else the seconds before the next one
+    def take(self, key, count, seconds, now=None):
+        rate = float(count) / seconds
+        now = time.time() if now is None else now # wall clock, the file outlives the processes
+        slot = self._slot(key)
+        with self._lock: # lockf only excludes the other processes, not our threads
+            if self._map is None:
+                self._open()
+            if self._fd is not None:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX, SLOT.size, slot)
+            try:
+                tokens, last = SLOT.unpack_from(self._map, slot)
+                if last == 0:
+                    tokens = float(count)
+                else:
+                    tokens = min(float(count), tokens + max(0.0, now - last) * rate)
+                wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+                SLOT.pack_into(self._map, slot, tokens - 1 if tokens >= 1 else tokens, now)
+            finally:
+                if self._fd is not None:
+                    fcntl.lockf(self._fd, fcntl.LOCK_UN, SLOT.size, slot)
+        return wait
+
+    # after a fork the child has to map the file again
+    def reset(self):
+        with self._lock:
+            self._map = None
+            self._fd = None
+
+_buckets = None
+_buckets_lock = Lock()
+
+def get_buckets():
+    global _buckets
+    if _buckets is None:
+        with _buckets_lock:
+            if _buckets is None:
+                _buckets = SharedBuckets(current_app.config.get('RATE_LIMIT_FILE'), current_app.config.get('RATE_LIMIT_SLOTS', 65536))
+    return _buckets
+
+# to call in a forked child
+def reset():
+    if _buckets is not None:
+        _buckets.reset()
+
+#################
+#### CHECKS #####
+#################
+
+# address of the client: the last RATE_LIMIT_PROXIES entries of X-Forwarded-For were added by our proxies
+def client_address():
+    proxies = current_app.config.get('RATE_LIMIT_PROXIES', 0)
+    route = [request.remote_addr or '']
+    if proxies:
+        forwarded = request.headers.get('X-Forwarded-For', '')
+        route = [address.strip() for address in forwarded.split(',') if address.strip()] + route
+    return route[max(0, len(route) - 1 - proxies)]
+
+# (name, index, scope, count, seconds) of the endpoint: its own RATE_LIMITS and the ones of its blueprint
+def rules():
+    limits = current_app.config.get('RATE_LIMITS') or {}
+    found = []
+    for name in (request.endpoint, request.blueprint):
+        for index, (scope, count, seconds) in enumerate(limits.get(name, ())):
+            found.append((name, index, scope, count, seconds))
+    return found
+
+def too_many(wait):
+    return jsonify({
+        'message': 'Too many requests',
+    }), 429, {'Retry-After': str(int(math.ceil(wait)))}
+
+# takes a token of each bucket, the 429 of the first empty one
+def check(found, identity):
+    buckets = get_buckets()
+    for name, index, scope, count, seconds in found:
+        wait = buckets.take('%s:%d:%s' % (name, index, identity), count, seconds)
+        if wait:
+            registry.inc('api_rate_limited_total', (request.endpoint, scope))
+            return too_many(wait)
+    return None
+
+# before the handler: the 'ip' rules, and the 'user' ones of the requests without a token.
+# With a token, token_required / token_optional check the 'user' rules once the user is known
+def before_request():
+    if request.endpoint is None:
+        return None
+    found = rules()
+    if not found:
+        return None
+    view = current_app.view_functions.get(request.endpoint)
+    by_user = getattr(view, 'checks_token', False) and request.headers.get('x-token') is not None
+    address = client_address()
+    limited = check([rule for rule in found if rule[2] == 'ip'], 'ip:' + address)
+    if limited is None and not by_user:
+        limited = check([rule for rule in found if rule[2] == 'user'], 'ip:' + address)
+    return limited
+
+# called by token_required / token_optional: None, or the 429 to return.
+# Without a user the 'user' rules were taken per address by before_request already
+def limit_user(user):
+    if user is None or not current_app.config.get('RATE_LIMIT', True) or request.endpoint is None:
+        return None
+    found = [rule for rule in rules() if rule[2] == 'user']
+    if not found:
+        return None
+    return check(found, 'user:%d' % user.id)
+
+def init_app(app):
+    if not app.config.get('RATE_LIMIT', True):
+        return
+    app.before_request(before_request)
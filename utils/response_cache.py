@@ -0,0 +1,97 @@
+##
+## FILE WHERE WE DEFINE THE CACHE OF THE PUBLIC GET RESPONSES
+## (keyed on route + normalized query string, invalidated by tags from the write handlers)
+##
+
+from flask import current_app, request, g, make_response, Response
+from functools import wraps
+from threading import Lock
+
+import hashlib
+
+# personal imports
+from utils.cache import ResponseCache, SharedVersions
+
+# tags:
+#   videos, videos:search          lists of /videos (with ?name=)
+#   user:<id>:videos               /user/<id>/videos
+#   video:<id>                     any list holding the video (formats, comments preview, name)
+#   video:<id>:comments            /video/<id>/comments
+#   users, users:search, user:<id> same for /users
+
+_cache = None
+_cache_lock = Lock()
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                versions = SharedVersions(current_app.config.get('RESPONSE_CACHE_VERSIONS'), current_app.config.get('RESPONSE_CACHE_SLOTS', 65536))
+                _cache = ResponseCache(current_app.config.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024), current_app.config.get('RESPONSE_CACHE_TTL', 30), versions)
+    return _cache
+
+# to call in a forked child
+def reset():
+    if _cache is not None:
+        _cache.clear()
+        _cache.versions.reset()
+
+# called by the write handlers once committed
+def invalidate(*tags):
+    if not current_app.config.get('RESPONSE_CACHE', True):
+        return
+    cache = get_cache()
+    for tag in tags:
+        cache.versions.bump(tag)
+
+# tags of the rows in the response, known once the handler ran
+def add_tags(*tags):
+    if 'cache_tags' not in g:
+        g.cache_tags = []
+    g.cache_tags.extend(tags)
+
+def make_etag(body):
+    return hashlib.sha1(body).hexdigest()
+
+def send(body, etag, hit):
+    if request.if_none_match.contains_weak(etag): # the compressed responses have a weak one (utils/compression.py)
+        response = Response(status=304)
+    else:
+        response = Response(body, status=200, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['X-Cache'] = 'HIT' if hit else 'MISS'
+    return response
+
+# tags(**view_args) -> tags of the whole response (the handler adds the ones of its rows with add_tags)
+def cached(tags):
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if not current_app.config.get('RESPONSE_CACHE', True) or request.method != 'GET':
+                return f(*args, **kwargs)
+
+            cache = get_cache()
+            key = (request.endpoint, tuple(sorted(kwargs.items())), tuple(sorted((name, tuple(values)) for name, values in request.args.lists())))
+
+            hit = cache.get(key)
+            if hit is not None:
+                return send(hit[0], hit[1], True)
+
+            base_tags = tags(**kwargs)
+            versions = cache.current(base_tags)
+            g.cache_tags = []
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200 or response.direct_passthrough:
+                return response
+
+            body = response.get_data()
+            etag = make_etag(body)
+            # the row tags are only known after the query: a write on one of the rows in between
+            # can leave a stale entry, for RESPONSE_CACHE_TTL seconds at most
+            cache.set(key, body, etag, versions + cache.current(g.cache_tags))
+            return send(body, etag, False)
+
+        return decorated
+
+    return decorator
@@ -0,0 +1,93 @@
+##
+## FILE WHERE WE DEFINE THE FULL-TEXT SEARCH
+## (SQLite FTS5 tables kept in sync with video.name and user.pseudo by triggers)
+##
+
+from flask import current_app
+from sqlalchemy import event, func, select, text, literal_column
+from sqlalchemy.sql import table, column
+from threading import Lock
+
+import re
+
+# personal imports
+from app import db
+
+# external content tables: the index only, the rows stay in video / user,
+# triggers keep them in sync on every INSERT / UPDATE / DELETE (whatever the code path)
+INDEXES = {
+    'video_fts': ('video', 'name'),
+    'user_fts': ('user', 'pseudo'),
+}
+
+def ddl(index, table, column):
+    return [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5({column}, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        "CREATE TRIGGER IF NOT EXISTS {index}_insert AFTER INSERT ON \"{table}\" BEGIN "
+            "INSERT INTO {index}(rowid, {column}) VALUES (new.id, new.{column}); END",
+        "CREATE TRIGGER IF NOT EXISTS {index}_delete AFTER DELETE ON \"{table}\" BEGIN "
+            "INSERT INTO {index}({index}, rowid, {column}) VALUES ('delete', old.id, old.{column}); END",
+        "CREATE TRIGGER IF NOT EXISTS {index}_update AFTER UPDATE OF {column} ON \"{table}\" BEGIN "
+            "INSERT INTO {index}({index}, rowid, {column}) VALUES ('delete', old.id, old.{column}); "
+            "INSERT INTO {index}(rowid, {column}) VALUES (new.id, new.{column}); END",
+        "INSERT INTO {index}({index}) VALUES ('rebuild')", # index the rows already there
+    ]
+
+# creates the indexes, called after db.create_all (and safe to call again)
+def install(connection):
+    if connection.dialect.name != 'sqlite':
+        return
+    for index, (table, column) in INDEXES.items():
+        exists = connection.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), name=index).first()
+        if exists:
+            continue
+        for statement in ddl(index, table, column):
+            connection.execute(text(statement.format(index=index, table=table, column=column)))
+    available.clear()
+
+@event.listens_for(db.Model.metadata, 'after_create')
+def after_create(target, connection, **kw):
+    install(connection)
+
+# index name -> bool, checked once per process (databases created before the indexes don't have them)
+available = {}
+available_lock = Lock()
+
+def enabled(index):
+    if not current_app.config.get('SEARCH_FTS', True):
+        return False
+    if index not in available:
+        with available_lock:
+            if db.engine.dialect.name != 'sqlite':
+                available[index] = False
+            else:
+                available[index] = db.session.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': index}).first() is not None
+            if not available[index]:
+                current_app.logger.warning('search: no %s index, falling back to LIKE', index)
+    return available[index]
+
+# user input -> fts5 query: every word must match, as a prefix ('cat vid' -> "cat"* "vid"*)
+def match_query(terms):
+    words = re.findall(r'\w+', terms, re.UNICODE)
+    return ' '.join('"%s"*' % word for word in words[:current_app.config.get('SEARCH_MAX_TERMS', 8)])
+
+# subquery (id, score) of the rows matching terms, best first when ordered by score
+def matches(index, terms):
+    fts = table(index, column('rowid'))
+    return select([
+            fts.c.rowid.label('id'),
+            func.bm25(literal_column(index)).label('score')
+        ]) \
+        .select_from(fts) \
+        .where(text('%s MATCH :terms' % index).bindparams(terms=match_query(terms))) \
+        .alias('%s_matches' % index)
+
+# Model.query filtered on the search terms: rows are (instance, score, id)
+# and the pager orders them by (score, id), best first
+# None if there is nothing to search in terms
+def search(model, index, terms):
+    if not match_query(terms):
+        return None
+    found = matches(index, terms)
+    query = model.query.join(found, found.c.id == model.id).add_columns(found.c.score, found.c.id)
+    return query, (found.c.score, found.c.id)
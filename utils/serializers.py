@@ -0,0 +1,135 @@
+##
+## FILE WHERE WE DEFINE THE FAST SERIALIZERS
+## (each schema + only / exclude / many compiled once into plain getters, same output as schema.dump(...).data)
+##
+
+from marshmallow import fields, utils, missing
+from marshmallow_sqlalchemy.fields import Related
+from sqlalchemy import inspect
+from sqlalchemy.orm.interfaces import MANYTOONE
+from threading import Lock
+
+# personal imports
+from utils.metrics import timed
+
+# (schema class, only, exclude, many) -> dump function
+_compiled = {}
+_lock = Lock()
+
+# dump function of the schema, compiled on the first call: serializer(VideoSchema, many=True)(videos)
+def serializer(schema_class, only=None, exclude=(), many=False):
+    key = (schema_class, tuple(only) if only is not None else None, tuple(exclude), many)
+    dump = _compiled.get(key)
+    if dump is None:
+        with _lock:
+            dump = _compiled.get(key)
+            if dump is None:
+                dump = _compiled[key] = timed_dump(compile_schema(schema_class(only=only, exclude=exclude, many=many)))
+    return dump
+
+def timed_dump(dump):
+    def timed_dump(obj):
+        with timed('serialize'):
+            return dump(obj)
+    return timed_dump
+
+def has_dump_processors(schema):
+    # a defaultdict, dump() leaves empty lists behind
+    return any(tag in ('pre_dump', 'post_dump') and names for (tag, pass_many), names in getattr(schema, '__processors__', {}).items())
+
+# a function of one object (or of a list of them if schema.many) returning the dict marshmallow would
+def compile_schema(schema):
+    if has_dump_processors(schema) or schema.prefix or schema.dict_class is not dict:
+        return lambda obj: schema.dump(obj).data # not worth a specialization
+
+    getters = []
+    generic = False
+    for name, field in schema.fields.items():
+        if field.load_only:
+            continue
+        getter = compile_field(schema, name, field)
+        if getter is None:
+            generic = True
+            getter = generic_getter(schema, name, field)
+        getters.append((field.dump_to or name, getter))
+
+    if generic:
+        def dump_one(obj):
+            items = {}
+            for key, getter in getters:
+                value = getter(obj)
+                if value is not missing:
+                    items[key] = value
+            return items
+    else:
+        def dump_one(obj):
+            return {key: getter(obj) for key, getter in getters}
+
+    if schema.many:
+        return lambda objs: [dump_one(obj) for obj in objs]
+    return dump_one
+
+# marshmallow's own path, for the fields without a specialization
+def generic_getter(schema, name, field):
+    return lambda obj: field.serialize(name, obj, accessor=schema.get_attribute)
+
+# getter of the field, or None if it has no specialization
+def compile_field(schema, name, field):
+    if getattr(field, 'attribute', None) not in (None, name) or getattr(field, '_CHECK_ATTRIBUTE', True) is False:
+        return None
+    kind = type(field)
+
+    if kind is fields.Integer and not field.as_string:
+        def integer(obj):
+            value = getattr(obj, name)
+            return None if value is None else int(value)
+        return integer
+
+    if kind is fields.String:
+        def string(obj):
+            value = getattr(obj, name)
+            return value if value is None or type(value) is str else utils.ensure_text_type(value)
+        return string
+
+    if kind is fields.Boolean:
+        def boolean(obj):
+            return field._serialize(getattr(obj, name), name, obj)
+        return boolean
+
+    if kind is fields.DateTime and (field.dateformat or field.DEFAULT_FORMAT) == 'iso' and not field.localtime:
+        def datetime(obj):
+            value = getattr(obj, name)
+            return None if value is None else utils.isoformat(value)
+        return datetime
+
+    if kind is fields.Nested:
+        nested = compile_schema(field.schema) # field.schema has the only / exclude / many of the field
+        def nested_getter(obj):
+            value = getattr(obj, name)
+            return None if value is None else nested(value)
+        return nested_getter
+
+    if kind is Related:
+        return compile_related(schema, name, field)
+
+    return None
+
+# many-to-one relationship to a single primary key: the foreign key column holds the same value,
+# reading it avoids loading the related row (one query per item in a list)
+def compile_related(schema, name, field):
+    model = schema.opts.model
+    if model is None:
+        return None
+    prop = inspect(model).relationships.get(name)
+    if prop is None or prop.direction is not MANYTOONE or len(prop.local_columns) != 1 or len(field.related_keys) != 1:
+        return None
+    remote = list(prop.remote_side)
+    if len(remote) != 1 or remote[0].key != field.related_keys[0].key:
+        return None
+    column = inspect(model).get_property_by_column(list(prop.local_columns)[0]).key
+    fallback = generic_getter(schema, name, field)
+
+    def related(obj):
+        value = getattr(obj, column)
+        return value if value is not None else fallback(obj) # relationship set but not flushed yet
+    return related
@@ -0,0 +1,193 @@
+##
+## FILE WHERE WE DEFINE THE BLOB STORAGE
+## (each content stored once in UPLOAD_FOLDER/blobs/ab/cd/<sha256><ext>, hashed while written, counted by the rows using it)
+##
+
+from flask import current_app
+from werkzeug import secure_filename
+from sqlalchemy import func, select
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock
+
+import hashlib
+import fcntl
+import posixpath
+import uuid
+import os
+
+# personal imports
+from models import Blob, Video, Video_Format
+from app import db
+from utils.database import insert_ignore, upsert, use_writer
+from utils.metrics import timed
+from utils.counters import add as add_count
+
+# a stored file: uri is what goes in Video.source / Video_Format.uri (UPLOAD_FOLDER + path of the blob)
+Stored = namedtuple('Stored', ['hash', 'path', 'uri', 'size'])
+
+def folder():
+    return current_app.config.get('BLOB_FOLDER', 'blobs')
+
+# blobs/ab/cd/abcd...<ext>: BLOB_SHARD_DEPTH levels of 256 folders, so that none gets too big
+def blob_path(hash, extension):
+    depth = current_app.config.get('BLOB_SHARD_DEPTH', 2)
+    return '/'.join([folder()] + [hash[2 * index:2 * index + 2] for index in range(depth)] + [hash + extension])
+
+# a media path under /uploads/ that may be served: the flat files of before the blobs, or a blob.
+# Checked on the segments as they are, so that blobs/../partial/<id> or blobs//tmp/x can't reach the files around them
+def is_public(path):
+    segments = path.split('/')
+    if any(segment in ('', '.', '..') for segment in segments) or posixpath.normpath(path) != path:
+        return False
+    if len(segments) == 1:
+        return True
+    return segments[0] == folder() and segments[1] != 'tmp'
+
+# extension kept on the blob, for the mimetype of /uploads/ and the encoders
+def extension(filename):
+    return os.path.splitext(secure_filename(filename))[1].lower()[:16]
+
+# file on the same filesystem as the blobs, so that moving it is a rename
+def temp_path(extension=''):
+    path = os.path.join(current_app.config['UPLOAD_FOLDER'], folder(), 'tmp')
+    os.makedirs(path, exist_ok=True)
+    return os.path.join(path, uuid.uuid4().hex + extension)
+
+# where a content is stored: its blob if there is one already, or the one it will get
+def locate(hash, size, extension):
+    existing = db.session.query(Blob.path).filter_by(hash=hash).scalar()
+    relative = existing or blob_path(hash, extension)
+    return Stored(hash, relative, current_app.config['UPLOAD_FOLDER'] + relative, size)
+
+_files_lock = Lock()
+
+# held to touch a blob (place) and to check and remove a file (sweeper), so that a blob can't be
+# touched between the sweeper's check of its mtime and its removal. BLOB_LOCK is shared by the processes
+@contextmanager
+def files_lock():
+    path = current_app.config.get('BLOB_LOCK')
+    with _files_lock:
+        if not path:
+            yield
+            return
+        with open(path, 'a') as file:
+            fcntl.flock(file, fcntl.LOCK_EX) # released on close
+            yield
+
+# moves the file to its blob, or drops it if that content is already stored.
+# keep: the blob is a hard link and the file stays, for the caller to remove once its rows are committed
+def place(path, hash, size, extension, keep=False):
+    stored = locate(hash, size, extension)
+    target = os.path.join(current_app.config['UPLOAD_FOLDER'], stored.path)
+
+    with files_lock():
+        try:
+            os.utime(target) # used again: the sweeper leaves recently touched files alone
+            if not keep:
+                os.remove(path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if keep:
+                os.link(path, target)
+                os.utime(target) # the mtime of the file, maybe older than GC_GRACE
+            else:
+                os.replace(path, target)
+    return stored
+
+# writes the stream by UPLOAD_BUFFER_SIZE blocks, computing its sha256 on the way
+def store_stream(stream, extension):
+    buffer_size = current_app.config.get('UPLOAD_BUFFER_SIZE', 64 * 1024)
+    digest = hashlib.sha256()
+    size = 0
+    path = temp_path()
+    try:
+        with timed('disk_write'):
+            with open(path, 'wb') as file:
+                while True:
+                    chunk = stream.read(buffer_size)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    file.write(chunk)
+                    size += len(chunk)
+            return place(path, digest.hexdigest(), size, extension)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+# sha256 and size of a file already on disk
+def hash_file(path):
+    buffer_size = current_app.config.get('UPLOAD_BUFFER_SIZE', 64 * 1024)
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as file:
+        while True:
+            chunk = file.read(buffer_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+# a file already on disk (encoder output): read once for the hash, then moved
+def store_file(path, extension):
+    hash, size = hash_file(path)
+    return place(path, hash, size, extension)
+
+############################
+#### REFERENCE COUNTING ####
+############################
+
+# the blob row, in the transaction of the row pointing to it
+def add_blob(session, stored):
+    insert_ignore(session, Blob, {'hash': stored.hash, 'path': stored.path, 'size': stored.size, 'refs': 0, 'created_at': datetime.utcnow()})
+
+# refs of the blobs counted from the rows using them, after the changes of the session:
+# a count rather than +1 / -1, so that a missed decrement can't leave a blob referenced forever
+def recount(session, hashes):
+    hashes = [hash for hash in set(hashes) if hash]
+    if not hashes:
+        return
+    session.flush()
+    videos = select([func.count()]).where(Video.blob_id == Blob.hash).as_scalar()
+    formats = select([func.count()]).where(Video_Format.blob_id == Blob.hash).as_scalar()
+    session.query(Blob).filter(Blob.hash.in_(hashes)).update({'refs': videos + formats}, synchronize_session=False)
+
+# upsert of the format of a video (one per code), the blob it replaces loses a reference
+def save_format(session, videoId, code, stored):
+    add_blob(session, stored) # the write lock, nobody adds the format between the read and the upsert
+    use_writer(session) # the previous blob as seen by the writer
+    previous = session.query(Video_Format.blob_id).filter_by(video_id=videoId, code=code).first()
+    format = upsert(session, Video_Format, {'video_id': videoId, 'code': code}, {'uri': stored.uri, 'blob_id': stored.hash})
+    if previous is None:
+        add_count(session, Video, 'format_count', {videoId: 1})
+    recount(session, [previous.blob_id if previous is not None else None, stored.hash])
+    return format
+
+##############################
+#### FILES OF BEFORE 0003 ####
+##############################
+
+# moves the flat files of UPLOAD_FOLDER of the existing videos and formats to blobs (python manage.py import-uploads)
+# one transaction per file, for all the rows using it; returns the number of files (imported, missing)
+def import_legacy(log=print):
+    paths = set(row[0] for row in db.session.query(Video.source).filter(Video.blob_id.is_(None)))
+    paths.update(row[0] for row in db.session.query(Video_Format.uri).filter(Video_Format.blob_id.is_(None)))
+
+    imported = missing = 0
+    for path in sorted(paths):
+        if not os.path.isfile(path):
+            log('%s not found, its rows are left as they are' % path)
+            missing += 1
+            continue
+        stored = store_file(path, extension(path))
+        add_blob(db.session, stored)
+        Video.query.filter(Video.source == path, Video.blob_id.is_(None)).update({'source': stored.uri, 'blob_id': stored.hash}, synchronize_session=False)
+        Video_Format.query.filter(Video_Format.uri == path, Video_Format.blob_id.is_(None)).update({'uri': stored.uri, 'blob_id': stored.hash}, synchronize_session=False)
+        recount(db.session, [stored.hash])
+        db.session.commit()
+        imported += 1
+    db.session.remove()
+    return imported, missing
@@ -0,0 +1,291 @@
+##
+## FILE WHERE WE DEFINE THE DELETES AND THE MEDIA SWEEPER
+## (rows are deleted set based in the request, their files are removed later by a background thread in small batches)
+##
+
+from flask import current_app
+from sqlalchemy import or_, func
+from threading import Thread, Event
+
+import fcntl
+import time
+import os
+
+# personal imports
+from models import User, Video, Video_Format, Comment, Token, Encode_Job, Upload, Blob
+from app import db
+from utils.storage import recount, folder, files_lock
+from utils.counters import remove as remove_count, repair
+
+#################
+#### DELETES ####
+#################
+
+# the videos (a list of ids or a query of ids) and the rows pointing to them, in the session's transaction:
+# a few DELETE ... WHERE video_id IN, no row loaded. Their blobs lose their references, the files stay for the sweeper
+def delete_videos(session, videoIds):
+    hashes = [row[0] for row in session.query(Video.blob_id).filter(Video.id.in_(videoIds))]
+    hashes += [row[0] for row in session.query(Video_Format.blob_id).filter(Video_Format.video_id.in_(videoIds))]
+    remove_count(session, User, 'video_count', session.query(Video.user_id, func.count()).filter(Video.id.in_(videoIds)).group_by(Video.user_id))
+
+    for model in (Comment, Encode_Job, Upload, Video_Format): # jobs before the formats they point to
+        session.query(model).filter(model.video_id.in_(videoIds)).delete(synchronize_session=False)
+    session.query(Video).filter(Video.id.in_(videoIds)).delete(synchronize_session=False)
+    recount(session, hashes)
+
+# returns the ids of the videos of the others it had commented, whose cached lists and comments are stale once committed
+def delete_user(session, userId):
+    videoIds = session.query(Video.id).filter(Video.user_id == userId).subquery()
+    delete_videos(session, videoIds)
+    # its comments on the videos of the others
+    commented = session.query(Comment.video_id, func.count()).filter(Comment.user_id == userId).group_by(Comment.video_id).all()
+    remove_count(session, Video, 'comment_count', commented)
+    for model in (Comment, Token, Upload):
+        session.query(model).filter(model.user_id == userId).delete(synchronize_session=False)
+    session.query(User).filter(User.id == userId).delete(synchronize_session=False)
+    return [videoId for videoId, count in commented]
+
+# rows left by the deletes of before the cascades (python manage.py gc --orphans): returns model name -> count
+def delete_orphans(session, dry_run=False):
+    videoIds = session.query(Video.id)
+    userIds = session.query(User.id)
+    orphans = {
+        'video': session.query(Video.id).filter(~Video.user_id.in_(userIds)),
+        'video__format': session.query(Video_Format.id).filter(~Video_Format.video_id.in_(videoIds)),
+        'comment': session.query(Comment.id).filter(or_(~Comment.video_id.in_(videoIds), ~Comment.user_id.in_(userIds))),
+        'encode__job': session.query(Encode_Job.id).filter(~Encode_Job.video_id.in_(videoIds)),
+        'upload': session.query(Upload.id).filter(or_(~Upload.user_id.in_(userIds), Upload.video_id.isnot(None) & ~Upload.video_id.in_(videoIds))),
+        'token': session.query(Token.id).filter(~Token.user_id.in_(userIds)),
+    }
+    counts = dict((name, query.count()) for name, query in orphans.items())
+    if dry_run:
+        return counts
+
+    delete_videos(session, [row.id for row in orphans['video']]) # with their own rows
+    hashes = [row[0] for row in session.query(Video_Format.blob_id).filter(Video_Format.id.in_(orphans['video__format'].subquery()))]
+    for name, model in (('comment', Comment), ('encode__job', Encode_Job), ('upload', Upload), ('token', Token), ('video__format', Video_Format)):
+        ids = [row.id for row in orphans[name]]
+        session.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+    recount(session, hashes)
+    session.commit()
+    repair(session) # the counters of the rows left
+    return counts
+
+#################
+#### SWEEPER ####
+#################
+
+# what a sweep removed (or would remove in dry run): kind -> [files, bytes], and the first paths
+class Report(object):
+    def __init__(self, dry_run, max_paths=100):
+        self.dry_run = dry_run
+        self.kinds = {}
+        self.paths = []
+        self.max_paths = max_paths
+
+    def add(self, kind, path, size):
+        row = self.kinds.setdefault(kind, [0, 0])
+        row[0] += 1
+        row[1] += size
+        if len(self.paths) < self.max_paths:
+            self.paths.append(path)
+
+    def files(self):
+        return sum(row[0] for row in self.kinds.values())
+
+    def lines(self):
+        verb = 'would remove' if self.dry_run else 'removed'
+        lines = ['%s %d file(s), %d bytes' % (verb, self.files(), sum(row[1] for row in self.kinds.values()))]
+        for kind, (count, size) in sorted(self.kinds.items()):
+            lines.append('  %s: %d file(s), %d bytes' % (kind, count, size))
+        return lines
+
+# GC_BATCH_SIZE files, then GC_BATCH_PAUSE seconds (or until the sweeper stops)
+class Throttle(object):
+    def __init__(self, stopped=None):
+        self.batch_size = current_app.config.get('GC_BATCH_SIZE', 100)
+        self.pause = current_app.config.get('GC_BATCH_PAUSE', 1.0)
+        self.stopped = stopped or Event()
+        self.count = 0
+
+    def __call__(self):
+        self.count += 1
+        if self.count % self.batch_size == 0:
+            self.stopped.wait(self.pause)
+        return not self.stopped.is_set()
+
+# the file if nobody touched it since cutoff: a new upload of the same content touches its blob (see storage.place),
+# under the lock of place so that it can't happen between the check and the removal
+def remove_file(path, cutoff, dry_run):
+    with files_lock():
+        try:
+            stat = os.stat(path)
+            if stat.st_mtime > cutoff:
+                return None
+            if not dry_run:
+                os.remove(path)
+        except FileNotFoundError:
+            return None
+    return stat.st_size
+
+# true if the file was touched since cutoff (and is kept)
+def touched(path, cutoff):
+    with files_lock():
+        try:
+            return os.stat(path).st_mtime > cutoff
+        except FileNotFoundError:
+            return False
+
+# blobs no video or format uses anymore: the row goes first (only if still unreferenced), then the file.
+# A file touched in the grace keeps its row too, so that a new upload of the content finds it and the next sweep retries
+def sweep_blobs(report, throttle, cutoff):
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    last = ''
+    while True:
+        blobs = db.session.query(Blob.hash, Blob.path).filter(Blob.refs == 0, Blob.hash > last) \
+            .order_by(Blob.hash).limit(throttle.batch_size).all()
+        db.session.commit()
+        if not blobs:
+            return
+        for blob in blobs:
+            last = blob.hash
+            path = os.path.join(upload_folder, blob.path)
+            if touched(path, cutoff):
+                continue
+            if not report.dry_run:
+                deleted = Blob.query.filter_by(hash=blob.hash, refs=0).delete(synchronize_session=False)
+                db.session.commit()
+                if not deleted:
+                    continue # used again meanwhile
+            size = remove_file(path, cutoff, report.dry_run) # touched meanwhile: the upload puts its row back
+            if size is not None:
+                report.add('unreferenced blob', blob.path, size)
+            if not throttle():
+                return
+
+def walk(path):
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            yield os.path.join(root, name)
+
+# files of UPLOAD_FOLDER no row knows about: blobs of rolled back requests, temporary and partial files
+# of requests that died, flat files of deleted videos stored before the blobs
+def sweep_files(report, throttle, cutoff):
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    blobs = os.path.join(upload_folder, folder())
+
+    def blob_files():
+        batch = []
+        for path in walk(blobs):
+            if os.path.dirname(path) != os.path.join(blobs, 'tmp'):
+                batch.append(path)
+            if len(batch) == throttle.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    for batch in blob_files():
+        hashes = dict((os.path.splitext(os.path.basename(path))[0], path) for path in batch)
+        known = set(row.hash for row in db.session.query(Blob.hash).filter(Blob.hash.in_(list(hashes))))
+        db.session.commit()
+        for hash, path in hashes.items():
+            if hash not in known:
+                size = remove_file(path, cutoff, report.dry_run)
+                if size is not None:
+                    report.add('blob without row', os.path.relpath(path, upload_folder), size)
+                if not throttle():
+                    return
+
+    for path in walk(os.path.join(blobs, 'tmp')):
+        size = remove_file(path, cutoff, report.dry_run)
+        if size is not None:
+            report.add('temporary file', os.path.relpath(path, upload_folder), size)
+        if not throttle():
+            return
+
+    partial = os.path.join(upload_folder, 'partial')
+    names = os.listdir(partial) if os.path.isdir(partial) else []
+    uploads = set(row.id for row in db.session.query(Upload.id).filter(Upload.id.in_(names))) if names else set()
+    for name in names:
+        if name not in uploads:
+            size = remove_file(os.path.join(partial, name), cutoff, report.dry_run)
+            if size is not None:
+                report.add('partial upload without row', 'partial/' + name, size)
+            if not throttle():
+                return
+
+    # the rows of before the blobs have no blob_id (indexed), the files they use are kept
+    used = set(row[0] for row in db.session.query(Video.source).filter(Video.blob_id.is_(None)))
+    used.update(row[0] for row in db.session.query(Video_Format.uri).filter(Video_Format.blob_id.is_(None)))
+    db.session.commit()
+    for name in os.listdir(upload_folder):
+        path = os.path.join(upload_folder, name)
+        if not os.path.isfile(path) or upload_folder + name in used:
+            continue
+        size = remove_file(path, cutoff, report.dry_run)
+        if size is not None:
+            report.add('flat file without row', name, size)
+        if not throttle():
+            return
+
+# one sweep: unreferenced blobs, and every file of UPLOAD_FOLDER if scan
+def sweep(dry_run=False, scan=False, stopped=None):
+    report = Report(dry_run)
+    throttle = Throttle(stopped)
+    cutoff = time.time() - current_app.config.get('GC_GRACE', 3600)
+    try:
+        sweep_blobs(report, throttle, cutoff)
+        if scan:
+            sweep_files(report, throttle, cutoff)
+    finally:
+        db.session.remove()
+    return report
+
+# background thread of each serving process, the one holding GC_LOCK sweeps
+class Sweeper(object):
+    def __init__(self):
+        self.app = None
+        self.stopped = Event()
+        self.lock = None
+
+    def start(self, app):
+        if self.app is not None or not app.config.get('GC', True):
+            return
+        self.app = app
+        thread = Thread(target=self.run, name='media-sweeper', daemon=True)
+        thread.start()
+
+    def locked(self):
+        path = self.app.config.get('GC_LOCK')
+        if not path:
+            return True
+        if self.lock is None:
+            self.lock = open(path, 'a')
+            try:
+                fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB) # released when the process exits
+            except OSError:
+                self.lock.close()
+                self.lock = None
+        return self.lock is not None
+
+    def run(self):
+        next_scan = time.monotonic() + self.app.config.get('GC_SCAN_INTERVAL', 24 * 3600)
+        while not self.stopped.wait(self.app.config.get('GC_INTERVAL', 60)):
+            if not self.locked():
+                continue # another process sweeps
+            scan = time.monotonic() >= next_scan
+            try:
+                with self.app.app_context():
+                    report = sweep(self.app.config.get('GC_DRY_RUN', False), scan, self.stopped)
+                if report.files():
+                    self.app.logger.info('media sweeper: %s', '\n'.join(report.lines()))
+            except Exception as err:
+                self.app.logger.error('media sweeper: %s', err)
+            if scan:
+                next_scan = time.monotonic() + self.app.config.get('GC_SCAN_INTERVAL', 24 * 3600)
+
+    def stop(self):
+        self.stopped.set()
+
+sweeper = Sweeper()
@@ -0,0 +1,103 @@
+##
+## FILE WHERE WE DEFINE THE TOKENS LIFECYCLE
+## (revocation set and the reaper purging expired tokens)
+##
+
+from datetime import datetime
+from threading import Lock, Thread, Event
+
+import time
+
+# personal imports
+from models import Token, Revoked_Token
+from app import db
+
+# revoked tokens of every worker, in memory: code -> expiration date
+# filled by revoke() in this process and by sync() from the revoked_token table for the others
+class RevocationSet(object):
+    def __init__(self):
+        self._codes = {}
+        self._last_id = 0
+        self._lock = Lock()
+
+    def add(self, code, expired_at):
+        with self._lock:
+            self._codes[code] = expired_at
+
+    def __contains__(self, code):
+        return code in self._codes # dict lookup, no lock needed
+
+    # loads the revocations made since the last sync, and forgets the expired ones
+    def sync(self):
+        rows = db.session.query(Revoked_Token.id, Revoked_Token.code, Revoked_Token.expired_at) \
+            .filter(Revoked_Token.id > self._last_id).order_by(Revoked_Token.id).all()
+        now = datetime.utcnow()
+        with self._lock:
+            for row in rows:
+                self._codes[row.code] = row.expired_at
+                self._last_id = row.id
+            for code in [code for code, expired_at in self._codes.items() if expired_at <= now]:
+                del self._codes[code]
+
+    def __len__(self):
+        return len(self._codes)
+
+revoked = RevocationSet()
+
+# revokes a token for every worker (persisted) and forgets its login row
+def revoke(code, expired_at):
+    db.session.add(Revoked_Token(code = code, expired_at = expired_at))
+    Token.query.filter_by(code = code).delete(synchronize_session=False)
+    db.session.commit()
+    revoked.add(code, expired_at)
+
+# deletes expired rows by batches of batch_size, short transactions so that logins are not blocked
+# returns the number of deleted rows
+def purge_expired(batch_size=1000):
+    deleted = 0
+    now = datetime.utcnow()
+    for model in (Token, Revoked_Token):
+        while True:
+            ids = db.session.query(model.id).filter(model.expired_at < now).limit(batch_size).subquery()
+            count = model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+            deleted += count
+            if count < batch_size:
+                break
+    return deleted
+
+# background thread: syncs the revocation set every TOKEN_REVOCATION_SYNC seconds
+# and purges expired tokens every TOKEN_REAPER_INTERVAL seconds
+class Reaper(Thread):
+    def __init__(self, app):
+        Thread.__init__(self, name='token-reaper', daemon=True)
+        self.app = app
+        self.stopped = Event()
+
+    def run(self):
+        sync_interval = self.app.config.get('TOKEN_REVOCATION_SYNC', 5)
+        purge_interval = self.app.config.get('TOKEN_REAPER_INTERVAL', 600)
+        batch_size = self.app.config.get('TOKEN_REAPER_BATCH', 1000)
+        next_purge = time.monotonic()
+
+        while not self.stopped.is_set():
+            with self.app.app_context():
+                try:
+                    revoked.sync()
+                    if time.monotonic() >= next_purge:
+                        purge_expired(batch_size)
+                        next_purge = time.monotonic() + purge_interval
+                except Exception as err:
+                    db.session.rollback()
+                    self.app.logger.error('token reaper: %s', err)
+                finally:
+                    db.session.remove()
+            self.stopped.wait(sync_interval)
+
+    def stop(self):
+        self.stopped.set()
+
+def start_reaper(app):
+    reaper = Reaper(app)
+    reaper.start()
+    return reaper
@@ -0,0 +1,116 @@
+##
+## FILE WHERE WE DEFINE THE VIEW COUNTER
+## (views are added in memory and flushed to video.view by batches)
+##
+
+from flask import current_app
+from sqlalchemy import text
+from threading import Thread, Event, Lock
+
+import atexit
+import json
+import os
+
+# personal imports
+from app import db
+
+# one UPDATE per video and per flush instead of one per view:
+# video id -> views not yet in the database
+class ViewCounter(object):
+    def __init__(self):
+        self.app = None
+        self.stopped = Event()
+        self._deltas = {}
+        self._lock = Lock()
+
+    def start(self, app):
+        with self._lock:
+            if self.app is not None:
+                return
+            self.app = app
+
+        # views left by the last run if it could not flush them
+        self.load_journal()
+
+        thread = Thread(target=self.run, name='views-flusher', daemon=True)
+        thread.start()
+        atexit.register(self.stop)
+
+    def add(self, videoId, count=1):
+        if self.app is None:
+            self.start(current_app._get_current_object())
+        with self._lock:
+            self._deltas[videoId] = self._deltas.get(videoId, 0) + count
+
+    # views of a video not flushed yet, to add to video.view when reading it
+    def pending(self, videoId):
+        return self._deltas.get(videoId, 0)
+
+    def flush(self):
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+        if not deltas:
+            return 0
+
+        try:
+            with self.app.app_context():
+                with db.engine.begin() as connection:
+                    connection.execute(text('UPDATE video SET view = COALESCE(view, 0) + :count WHERE id = :id'),
+                        [{'id': videoId, 'count': count} for videoId, count in deltas.items()])
+        except Exception:
+            self.merge(deltas) # retried on the next flush
+            raise
+        return len(deltas)
+
+    def merge(self, deltas):
+        with self._lock:
+            for videoId, count in deltas.items():
+                self._deltas[videoId] = self._deltas.get(videoId, 0) + count
+
+    def run(self):
+        interval = self.app.config.get('VIEWS_FLUSH_INTERVAL', 5)
+        while not self.stopped.wait(interval):
+            try:
+                self.flush()
+            except Exception as err:
+                self.app.logger.error('views flush: %s', err)
+
+    # graceful shutdown: last flush, or the journal if the database is not reachable
+    def stop(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        try:
+            self.flush()
+        except Exception:
+            self.save_journal()
+
+    def journal_path(self):
+        return self.app.config.get('VIEWS_JOURNAL', 'views.journal') + '.%d' % os.getpid()
+
+    def save_journal(self):
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+        if deltas:
+            with open(self.journal_path(), 'w') as file:
+                json.dump(deltas, file)
+
+    def load_journal(self):
+        folder = os.path.dirname(self.app.config.get('VIEWS_JOURNAL', 'views.journal')) or '.'
+        prefix = os.path.basename(self.app.config.get('VIEWS_JOURNAL', 'views.journal')) + '.'
+        for name in os.listdir(folder):
+            if not name.startswith(prefix) or name.endswith('.loading'):
+                continue
+            path = os.path.join(folder, name)
+            try:
+                os.rename(path, path + '.loading') # only one of the workers starting together gets it
+            except OSError:
+                continue
+            try:
+                with open(path + '.loading') as file:
+                    self.merge(dict((int(videoId), count) for videoId, count in json.load(file).items()))
+                os.remove(path + '.loading')
+            except (OSError, ValueError) as err:
+                self.app.logger.error('views journal %s: %s', path, err)
+
+views = ViewCounter()
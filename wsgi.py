@@ -0,0 +1,10 @@
+##
+## FILE WHERE WE EXPOSE THE APP TO A WSGI SERVER
+## gunicorn -c gunicorn.conf.py wsgi:app
+##
+
+import os
+
+from app import create_app
+
+app = create_app(os.environ.get('API_ENV', 'prod'))